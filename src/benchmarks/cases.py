@@ -0,0 +1,512 @@
+import importlib.util
+import itertools
+import os
+import tempfile
+from typing import Callable
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from PIL import Image
+
+import models
+from dataloaders.augmentation import PairedAugmentation
+from dataloaders.ISTD_dataset import ISTD_Dataset
+from dataloaders.ISTD_shards import ISTD_Shards, LocalObjectStore, write_shards
+from export import export_generator, export_onnx, load_artifact
+from quantization import quantize_generator
+from trainer import Trainer
+from utils.arguments_parser import arguments_parser
+from utils.image_io import load_image, to_tensor
+from utils.utils import Buffer, QueueMask, mask_generator
+
+# name -> function(size, batch_size) returning the measured callable
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """
+    registers benchmark case, setup is done by the decorated function
+    and only the returned callable is measured
+    """
+
+    def register(setup: Callable[[int, int], Callable[[], None]]):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def random_images(batch_size: int, channels: int, size: int) -> torch.Tensor:
+    return torch.rand(batch_size, channels, size, size) * 2 - 1
+
+
+@benchmark("generator_s2f_forward")
+def generator_s2f_forward(size: int, batch_size: int):
+    generator = models.Generator_S2F(3, 3).eval()
+    images = random_images(batch_size, 3, size)
+
+    def run():
+        with torch.inference_mode():
+            generator(images)
+
+    return run
+
+
+def channels_last_forward(model: torch.nn.Module, inputs: tuple):
+    model.eval().to(memory_format=torch.channels_last)
+    inputs = tuple(
+        tensor.contiguous(memory_format=torch.channels_last) for tensor in inputs
+    )
+
+    def run():
+        with torch.inference_mode():
+            model(*inputs)
+
+    return run
+
+
+@benchmark("generator_s2f_forward_channels_last")
+def generator_s2f_forward_channels_last(size: int, batch_size: int):
+    return channels_last_forward(
+        models.Generator_S2F(3, 3), (random_images(batch_size, 3, size),)
+    )
+
+
+# convolutions of Generator_S2F in both memory formats, with inputs of the sizes
+# they get in the generator: 7x7 input layer on padded image, first stride 2
+# downsampling and first transposed upsampling at a quarter of the image size
+CONVOLUTIONS = {
+    "conv_7x7": (lambda: nn.Conv2d(3, 64, 7), 3, 6, 1),
+    "conv_3x3_stride_2": (lambda: nn.Conv2d(64, 128, 3, stride=2, padding=1), 64, 0, 1),
+    "conv_transpose_3x3": (
+        lambda: nn.ConvTranspose2d(256, 128, 3, stride=2, padding=1, output_padding=1),
+        256,
+        0,
+        4,
+    ),
+}
+
+
+def register_convolution(name: str, channels_last: bool) -> None:
+    create_layer, in_channels, padding, downsampling = CONVOLUTIONS[name]
+
+    @benchmark(name + ("_channels_last" if channels_last else ""))
+    def convolution(size: int, batch_size: int):
+        images = random_images(batch_size, in_channels, size // downsampling + padding)
+        if channels_last:
+            return channels_last_forward(create_layer(), (images,))
+
+        layer = create_layer().eval()
+
+        def run():
+            with torch.inference_mode():
+                layer(images)
+
+        return run
+
+
+for convolution_name in CONVOLUTIONS:
+    register_convolution(convolution_name, channels_last=False)
+    register_convolution(convolution_name, channels_last=True)
+
+
+@benchmark("generator_s2f_artifact_forward")
+def generator_s2f_artifact_forward(size: int, batch_size: int):
+    """
+    deshadower exported to TorchScript, compared with generator_s2f_forward
+    """
+    images = random_images(batch_size, 3, size)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "generator.pt")
+        torch.jit.save(export_generator(models.Generator_S2F(3, 3), (images,)), path)
+        generator = load_artifact(path, torch.device("cpu"))
+
+    def run():
+        with torch.inference_mode():
+            generator(images)
+
+    return run
+
+
+@benchmark("generator_s2f_int8_forward")
+def generator_s2f_int8_forward(size: int, batch_size: int):
+    """
+    deshadower with int8 convolutions calibrated on random images
+    """
+    images = random_images(batch_size, 3, size)
+    generator = quantize_generator(
+        models.Generator_S2F(3, 3), [(random_images(1, 3, size),) for _ in range(4)]
+    )
+
+    def run():
+        with torch.inference_mode():
+            generator(images)
+
+    return run
+
+
+def onnx_forward(generator: torch.nn.Module, inputs: tuple, threads: int):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "generator.onnx")
+        export_onnx(generator, inputs, path)
+        # ONNX Runtime threads follow --torch_threads for comparable results
+        model = load_artifact(path, torch.device("cpu"), threads, 1)
+
+    def run():
+        model(*inputs)
+
+    return run
+
+
+# ONNX Runtime is an optional dependency
+if importlib.util.find_spec("onnx") and importlib.util.find_spec("onnxruntime"):
+
+    @benchmark("generator_s2f_onnx_forward")
+    def generator_s2f_onnx_forward(size: int, batch_size: int):
+        return onnx_forward(
+            models.Generator_S2F(3, 3),
+            (random_images(batch_size, 3, size),),
+            torch.get_num_threads(),
+        )
+
+    @benchmark("generator_f2s_onnx_forward")
+    def generator_f2s_onnx_forward(size: int, batch_size: int):
+        return onnx_forward(
+            models.Generator_F2S(3, 3),
+            (
+                random_images(batch_size, 3, size),
+                random_images(batch_size, 1, size).sign(),
+            ),
+            torch.get_num_threads(),
+        )
+
+
+@benchmark("generator_s2f_backward")
+def generator_s2f_backward(size: int, batch_size: int):
+    generator = models.Generator_S2F(3, 3)
+    images = random_images(batch_size, 3, size)
+
+    def run():
+        generator.zero_grad(set_to_none=True)
+        generator(images).mean().backward()
+
+    return run
+
+
+@benchmark("generator_f2s_forward")
+def generator_f2s_forward(size: int, batch_size: int):
+    generator = models.Generator_F2S(3, 3).eval()
+    images = random_images(batch_size, 3, size)
+    masks = random_images(batch_size, 1, size).sign()
+
+    def run():
+        with torch.inference_mode():
+            generator(images, masks)
+
+    return run
+
+
+@benchmark("generator_f2s_backward")
+def generator_f2s_backward(size: int, batch_size: int):
+    generator = models.Generator_F2S(3, 3, enable_grad=True)
+    images = random_images(batch_size, 3, size)
+    masks = random_images(batch_size, 1, size).sign()
+
+    def run():
+        generator.zero_grad(set_to_none=True)
+        generator(images, masks).mean().backward()
+
+    return run
+
+
+@benchmark("discriminator_forward")
+def discriminator_forward(size: int, batch_size: int):
+    discriminator = models.Discriminator(3).eval()
+    images = random_images(batch_size, 3, size)
+
+    def run():
+        with torch.inference_mode():
+            discriminator(images)
+
+    return run
+
+
+@benchmark("trainer_iteration")
+def trainer_iteration(size: int, batch_size: int):
+    """
+    generator and both discriminators updates of one training iteration
+    """
+    opt = arguments_parser(["--size", str(size), "--batch_size", str(batch_size)])
+    trainer = Trainer(opt)
+    (
+        input_shadow,
+        input_mask,
+        target_real,
+        target_fake,
+        mask_non_shadow,
+    ) = Trainer.allocate_memory(opt)
+    real_shadow = input_shadow.copy_(random_images(batch_size, 3, size))
+    real_mask = input_mask.copy_(random_images(batch_size, 3, size))
+    criterions = Trainer.critirion_init()
+    mask_queue = QueueMask(4)
+    fake_shadow_buff, fake_mask_buff = Buffer(), Buffer()
+
+    def run():
+        results = trainer.run_one_batch_for_generator(
+            real_shadow,
+            real_mask,
+            mask_non_shadow,
+            mask_queue,
+            target_real,
+            0,
+            *criterions,
+        )
+        fake_shadow, fake_mask = results[7], results[8]
+        trainer.run_one_batch_for_discriminator_s2f(
+            real_shadow,
+            real_mask,
+            target_real,
+            target_fake,
+            fake_shadow_buff,
+            mask_queue,
+            criterions[0],
+            0,
+            fake_shadow,
+        )
+        trainer.run_one_batch_for_discriminator_f2s(
+            real_shadow,
+            real_mask,
+            target_real,
+            target_fake,
+            fake_mask_buff,
+            mask_queue,
+            criterions[0],
+            0,
+            fake_mask,
+        )
+
+    return run
+
+
+def optimizer_trainer(options: list) -> Trainer:
+    """
+    returns trainer with random gradients of all parameters for optimizer steps
+    """
+    trainer = Trainer(arguments_parser(options))
+    for network in trainer.networks().values():
+        for parameter in network.parameters():
+            parameter.grad = torch.randn_like(parameter)
+    return trainer
+
+
+def register_generator_optimizer(implementation: str) -> None:
+    @benchmark(f"generator_optimizer_step_{implementation}")
+    def generator_optimizer_step(size: int, batch_size: int):
+        """
+        Adam step over parameters of both generators, independent of image size
+        """
+        optimizer = optimizer_trainer(
+            ["--optimizer_implementation", implementation]
+        ).optimizer_gen
+        return optimizer.step
+
+
+for optimizer_implementation in ("default", "foreach", "fused"):
+    register_generator_optimizer(optimizer_implementation)
+
+
+def register_discriminator_optimizer(joint: bool) -> None:
+    @benchmark(f"discriminator_optimizer_step_{'joint' if joint else 'separate'}")
+    def discriminator_optimizer_step(size: int, batch_size: int):
+        """
+        Adam steps updating both discriminators, independent of image size
+        """
+        options = ["--optimizer_implementation", "foreach"]
+        trainer = optimizer_trainer(
+            options + (["--joint_discriminator_optimizer"] if joint else [])
+        )
+        optimizers = list(trainer.optimizers().values())[1:]
+
+        def run():
+            for optimizer in optimizers:
+                optimizer.step()
+
+        return run
+
+
+register_discriminator_optimizer(joint=False)
+register_discriminator_optimizer(joint=True)
+
+
+@benchmark("mask_generator")
+def mask_generator_case(size: int, batch_size: int):
+    shadow = random_images(batch_size, 3, size)
+    shadow_free = random_images(batch_size, 3, size)
+
+    def run():
+        mask_generator(shadow, shadow_free)
+
+    return run
+
+
+@benchmark("buffer_push_and_pop")
+def buffer_push_and_pop(size: int, batch_size: int):
+    buffer = Buffer()
+    # filled buffer, every push swaps images with probability 0.5
+    for _ in range(buffer.max_size):
+        buffer.push_and_pop(random_images(1, 3, size))
+    images = random_images(batch_size, 3, size)
+
+    def run():
+        buffer.push_and_pop(images)
+
+    return run
+
+
+@benchmark("dataset_getitem")
+def dataset_getitem(size: int, batch_size: int):
+    """
+    decoding and augmentation of batch_size image pairs of a generated PNG dataset
+    """
+    root = tempfile.TemporaryDirectory()
+    generator = np.random.default_rng(0)
+    loaded_size = int(size * 1.12)
+    for folder in ("set_A", "set_C"):
+        os.makedirs(os.path.join(root.name, "train", folder))
+        for number in range(4):
+            array = generator.integers(0, 256, (loaded_size, loaded_size, 3), np.uint8)
+            Image.fromarray(array).save(
+                os.path.join(root.name, "train", folder, f"{number}.png")
+            )
+
+    dataset = ISTD_Dataset(
+        root.name,
+        [
+            transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ],
+    )
+    indices = itertools.cycle(range(len(dataset)))
+
+    def run():
+        # the closure keeps temporary directory alive
+        root.name
+        for _ in range(batch_size):
+            dataset[next(indices)]
+
+    return run
+
+
+@benchmark("pil_augmentation")
+def pil_augmentation(size: int, batch_size: int):
+    """
+    crop, flip and normalization of batch_size decoded image pairs by PIL transforms
+    """
+    loaded_size = int(size * 1.12)
+    images = [
+        Image.fromarray(array)
+        for array in np.random.default_rng(0).integers(
+            0, 256, (2 * batch_size, loaded_size, loaded_size, 3), np.uint8
+        )
+    ]
+    transform = transforms.Compose(
+        [
+            transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ]
+    )
+
+    def run():
+        for image in images:
+            transform(image)
+
+    return run
+
+
+def register_paired_augmentation(per_sample: bool) -> None:
+    @benchmark(f"paired_augmentation_{'sample' if per_sample else 'batch'}")
+    def paired_augmentation(size: int, batch_size: int):
+        """
+        the same augmentation of collated uint8 batches of image pairs
+        """
+        loaded_size = int(size * 1.12)
+        shadow, shadow_free = torch.randint(
+            0, 256, (2, batch_size, 3, loaded_size, loaded_size), dtype=torch.uint8
+        )
+        augmentation = PairedAugmentation(size, per_sample=per_sample)
+        return lambda: augmentation(shadow, shadow_free)
+
+
+register_paired_augmentation(per_sample=True)
+register_paired_augmentation(per_sample=False)
+
+
+def register_image_decode(backend: str) -> None:
+    @benchmark(f"image_decode_{backend}")
+    def image_decode(size: int, batch_size: int):
+        """
+        decoding batch_size 640x480 PNG images of ISTD resolution to float tensors,
+        draft backend decodes them reduced when size is much smaller
+        """
+        root = tempfile.TemporaryDirectory()
+        path = os.path.join(root.name, "image.png")
+        array = np.random.default_rng(0).integers(0, 256, (480, 640, 3), np.uint8)
+        Image.fromarray(array).save(path)
+        to_float = to_tensor(backend)
+
+        def run():
+            # the closure keeps temporary directory alive
+            root.name
+            for _ in range(batch_size):
+                to_float(load_image(path, backend, size))
+
+        return run
+
+
+for image_backend in ("pil", "draft", "torchvision"):
+    register_image_decode(image_backend)
+
+
+@benchmark("shards_stream")
+def shards_stream(size: int, batch_size: int):
+    """
+    the same decoding and augmentation as dataset_getitem with pairs streamed
+    from tar shards
+    """
+    root = tempfile.TemporaryDirectory()
+    generator = np.random.default_rng(0)
+    loaded_size = int(size * 1.12)
+    for folder in ("set_A", "set_C"):
+        os.makedirs(os.path.join(root.name, "train", folder))
+        for number in range(16):
+            array = generator.integers(0, 256, (loaded_size, loaded_size, 3), np.uint8)
+            Image.fromarray(array).save(
+                os.path.join(root.name, "train", folder, f"{number}.png")
+            )
+    store = LocalObjectStore(os.path.join(root.name, "shards"))
+    write_shards(root.name, store, samples_per_shard=4)
+
+    dataset = ISTD_Shards(
+        store,
+        [
+            transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ],
+    )
+    samples = itertools.chain.from_iterable(itertools.repeat(dataset))
+
+    def run():
+        # the closure keeps temporary directory alive
+        root.name
+        for _ in range(batch_size):
+            next(samples)
+
+    return run
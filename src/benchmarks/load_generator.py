@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from PIL import Image
+
+from server import read_head
+
+"""
+Load generator of the deshadowing server measuring throughput and latency
+percentiles at increasing numbers of concurrent clients.
+Start the server with:
+python src/main.py --type serve --size 256 --max_batch_size 8
+and measure it with:
+python src/benchmarks/load_generator.py --concurrency 1 2 4 8 16 --requests 200
+"""
+
+
+def arguments_parser(args: list = None):
+    parser = argparse.ArgumentParser(description="Load generator")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="server address")
+    parser.add_argument("--port", type=int, default=8080, help="server port")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4, 8, 16],
+        help="numbers of concurrent clients, each measured separately",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=200,
+        help="measured requests of every concurrency level",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=8,
+        help="not measured requests before every concurrency level",
+    )
+    parser.add_argument(
+        "--image",
+        type=str,
+        default="",
+        help="image sent in requests, random noise image when not given",
+    )
+    parser.add_argument(
+        "--size", type=int, default=256, help="size of the random noise image"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="png",
+        choices=["png", "tensor"],
+        help="requested response format",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", type=str, default="", help="save results as json")
+    return parser.parse_args(args)
+
+
+def request_image(opt) -> bytes:
+    """
+    returns encoded image sent in every request
+    """
+    if opt.image:
+        with open(opt.image, "rb") as image_file:
+            return image_file.read()
+    noise = np.random.default_rng(opt.seed).integers(
+        0, 256, (opt.size, opt.size, 3), dtype=np.uint8
+    )
+    buffer = io.BytesIO()
+    Image.fromarray(noise).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def request(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    method: str,
+    target: str,
+    body: bytes = b"",
+) -> tuple:
+    """
+    returns (status, headers, body) of HTTP request sent over keep-alive connection
+    """
+    writer.write(
+        f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    head = await read_head(reader)
+    if head is None:
+        raise ConnectionError("Server closed the connection")
+    start_line, headers = head
+    response = await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(start_line.split(" ", 2)[1]), headers, response
+
+
+async def run_level(opt, image: bytes, concurrency: int) -> dict:
+    """
+    sends warmup and then measured requests from concurrency clients
+    """
+    target = f"/deshadow?format={opt.format}"
+    latencies, batch_sizes, errors = [], [], 0
+
+    async def client(requests: list, measured: bool) -> None:
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(opt.host, opt.port)
+        try:
+            while requests:
+                requests.pop()
+                start = time.perf_counter()
+                status, headers, _ = await request(
+                    reader, writer, "POST", target, image
+                )
+                if not measured:
+                    continue
+                if status != 200:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+                batch_sizes.append(int(headers.get("x-batch-size", 1)))
+        finally:
+            writer.close()
+
+    async def run(count: int, measured: bool) -> float:
+        requests = list(range(count))
+        start = time.perf_counter()
+        await asyncio.gather(*(client(requests, measured) for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    await run(opt.warmup, measured=False)
+    elapsed = await run(opt.requests, measured=True)
+
+    milliseconds = 1000 * np.asarray(latencies if latencies else [np.nan])
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": len(latencies) / elapsed,
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+        "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+    }
+
+
+async def server_metrics(opt) -> dict:
+    reader, writer = await asyncio.open_connection(opt.host, opt.port)
+    try:
+        _, _, body = await request(reader, writer, "GET", "/metrics")
+    finally:
+        writer.close()
+    return json.loads(body)
+
+
+async def run_load(opt) -> dict:
+    image = request_image(opt)
+    results = []
+    print(
+        f"{'concurrency':>12}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'batch':>8}{'errors':>8}"
+    )
+    for concurrency in opt.concurrency:
+        result = await run_level(opt, image, concurrency)
+        results.append(result)
+        print(
+            f"{concurrency:>12}{result['requests_per_sec']:>10.2f}"
+            f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+            f"{result['mean_batch_size']:>8.2f}{result['errors']:>8}"
+        )
+    return {"results": results, "server_metrics": await server_metrics(opt)}
+
+
+def main():
+    opt = arguments_parser()
+    results = asyncio.run(run_load(opt))
+
+    if opt.output:
+        with open(opt.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import torch
+
+from cases import BENCHMARKS
+
+"""
+CPU benchmarks of models and training hot paths.
+To run all benchmarks and store results as a baseline type:
+python src/benchmarks/run_benchmarks.py --output baseline.json
+To compare a later run against it type:
+python src/benchmarks/run_benchmarks.py --baseline baseline.json
+"""
+
+
+def arguments_parser(args: list = None):
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        default=list(BENCHMARKS),
+        choices=list(BENCHMARKS),
+        help="benchmarks to run",
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[64, 128], help="image sizes"
+    )
+    parser.add_argument(
+        "--batch_sizes", type=int, nargs="+", default=[1], help="batch sizes"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="not measured runs of every benchmark"
+    )
+    parser.add_argument(
+        "--repeats", type=int, default=10, help="measured runs of every benchmark"
+    )
+    parser.add_argument(
+        "--torch_threads",
+        type=int,
+        default=1,
+        help="number of torch intra-op threads, fixed for comparable results",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", type=str, default="", help="save results as json")
+    parser.add_argument(
+        "--baseline", type=str, default="", help="json results to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="relative slowdown of median time reported as regression",
+    )
+    return parser.parse_args(args)
+
+
+def measure(run, warmup: int, repeats: int) -> list:
+    """
+    returns times of repeats calls of run in seconds
+    """
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(opt) -> dict:
+    torch.set_num_threads(opt.torch_threads)
+    results = []
+    for name in opt.benchmarks:
+        for size in opt.sizes:
+            for batch_size in opt.batch_sizes:
+                torch.manual_seed(opt.seed)
+                times = measure(
+                    BENCHMARKS[name](size, batch_size), opt.warmup, opt.repeats
+                )
+                median = statistics.median(times)
+                results.append(
+                    {
+                        "name": name,
+                        "size": size,
+                        "batch_size": batch_size,
+                        "median_ms": 1000 * median,
+                        "mean_ms": 1000 * statistics.mean(times),
+                        "min_ms": 1000 * min(times),
+                        "stdev_ms": 1000 * statistics.pstdev(times),
+                        "images_per_sec": batch_size / median,
+                    }
+                )
+                print(
+                    f"{name:<36}{size:>6}{batch_size:>6}"
+                    f"{results[-1]['median_ms']:>12.2f} ms"
+                    f"{results[-1]['images_per_sec']:>10.2f} img/s"
+                )
+
+    return {
+        "environment": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "torch_threads": opt.torch_threads,
+            "repeats": opt.repeats,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compares median times of benchmarks present in both results.
+    Returns list of (name, size, batch_size, ratio) of regressions,
+    where ratio is current median time divided by baseline median time.
+    """
+    baseline_results = {
+        (result["name"], result["size"], result["batch_size"]): result
+        for result in baseline["results"]
+    }
+    regressions = []
+    for result in current["results"]:
+        key = (result["name"], result["size"], result["batch_size"])
+        if key not in baseline_results:
+            continue
+        ratio = result["median_ms"] / baseline_results[key]["median_ms"]
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append((*key, ratio))
+        print(
+            f"{key[0]:<36}{key[1]:>6}{key[2]:>6}{ratio:>10.2f}x"
+            f"  {'REGRESSION' if regressed else 'ok'}"
+        )
+    return regressions
+
+
+def main():
+    opt = arguments_parser()
+    current = run_benchmarks(opt)
+
+    if opt.output:
+        with open(opt.output, "w") as results_file:
+            json.dump(current, results_file, indent=2)
+
+    if opt.baseline:
+        with open(opt.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["environment"] != current["environment"]:
+            print("Warning: baseline was measured in a different environment")
+        print("\nComparison with baseline (current / baseline median time):")
+        regressions = compare(current, baseline, opt.tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} benchmarks regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import sys
+
+sys.path.insert(1, "./src")
+sys.path.insert(1, "./src/benchmarks")
+
+import pytest
+
+import run_benchmarks
+
+
+@pytest.mark.parametrize("name", ["mask_generator", "buffer_push_and_pop"])
+def test_run_benchmark(name):
+    opt = run_benchmarks.arguments_parser(
+        ["--benchmarks", name, "--sizes", "16", "--warmup", "0", "--repeats", "2"]
+    )
+    results = run_benchmarks.run_benchmarks(opt)["results"]
+
+    assert len(results) == 1
+    assert results[0]["name"] == name and results[0]["size"] == 16
+    assert results[0]["median_ms"] > 0
+
+
+def test_compare_flags_regressions():
+    baseline = {
+        "results": [
+            {"name": "a", "size": 16, "batch_size": 1, "median_ms": 10.0},
+            {"name": "b", "size": 16, "batch_size": 1, "median_ms": 10.0},
+        ]
+    }
+    current = {
+        "results": [
+            {"name": "a", "size": 16, "batch_size": 1, "median_ms": 10.5},
+            {"name": "b", "size": 16, "batch_size": 1, "median_ms": 12.0},
+            {"name": "c", "size": 16, "batch_size": 1, "median_ms": 1.0},
+        ]
+    }
+
+    regressions = run_benchmarks.compare(current, baseline, tolerance=0.1)
+    assert [regression[0] for regression in regressions] == ["b"]
+    assert regressions[0][3] == pytest.approx(1.2)
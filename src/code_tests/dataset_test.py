@@ -0,0 +1,360 @@
+import sys
+
+sys.path.insert(1, "./src")
+
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+from dataloaders.augmentation import PairedAugmentation
+from dataloaders.ISTD_cache import build_cache
+from dataloaders.ISTD_dataset import ISTD_Dataset
+from dataloaders.ISTD_masks import ISTD_Masks, build_masks
+from dataloaders.inference_dataset import Inference_Dataset
+from dataloaders.ISTD_shards import ISTD_Shards, LocalObjectStore, write_shards
+from utils.utils import mask_generator
+
+
+@pytest.fixture
+def dataset_root(tmp_path):
+    generator = np.random.default_rng(0)
+    for folder in ("set_A", "set_C"):
+        (tmp_path / "train" / folder).mkdir(parents=True)
+        for number in range(3):
+            array = generator.integers(0, 256, (24, 32, 3), dtype=np.uint8)
+            Image.fromarray(array).save(tmp_path / "train" / folder / f"{number}.png")
+    return tmp_path
+
+
+def test_cache_matches_images(dataset_root, tmp_path):
+    cache_path = str(tmp_path / "cache")
+    build_cache(str(dataset_root), cache_path)
+    dataset = ISTD_Dataset(str(dataset_root), [], cache_path=cache_path)
+
+    item = dataset[1]
+    expected = np.array(Image.open(dataset_root / "train" / "set_A" / "1.png"))
+    assert item["Shadow"].dtype == torch.uint8
+    assert torch.equal(item["Shadow"], torch.from_numpy(expected).permute(2, 0, 1))
+
+
+def test_cache_resize(dataset_root, tmp_path):
+    cache_path = str(tmp_path / "cache")
+    build_cache(str(dataset_root), cache_path, size=12)
+    dataset = ISTD_Dataset(str(dataset_root), [], cache_path=cache_path)
+
+    assert len(dataset) == 3
+    assert dataset[2]["Shadow-free"].shape == (3, 12, 16)
+
+
+def test_pil_transforms_keep_pairs_aligned(tmp_path):
+    array = np.random.default_rng(1).integers(0, 256, (24, 32, 3), dtype=np.uint8)
+    for folder in ("set_A", "set_C"):
+        (tmp_path / "train" / folder).mkdir(parents=True)
+        Image.fromarray(array).save(tmp_path / "train" / folder / "0.png")
+    dataset = ISTD_Dataset(
+        str(tmp_path),
+        [
+            transforms.RandomCrop(16),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+        ],
+    )
+
+    for _ in range(10):
+        item = dataset[0]
+        assert torch.equal(item["Shadow"], item["Shadow-free"])
+
+
+def crops(image: torch.Tensor, size: int) -> list:
+    """
+    all crops and their horizontal flips of [C, H, W] image
+    """
+    height, width = image.shape[1:]
+    return [
+        crop
+        for top in range(height - size + 1)
+        for left in range(width - size + 1)
+        for crop in (
+            image[:, top : top + size, left : left + size],
+            image[:, top : top + size, left : left + size].flip(2),
+        )
+    ]
+
+
+@pytest.mark.parametrize("per_sample", [True, False])
+def test_paired_augmentation(per_sample):
+    shadow = torch.randint(0, 256, (4, 3, 12, 16), dtype=torch.uint8)
+    shadow_free = 255 - shadow
+    augmented_shadow, augmented_shadow_free, masks = PairedAugmentation(
+        8, per_sample=per_sample
+    )(shadow, shadow_free)
+    assert masks is None
+
+    assert augmented_shadow.shape == (4, 3, 8, 8)
+    assert augmented_shadow.dtype == torch.float
+    # both images of a pair are cropped and flipped the same way
+    assert torch.allclose(augmented_shadow, -augmented_shadow_free, atol=1e-6)
+
+    normalized = shadow.float() / 127.5 - 1
+    # positions of crops matching every augmented image
+    matches = [
+        {
+            number
+            for number, crop in enumerate(crops(image, 8))
+            if torch.equal(sample, crop)
+        }
+        for sample, image in zip(augmented_shadow, normalized)
+    ]
+    assert all(matches)
+    if not per_sample:
+        # the whole batch shares one crop
+        assert set.intersection(*matches)
+
+
+def test_paired_augmentation_resize():
+    shadow = torch.randint(0, 256, (2, 3, 24, 32), dtype=torch.uint8)
+    masks = (shadow[:, :1] > 127).to(torch.uint8) * 255
+    augmented_shadow, augmented_shadow_free, augmented_masks = PairedAugmentation(
+        10, resize=12
+    )(shadow, shadow.clone(), masks)
+
+    assert augmented_shadow.shape == (2, 3, 10, 10)
+    assert torch.equal(augmented_shadow, augmented_shadow_free)
+    assert augmented_shadow.min() >= -1 and augmented_shadow.max() <= 1
+    # masks stay binary
+    assert augmented_masks.shape == (2, 1, 10, 10)
+    assert set(augmented_masks.unique().tolist()) <= {-1.0, 1.0}
+
+
+def test_paired_augmentation_masks_of_cached_images(dataset_root, tmp_path):
+    (dataset_root / "train" / "set_B").mkdir()
+    for number in range(3):
+        Image.new("L", (32, 24), 255).save(
+            dataset_root / "train" / "set_B" / f"{number}.png"
+        )
+    cache_path = str(tmp_path / "cache")
+    build_cache(str(dataset_root), cache_path, size=12)
+    # cached images are resized, masks get the same size in workers
+    dataset = ISTD_Dataset(
+        str(dataset_root),
+        [],
+        cache_path=cache_path,
+        mask_transforms_list=[
+            transforms.Resize(12, transforms.InterpolationMode.NEAREST)
+        ],
+    )
+    batch = torch.utils.data.default_collate([dataset[0], dataset[1]])
+    assert batch["Shadow"].shape[2:] == batch["Mask"].shape[2:] == (12, 16)
+
+    augmentation = PairedAugmentation(8)
+    _, _, masks = augmentation(batch["Shadow"], batch["Shadow-free"], batch["Mask"])
+    assert masks.shape == (2, 1, 8, 8)
+    # masks of other size are resized to the images
+    _, _, masks = augmentation(
+        batch["Shadow"],
+        batch["Shadow-free"],
+        torch.full((2, 1, 24, 32), 255, dtype=torch.uint8),
+    )
+    assert masks.shape == (2, 1, 8, 8) and (masks == 1).all()
+
+
+def test_paired_augmentation_masks_of_draft_images(tmp_path):
+    (tmp_path / "train").mkdir()
+    for folder in ("set_A", "set_C", "set_B"):
+        (tmp_path / "train" / folder).mkdir()
+        for number in range(2):
+            array = np.zeros((48, 64), dtype=np.uint8)
+            # left half of the image is shadow
+            array[:, :32] = 255
+            image = Image.fromarray(array)
+            if folder != "set_B":
+                image = image.convert("RGB")
+            image.save(tmp_path / "train" / folder / f"{number}.png")
+    # images are decoded reduced by factor 4, masks at full resolution
+    dataset = ISTD_Dataset(
+        str(tmp_path),
+        [transforms.PILToTensor()],
+        image_backend="draft",
+        decode_size=12,
+        mask_transforms_list=[],
+    )
+    batch = torch.utils.data.default_collate([dataset[0], dataset[1]])
+    assert batch["Shadow"].shape[2:] == (12, 16)
+    assert batch["Mask"].shape[2:] == (48, 64)
+
+    shadow, _, masks = PairedAugmentation(10, resize=12)(
+        batch["Shadow"], batch["Shadow-free"], batch["Mask"]
+    )
+    assert masks.shape == (2, 1, 10, 10)
+    # masks stay aligned with their images
+    assert torch.equal(masks, shadow[:, :1])
+
+
+def shard_images(dataset) -> list:
+    """
+    sorted shadow images of all samples as bytes
+    """
+    return sorted(sample["Shadow"].numpy().tobytes() for sample in dataset)
+
+
+def test_shards_stream_all_samples(dataset_root, tmp_path):
+    (dataset_root / "train" / "set_B").mkdir()
+    for number in range(3):
+        Image.new("L", (32, 24)).save(
+            dataset_root / "train" / "set_B" / f"{number}.png"
+        )
+    store = LocalObjectStore(str(tmp_path / "shards"))
+    write_shards(str(dataset_root), store, samples_per_shard=2)
+    assert store.list("train-") == ["train-000000.tar", "train-000001.tar"]
+
+    reference = ISTD_Dataset(str(dataset_root), [transforms.PILToTensor()])
+    dataset = ISTD_Shards(store, [transforms.PILToTensor()])
+    assert len(dataset) == 3
+    samples = list(dataset)
+    assert len(samples) == 3
+    assert shard_images(samples) == shard_images(reference[i] for i in range(3))
+    pairs = {
+        reference[i]["Shadow"].numpy().tobytes(): reference[i]["Shadow-free"]
+        for i in range(3)
+    }
+    for sample in samples:
+        assert torch.equal(
+            sample["Shadow-free"], pairs[sample["Shadow"].numpy().tobytes()]
+        )
+
+    # workers read disjoint shards
+    loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+    assert shard_images(loader) == shard_images(samples)
+
+
+def test_shards_split_between_processes(dataset_root, tmp_path):
+    store = LocalObjectStore(str(tmp_path / "shards"))
+    write_shards(str(dataset_root), store, samples_per_shard=1)
+
+    processes = [ISTD_Shards(store, [transforms.PILToTensor()]) for _ in range(2)]
+    for rank, dataset in enumerate(processes):
+        dataset.rank, dataset.world_size = rank, 2
+    for epoch in range(3):
+        # one of 3 samples is skipped, processes get different shards every epoch
+        images = [shard_images(dataset) for dataset in processes]
+        assert len(images[0]) == len(images[1]) == 1
+        assert images[0] != images[1]
+
+
+def test_uneven_shards_balanced_by_samples(tmp_path):
+    generator = np.random.default_rng(0)
+    for folder in ("set_A", "set_C"):
+        (tmp_path / "train" / folder).mkdir(parents=True)
+        for number in range(11):
+            array = generator.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+            Image.fromarray(array).save(tmp_path / "train" / folder / f"{number}.png")
+    store = LocalObjectStore(str(tmp_path / "shards"))
+    # shards of 4, 4 and 3 samples
+    write_shards(str(tmp_path), store, samples_per_shard=4)
+
+    processes = [ISTD_Shards(store, [transforms.PILToTensor()]) for _ in range(2)]
+    for rank, dataset in enumerate(processes):
+        dataset.rank, dataset.world_size = rank, 2
+    for epoch in range(3):
+        images = [shard_images(dataset) for dataset in processes]
+        # every process runs the same number of iterations
+        assert len(images[0]) == len(images[1]) == len(processes[0]) == 5
+        assert not set(images[0]) & set(images[1])
+
+    # workers split samples in whole batches, so the loader yields len() batches
+    dataset = ISTD_Shards(store, [transforms.PILToTensor()], batch_size=2)
+    for drop_last in (False, True):
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=2, num_workers=2, drop_last=drop_last
+        )
+        batches = list(loader)
+        assert len(batches) == len(loader) == (5 if drop_last else 6)
+    assert sum(len(batch["Shadow"]) for batch in batches) == 10
+
+
+def test_shards_without_masks_rejected(dataset_root, tmp_path):
+    store = LocalObjectStore(str(tmp_path / "shards"))
+    write_shards(str(dataset_root), store)
+
+    with pytest.raises(ValueError, match="set_B"):
+        ISTD_Shards(store, [transforms.PILToTensor()], mask_transforms_list=[])
+
+
+def test_precomputed_masks(dataset_root, tmp_path):
+    build_masks(str(dataset_root), str(tmp_path / "masks"))
+    masks = ISTD_Masks(str(tmp_path / "masks"))
+    dataset = ISTD_Dataset(
+        str(dataset_root),
+        [transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))],
+    )
+
+    assert len(masks) == 3
+    for index in range(3):
+        item = dataset[index]
+        expected = mask_generator(item["Shadow"][None], item["Shadow-free"][None])[0]
+        assert masks.mask(index).dtype == torch.uint8
+        assert torch.equal(masks.mask(index) == 255, expected > 0)
+
+
+@pytest.mark.parametrize("precomputed", [False, True])
+def test_masks_follow_shadow_transforms(dataset_root, tmp_path, precomputed):
+    # masks of shadow pixels brighter in the red channel
+    (dataset_root / "train" / "set_B").mkdir()
+    for number in range(3):
+        image = np.array(Image.open(dataset_root / "train" / "set_A" / f"{number}.png"))
+        mask = np.uint8(image[..., 0] > 127) * 255
+        Image.fromarray(mask).save(dataset_root / "train" / "set_B" / f"{number}.png")
+    masks_path = None
+    if precomputed:
+        # precomputed masks are read in place of set_B masks
+        build_masks(str(dataset_root), str(tmp_path / "masks"))
+        masks_path = str(tmp_path / "masks")
+
+    dataset = ISTD_Dataset(
+        str(dataset_root),
+        [
+            transforms.RandomCrop(16),
+            transforms.RandomHorizontalFlip(),
+            transforms.PILToTensor(),
+        ],
+        unaligned=True,
+        mask_transforms_list=[
+            transforms.RandomCrop(16),
+            transforms.RandomHorizontalFlip(),
+        ],
+        masks_path=masks_path,
+    )
+    for index in range(3):
+        item = dataset[index]
+        shadow = transforms.PILToTensor()(
+            Image.open(dataset_root / "train" / "set_A" / f"{index}.png")
+        )
+        mask = (
+            ISTD_Masks(masks_path).mask(index)
+            if precomputed
+            else torch.from_numpy(
+                np.array(Image.open(dataset_root / "train" / "set_B" / f"{index}.png"))
+            )[None]
+        )
+        # the mask is cropped and flipped like its shadow image
+        position = next(
+            number
+            for number, crop in enumerate(crops(shadow, 16))
+            if torch.equal(crop, item["Shadow"])
+        )
+        assert torch.equal(item["Mask"], crops(mask, 16)[position])
+
+
+def test_inference_dataset_draft_decoding(tmp_path):
+    array = np.random.default_rng(0).integers(0, 256, (40, 60, 3), dtype=np.uint8)
+    Image.fromarray(array).save(tmp_path / "image.png")
+    dataset = Inference_Dataset(
+        str(tmp_path), [transforms.ToTensor()], ".png", "draft", decode_size=15
+    )
+
+    sample = dataset[0]
+    # decoded at reduced resolution, saved back at the original size
+    assert sample["image"].shape == (3, 20, 30)
+    assert sample["size"] == (60, 40)
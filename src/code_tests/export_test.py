@@ -0,0 +1,55 @@
+import sys
+
+sys.path.insert(1, "./src")
+
+import pytest
+import torch
+
+from export import artifact_path, export_generator, export_onnx, load_artifact
+from models import Generator_F2S, Generator_S2F
+from utils.arguments_parser import arguments_parser
+
+
+def test_exported_generator_matches_eager(tmp_path):
+    generator = Generator_S2F(3, 3, n_residual_blocks=2).eval()
+    artifact = export_generator(generator, (torch.rand(1, 3, 32, 32) * 2 - 1,))
+    torch.jit.save(artifact, str(tmp_path / "generator.pt"))
+
+    loaded = load_artifact(str(tmp_path / "generator.pt"), torch.device("cpu"))
+    # traced graph isn't specialized to the example size
+    images = torch.rand(2, 3, 48, 40) * 2 - 1
+    with torch.inference_mode():
+        assert torch.allclose(loaded(images), generator(images), atol=1e-5)
+
+
+def test_onnx_shadower_matches_eager(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    generator = Generator_F2S(3, 3, n_residual_blocks=2).eval()
+    mask = (torch.rand(1, 1, 32, 32) * 2 - 1).sign()
+    export_onnx(
+        generator, (torch.rand(1, 3, 32, 32) * 2 - 1, mask), str(tmp_path / "g.onnx")
+    )
+
+    loaded = load_artifact(str(tmp_path / "g.onnx"), torch.device("cpu"), 2, 1)
+    # batch and spatial axes are dynamic
+    images = torch.rand(2, 3, 48, 40) * 2 - 1
+    masks = (torch.rand(2, 1, 48, 40) * 2 - 1).sign()
+    with torch.inference_mode():
+        assert torch.allclose(
+            loaded(images, masks), generator(images, masks), atol=1e-4
+        )
+
+
+def test_artifact_path_follows_export_format():
+    checkpoint = ["--checkpoint_path", "./results/generator.pth"]
+    onnx = ["--export_format", "onnx"]
+
+    assert artifact_path(arguments_parser(checkpoint)) == "./results/generator.pt"
+    assert artifact_path(arguments_parser(checkpoint + onnx)) == (
+        "./results/generator.onnx"
+    )
+    with pytest.raises(SystemExit):
+        artifact_path(arguments_parser(onnx + ["--export_path", "generator.pt"]))
+    with pytest.raises(SystemExit):
+        artifact_path(arguments_parser(["--export_path", "generator.onnx"]))
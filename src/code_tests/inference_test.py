@@ -0,0 +1,23 @@
+import sys
+
+sys.path.insert(1, "./src")
+
+import pytest
+import torch
+import torch.nn as nn
+
+from inference import tiled_forward
+
+
+@pytest.mark.parametrize("size", [(8, 12), (37, 50), (64, 64)])
+def test_tiled_forward_matches_pointwise_model(size):
+    torch.manual_seed(0)
+    model = nn.Conv2d(3, 2, kernel_size=1)
+    image = torch.rand(2, 3, *size)
+
+    with torch.no_grad():
+        output = tiled_forward(model, (image,), tile_size=16, overlap=4, batch_size=3)
+        expected = model(image)
+
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=1e-5)
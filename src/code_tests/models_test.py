@@ -4,6 +4,9 @@ sys.path.insert(1, "./src")
 
 import models
 import pytest
+import torch
+
+from utils.arguments_parser import arguments_parser
 
 
 @pytest.fixture()
@@ -13,12 +16,12 @@ def channels():
 
 def test_deshadower(channels):
     in_channels, out_channels = channels
-    assert models.Deshadower1(in_channels, out_channels)
+    assert models.Generator_S2F(in_channels, out_channels)
 
 
 def test_shadower(channels):
     in_channels, out_channels = channels
-    assert models.Shadower(in_channels, out_channels)
+    assert models.Generator_F2S(in_channels, out_channels)
 
 
 def test_discriminator(channels):
@@ -26,3 +29,28 @@ def test_discriminator(channels):
     assert models.Discriminator(
         in_channels,
     )
+
+
+@pytest.mark.parametrize("checkpointing", ["block", "segment"])
+def test_generator_checkpointing_gradients(checkpointing):
+    torch.manual_seed(0)
+    reference = models.Generator_S2F(3, 3, n_residual_blocks=4)
+    generator = models.Generator_S2F(
+        3, 3, n_residual_blocks=4, checkpointing=checkpointing, checkpoint_segments=2
+    )
+    generator.load_state_dict(reference.state_dict())
+    image = torch.rand(2, 3, 16, 16) * 2 - 1
+
+    reference(image).mean().backward()
+    generator(image).mean().backward()
+
+    for expected, parameter in zip(reference.parameters(), generator.parameters()):
+        assert torch.allclose(expected.grad, parameter.grad, atol=1e-6)
+
+
+@pytest.mark.parametrize("segments", ["0", "-2"])
+def test_checkpoint_segments_rejected_below_one(segments):
+    with pytest.raises(SystemExit):
+        arguments_parser(
+            ["--checkpointing", "segment", "--checkpoint_segments", segments]
+        )
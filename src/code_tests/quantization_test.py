@@ -0,0 +1,42 @@
+import sys
+
+sys.path.insert(1, "./src")
+
+import torch
+
+from export import export_generator
+from models import Generator_S2F
+from quantization import QuantizedConv, is_quantized_artifact, quantize_generator
+from utils.metrics import psnr
+
+
+def test_quantized_generator_is_close_to_float():
+    torch.manual_seed(0)
+    generator = Generator_S2F(3, 3, n_residual_blocks=2).eval()
+    calibration = [(torch.rand(1, 3, 32, 32) * 2 - 1,) for _ in range(4)]
+
+    quantized = quantize_generator(generator, calibration)
+    wrapped = [
+        module for module in quantized.modules() if isinstance(module, QuantizedConv)
+    ]
+    assert len(wrapped) == sum(
+        isinstance(m, torch.nn.Conv2d) for m in generator.modules()
+    )
+    assert all(isinstance(module.conv, torch.nn.quantized.Conv2d) for module in wrapped)
+    # float model is left untouched
+    assert not any(isinstance(m, QuantizedConv) for m in generator.modules())
+
+    images = torch.rand(2, 3, 32, 32) * 2 - 1
+    with torch.inference_mode():
+        assert psnr(quantized(images), generator(images)).min() > 25
+
+
+def test_quantized_artifact_detected(tmp_path):
+    generator = Generator_S2F(3, 3, n_residual_blocks=1).eval()
+    inputs = (torch.rand(1, 3, 16, 16) * 2 - 1,)
+    quantized = quantize_generator(generator, [inputs])
+    torch.jit.save(export_generator(quantized, inputs), tmp_path / "int8.pt")
+    torch.jit.save(export_generator(generator, inputs), tmp_path / "float.pt")
+
+    assert is_quantized_artifact(str(tmp_path / "int8.pt"))
+    assert not is_quantized_artifact(str(tmp_path / "float.pt"))
@@ -0,0 +1,142 @@
+import sys
+
+sys.path.insert(1, "./src")
+sys.path.insert(1, "./src/benchmarks")
+
+import asyncio
+import io
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from load_generator import request
+from models import Generator_S2F
+from server import DeshadowServer, MicroBatcher
+
+
+def test_micro_batcher_splits_requests_by_max_batch_size():
+    async def run() -> list:
+        batcher = MicroBatcher(lambda images: images * 2, max_batch_size=4)
+        batcher.max_delay = 0.05
+        batcher.start()
+        try:
+            return await asyncio.gather(
+                *(batcher.submit(torch.full((1, 2, 2), float(i))) for i in range(6))
+            )
+        finally:
+            await batcher.close()
+
+    results = asyncio.run(run())
+
+    for i, (output, _) in enumerate(results):
+        assert torch.equal(output, torch.full((1, 2, 2), 2.0 * i))
+    assert [batch_size for _, batch_size in results] == [4] * 4 + [2] * 2
+
+
+def test_server_answers_png_and_tensor():
+    torch.manual_seed(0)
+    model = Generator_S2F(3, 3, n_residual_blocks=1).eval()
+    image = Image.fromarray(
+        np.random.default_rng(0).integers(0, 256, (12, 20, 3), dtype=np.uint8)
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+
+    server = DeshadowServer(model, size=16, max_batch_size=2, max_delay=0.5)
+
+    async def run() -> tuple:
+        port = await server.start(port=0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            png, tensor = await asyncio.gather(
+                request(reader, writer, "POST", "/deshadow", buffer.getvalue()),
+                server.deshadow(buffer.getvalue(), "tensor"),
+            )
+            responses = [
+                png,
+                await request(reader, writer, "POST", "/deshadow", b"not an image"),
+                await request(reader, writer, "GET", "/unknown"),
+                await request(reader, writer, "GET", "/metrics"),
+            ]
+        finally:
+            writer.close()
+            await server.close()
+        return tensor, responses
+
+    (tensor, tensor_headers), responses = asyncio.run(run())
+    png, bad_image, unknown, metrics = responses
+
+    assert png[0] == 200 and png[1]["x-batch-size"] == "2"
+    assert Image.open(io.BytesIO(png[2])).size == (20, 12)
+
+    shape = tuple(int(side) for side in tensor_headers["X-Tensor-Shape"].split(","))
+    output = torch.from_numpy(np.frombuffer(tensor, dtype="<f4").reshape(shape).copy())
+    with torch.inference_mode():
+        expected = model(server.transform(image)[None])
+        expected = F.interpolate(
+            expected, size=(12, 20), mode="bilinear", align_corners=False
+        )[0]
+    assert shape == (3, 12, 20)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+    assert bad_image[0] == 400 and unknown[0] == 404
+    assert metrics[0] == 200
+    snapshot = json.loads(metrics[2])
+    # the tensor request skipped HTTP routing, which counts requests
+    assert snapshot["requests"] == 1 and snapshot["errors"] == 1
+    assert snapshot["batches"] == 1 and snapshot["queue_depth"] == 0
+
+
+def test_server_rejects_malformed_requests_and_clamps_outputs():
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), (250, 5, 250)).save(buffer, format="PNG")
+    # output outside [-1, 1] like of exported or quantized models
+    server = DeshadowServer(lambda images: images * 3, size=8, max_delay=0.0)
+
+    async def run() -> tuple:
+        port = await server.start(port=0)
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            png = await request(reader, writer, "POST", "/deshadow", buffer.getvalue())
+            writer.write(b"GARBAGE\r\n\r\n")
+            status_line = await reader.readline()
+            # the connection is closed after the error response
+            await reader.read()
+            writer.close()
+        finally:
+            await server.close()
+        return png, status_line
+
+    png, status_line = asyncio.run(run())
+
+    assert status_line.startswith(b"HTTP/1.1 400")
+    pixels = np.asarray(Image.open(io.BytesIO(png[2])))
+    assert (pixels == (255, 0, 255)).all()
+
+
+def test_server_answers_draft_decoded_images_at_original_size():
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), (0, 0, 255)).save(buffer, format="PNG")
+    # short side is over 2x size, so the draft backend decodes it reduced
+    server = DeshadowServer(lambda images: images, size=8, image_backend="draft")
+
+    async def run() -> tuple:
+        port = await server.start(port=0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            return await asyncio.gather(
+                request(reader, writer, "POST", "/deshadow", buffer.getvalue()),
+                server.deshadow(buffer.getvalue(), "tensor"),
+            )
+        finally:
+            writer.close()
+            await server.close()
+
+    png, (_, tensor_headers) = asyncio.run(run())
+
+    assert png[0] == 200
+    assert Image.open(io.BytesIO(png[2])).size == (40, 30)
+    assert tensor_headers["X-Tensor-Shape"] == "3,30,40"
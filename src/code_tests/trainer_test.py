@@ -1,13 +1,18 @@
+import socket
 import sys
 
 sys.path.insert(1, "./src")
 
 import pytest
+import torch
 
 import trainer
 
+from dataloaders.data_loader import channels_last_collate
+from utils import distributed
 from utils.arguments_parser import arguments_parser
-
+from utils.batch_buffers import BatchBuffers
+from utils.utils import Buffer, QueueMask
 
 """
 To run tests type:
@@ -58,3 +63,352 @@ def test_learning_rate_schedulers_init(init_options):
     opt, trainer_object = init_options
     # trainer_object = trainer.Trainer(opt)
     assert trainer_object.learning_rate_schedulers_init(opt, 1)
+
+
+def test_amp_iteration_on_cpu():
+    opt = arguments_parser(["--amp", "--f2s_grad", "--size", "32", "--batch_size", "2"])
+    trainer_object = trainer.Trainer(opt)
+    if not torch.cuda.is_available():
+        assert trainer_object.amp_dtype == torch.bfloat16
+
+    input_shadow, input_mask, target_real, target_fake, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    real_shadow = input_shadow.copy_(torch.rand_like(input_shadow) * 2 - 1)
+    real_mask = input_mask.copy_(torch.rand_like(input_mask) * 2 - 1)
+    criterions = trainer.Trainer.critirion_init()
+    mask_queue = QueueMask(4)
+
+    results = trainer_object.run_one_batch_for_generator(
+        real_shadow, real_mask, mask_non_shadow, mask_queue, target_real, 0, *criterions
+    )
+    gen_loss, fake_shadow, fake_mask = results[0], results[7], results[8]
+    assert torch.isfinite(gen_loss)
+    # with --f2s_grad both generators receive gradients
+    assert trainer_object.generator_free_to_shadow.model[1].weight.grad is not None
+    assert trainer_object.generator_shadow_to_free.model[1].weight.grad is not None
+
+    loss_disc, _ = trainer_object.run_one_batch_for_discriminator_s2f(
+        real_shadow,
+        real_mask,
+        target_real,
+        target_fake,
+        Buffer(),
+        mask_queue,
+        criterions[0],
+        0,
+        fake_shadow,
+    )
+    assert torch.isfinite(loss_disc)
+
+
+def test_frozen_shadower_losses_not_computed():
+    opt = arguments_parser(["--size", "32", "--batch_size", "2"])
+    trainer_object = trainer.Trainer(opt)
+    input_shadow, input_mask, target_real, _, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    real_shadow = input_shadow.copy_(torch.rand_like(input_shadow) * 2 - 1)
+    real_mask = input_mask.copy_(torch.rand_like(input_mask) * 2 - 1)
+
+    results = trainer_object.run_one_batch_for_generator(
+        real_shadow,
+        real_mask,
+        mask_non_shadow,
+        QueueMask(4),
+        target_real,
+        0,
+        *trainer.Trainer.critirion_init(),
+    )
+    # identity and cycle losses of the shadower are skipped, not reported as 0
+    assert results[2] is None and results[6] is None
+    assert torch.allclose(results[0], sum(results[i] for i in (1, 3, 4, 5)))
+
+
+def test_generator_step_error_unfreezes_discriminators():
+    opt = arguments_parser(["--size", "32", "--batch_size", "2"])
+    trainer_object = trainer.Trainer(opt)
+    input_shadow, input_mask, target_real, _, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    _, cycle_loss_criterion, identity_loss_criterion = trainer.Trainer.critirion_init()
+
+    def failing_criterion(*inputs):
+        raise RuntimeError("failing loss")
+
+    with pytest.raises(RuntimeError, match="failing loss"):
+        trainer_object.run_one_batch_for_generator(
+            input_shadow.zero_(),
+            input_mask.zero_(),
+            mask_non_shadow,
+            QueueMask(4),
+            target_real,
+            0,
+            failing_criterion,
+            cycle_loss_criterion,
+            identity_loss_criterion,
+        )
+    for discriminator in (
+        trainer_object.discriminator_shadow_to_free,
+        trainer_object.discriminator_free_to_shadow,
+    ):
+        assert all(parameter.requires_grad for parameter in discriminator.parameters())
+
+
+def test_save_and_resume_training_state(tmp_path):
+    opt = arguments_parser(["--size", "32"])
+    trainer_object = trainer.Trainer(opt)
+    trainer_object.learning_rate_schedulers_init(opt, current_epoch=0)
+    trainer_object.update_lr_per_batch()
+    mask_queue = QueueMask(4)
+    mask_queue.insert(torch.ones(2, 1, 8, 8))
+    path = str(tmp_path / "state" / "training_state.pth")
+
+    trainer_object.save_training_state(path, 5, 123, {"mask_queue": mask_queue})
+    trainer_object.checkpoint_writer.wait()
+
+    resumed = trainer.Trainer(opt)
+    resumed.learning_rate_schedulers_init(opt, current_epoch=0)
+    resumed_queue = QueueMask(4)
+    epoch, iteration = resumed.resume_training_state(
+        path, {"mask_queue": resumed_queue}
+    )
+    assert (epoch, iteration) == (5, 123)
+    for name, network in trainer_object.networks().items():
+        for expected, parameter in zip(
+            network.parameters(), resumed.networks()[name].parameters()
+        ):
+            assert torch.equal(expected, parameter)
+    assert resumed.lr_schedulers["lr_scheduler_gen"].last_epoch == 1
+    assert len(resumed_queue) == 2
+
+
+def test_channels_last_iteration():
+    opt = arguments_parser(["--channels_last", "--size", "32", "--batch_size", "2"])
+    trainer_object = trainer.Trainer(opt)
+    assert trainer_object.generator_shadow_to_free.model[1].weight.is_contiguous(
+        memory_format=torch.channels_last
+    )
+
+    input_shadow, input_mask, target_real, _, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    assert input_shadow.is_contiguous(memory_format=torch.channels_last)
+    batch = channels_last_collate(
+        [{"Shadow": torch.rand(3, 32, 32), "Shadow-free": torch.rand(3, 32, 32)}] * 2
+    )
+    real_shadow = input_shadow.copy_(batch["Shadow"])
+    real_mask = input_mask.copy_(batch["Shadow-free"])
+    assert real_shadow.is_contiguous(memory_format=torch.channels_last)
+
+    results = trainer_object.run_one_batch_for_generator(
+        real_shadow,
+        real_mask,
+        mask_non_shadow,
+        QueueMask(4),
+        target_real,
+        0,
+        *trainer.Trainer.critirion_init(),
+    )
+    assert torch.isfinite(results[0])
+
+
+def distributed_iteration(opt):
+    trainer_object = trainer.Trainer(opt)
+    input_shadow, input_mask, target_real, target_fake, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    # every process trains on different images
+    torch.manual_seed(distributed.rank())
+    real_shadow = input_shadow.copy_(torch.rand_like(input_shadow) * 2 - 1)
+    real_mask = input_mask.copy_(torch.rand_like(input_mask) * 2 - 1)
+    criterions = trainer.Trainer.critirion_init()
+    mask_queue = QueueMask(4)
+
+    results = trainer_object.run_one_batch_for_generator(
+        real_shadow, real_mask, mask_non_shadow, mask_queue, target_real, 0, *criterions
+    )
+    trainer_object.run_one_batch_for_discriminator_s2f(
+        real_shadow,
+        real_mask,
+        target_real,
+        target_fake,
+        Buffer(),
+        mask_queue,
+        criterions[0],
+        0,
+        results[7],
+    )
+    torch.save(
+        {name: model.state_dict() for name, model in trainer_object.networks().items()},
+        f"{opt.training_state_path}.{distributed.rank()}",
+    )
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.mark.parametrize("f2s_grad", [False, True])
+def test_distributed_replicas_stay_in_sync(tmp_path, monkeypatch, f2s_grad):
+    # launch keeps address and port of an earlier process group in environment
+    monkeypatch.delenv("MASTER_ADDR", raising=False)
+    monkeypatch.delenv("MASTER_PORT", raising=False)
+    opt = arguments_parser(
+        ["--size", "32", "--batch_size", "2", "--nproc_per_node", "2"]
+        + ["--master_port", str(free_port()), "--dist_backend", "gloo"]
+        + ["--training_state_path", str(tmp_path / "state")]
+        + (["--f2s_grad"] if f2s_grad else [])
+    )
+    distributed.launch(distributed_iteration, opt)
+
+    states = [torch.load(tmp_path / f"state.{rank}") for rank in range(2)]
+    for name, state in states[0].items():
+        for key, tensor in state.items():
+            assert torch.equal(tensor, states[1][name][key]), f"{name}.{key}"
+
+
+def test_batch_buffers_shapes_and_reuse():
+    opt = arguments_parser(["--size", "32", "--batch_size", "3"])
+    trainer_object = trainer.Trainer(opt)
+    batch_buffers = BatchBuffers(3, trainer_object.device)
+
+    full = batch_buffers.load(torch.rand(3, 3, 32, 32), torch.rand(3, 3, 32, 32))
+    # partial last batch gets buffers of its own
+    partial = batch_buffers.load(torch.rand(2, 3, 32, 32), torch.rand(2, 3, 32, 32))
+    assert partial[0].shape == (2, 3, 32, 32) and partial[4].shape == (2, 1, 32, 32)
+    assert batch_buffers.get(3, 32, 32)[0] is full[0]
+
+    # targets match discriminator outputs, so losses don't broadcast
+    prediction = trainer_object.discriminator_shadow_to_free(partial[0])
+    assert prediction.shape == partial[2].shape == partial[3].shape == (2, 1)
+
+
+def test_joint_discriminator_optimizer():
+    opt = arguments_parser(
+        ["--joint_discriminator_optimizer", "--optimizer_implementation", "foreach"]
+        + ["--size", "32", "--batch_size", "2"]
+    )
+    trainer_object = trainer.Trainer(opt)
+    trainer_object.learning_rate_schedulers_init(opt, current_epoch=0)
+    assert trainer_object.optimizer_disc_deshadower is (
+        trainer_object.optimizer_disc_shadower
+    )
+    assert len(trainer_object.optimizers()) == 2
+    assert len(trainer_object.scalers()) == 2
+    assert len(trainer_object.lr_schedulers) == 2
+
+    input_shadow, input_mask, target_real, target_fake, _ = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    real_shadow = input_shadow.copy_(torch.rand_like(input_shadow) * 2 - 1)
+    real_mask = input_mask.copy_(torch.rand_like(input_mask) * 2 - 1)
+    criterion = trainer.Trainer.critirion_init()[0]
+    mask_queue = QueueMask(4)
+    deshadower_weight = trainer_object.discriminator_shadow_to_free.model[0].weight
+    shadower_weight = trainer_object.discriminator_free_to_shadow.model[0].weight
+    before = deshadower_weight.detach().clone(), shadower_weight.detach().clone()
+
+    trainer_object.run_one_batch_for_discriminator_s2f(
+        real_shadow,
+        real_mask,
+        target_real,
+        target_fake,
+        Buffer(),
+        mask_queue,
+        criterion,
+        0,
+        real_mask.clone(),
+    )
+    # deshadower discriminator waits for the joint step
+    assert torch.equal(deshadower_weight, before[0])
+    trainer_object.run_one_batch_for_discriminator_f2s(
+        real_shadow,
+        real_mask,
+        target_real,
+        target_fake,
+        Buffer(),
+        mask_queue,
+        criterion,
+        0,
+        real_shadow.clone(),
+    )
+    assert not torch.equal(deshadower_weight, before[0])
+    assert not torch.equal(shadower_weight, before[1])
+
+
+@pytest.mark.parametrize("accumulation_steps", [2, 3])
+def test_gradient_accumulation_matches_full_batch(accumulation_steps):
+    images = torch.rand(2, 3, 32, 32) * 2 - 1, torch.rand(2, 3, 32, 32) * 2 - 1
+    criterion = trainer.Trainer.critirion_init()[0]
+
+    def discriminator_step(trainer_object, shadow, shadow_free, targets):
+        trainer_object.run_one_batch_for_discriminator_s2f(
+            shadow,
+            shadow_free,
+            targets[: shadow.size(0)],
+            torch.zeros_like(targets[: shadow.size(0)]),
+            Buffer(),
+            QueueMask(4),
+            criterion,
+            0,
+            shadow_free,
+        )
+        return trainer_object.discriminator_shadow_to_free
+
+    torch.manual_seed(0)
+    full_batch = trainer.Trainer(
+        arguments_parser(["--size", "32", "--batch_size", "2"])
+    )
+    full = discriminator_step(full_batch, *images, torch.ones(2, 1))
+
+    torch.manual_seed(0)
+    accumulated = trainer.Trainer(
+        arguments_parser(
+            ["--size", "32", "--accumulation_steps", str(accumulation_steps)]
+        )
+    )
+    weight = accumulated.discriminator_shadow_to_free.model[0].weight
+    initial = weight.detach().clone()
+    # with 3 steps the end of epoch closes the window after 2 micro-batches
+    assert not accumulated.begin_micro_batch(remaining_batches=2)
+    discriminator_step(accumulated, images[0][:1], images[1][:1], torch.ones(1, 1))
+    # optimizer waits for the last micro-batch
+    assert torch.equal(weight, initial)
+    assert accumulated.begin_micro_batch(remaining_batches=1)
+    micro = discriminator_step(
+        accumulated, images[0][1:], images[1][1:], torch.ones(1, 1)
+    )
+    assert not torch.equal(weight, initial)
+
+    for full_parameter, micro_parameter in zip(full.parameters(), micro.parameters()):
+        assert torch.allclose(
+            full_parameter.grad, micro_parameter.grad, rtol=1e-4, atol=1e-6
+        )
+
+
+def test_generator_queues_given_masks():
+    opt = arguments_parser(["--size", "32", "--batch_size", "2"])
+    trainer_object = trainer.Trainer(opt)
+    input_shadow, input_mask, target_real, _, mask_non_shadow = (
+        trainer.Trainer.allocate_memory(opt)
+    )
+    real_shadow = input_shadow.copy_(torch.rand_like(input_shadow) * 2 - 1)
+    real_mask = input_mask.copy_(torch.rand_like(input_mask) * 2 - 1)
+    masks = (torch.rand(2, 1, 32, 32) * 2 - 1).sign()
+    mask_queue = QueueMask(4)
+
+    trainer_object.run_one_batch_for_generator(
+        real_shadow,
+        real_mask,
+        mask_non_shadow,
+        mask_queue,
+        target_real,
+        0,
+        *trainer.Trainer.critirion_init(),
+        masks,
+    )
+    # masks aren't generated from deshadowed images
+    assert torch.equal(mask_queue.last_item(), masks)
@@ -0,0 +1,166 @@
+import sys
+
+sys.path.insert(1, "./src")
+
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms as transforms
+from skimage.filters import threshold_otsu
+from PIL import Image
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from utils.image_io import image_size, load_image, to_tensor
+from utils.metrics import psnr, ssim
+from utils.profiler import StepProfiler, _percentile
+from utils.utils import Buffer, QueueMask, mask_generator, otsu_threshold
+
+
+def reference_mask(shadow_img: torch.Tensor, shadow_free_img: torch.Tensor):
+    """
+    PIL & skimage based mask generation for a single image
+    """
+    to_gray = transforms.Compose(
+        [transforms.ToPILImage(), transforms.Grayscale(num_output_channels=1)]
+    )
+    diff = np.asarray(to_gray((shadow_free_img + 1) * 0.5), dtype="float32")
+    diff = diff - np.asarray(to_gray((shadow_img + 1) * 0.5), dtype="float32")
+    return torch.tensor((np.float32(diff >= threshold_otsu(diff)) - 0.5) / 0.5)
+
+
+def test_otsu_threshold_matches_skimage():
+    values = torch.randn(3, 1000) * torch.tensor([[1.0], [10.0], [100.0]])
+    thresholds = otsu_threshold(values)
+    for row, threshold in zip(values, thresholds):
+        assert threshold.item() == pytest.approx(threshold_otsu(row.numpy()), abs=1e-3)
+
+
+def test_otsu_threshold_constant_row():
+    assert otsu_threshold(torch.full((1, 10), 4.0)).item() == 4.0
+
+
+def test_mask_generator_batch():
+    torch.manual_seed(0)
+    shadow = torch.rand(2, 3, 32, 32) * 2 - 1
+    shadow_free = torch.rand(2, 3, 32, 32) * 2 - 1
+
+    mask = mask_generator(shadow, shadow_free)
+
+    assert mask.shape == (2, 1, 32, 32)
+    for index in range(2):
+        expected = reference_mask(shadow[index], shadow_free[index])
+        assert torch.equal(mask[index, 0], expected)
+
+
+def test_queue_mask_ring_buffer():
+    queue = QueueMask(3)
+    for value in range(4):
+        queue.insert(torch.full((2, 1, 4, 4), float(value)))
+
+    assert len(queue) == 3
+    assert torch.equal(queue.last_item(), torch.full((2, 1, 4, 4), 3.0))
+    # the oldest masks were overwritten
+    assert set(queue.queue[:, 0, 0, 0].tolist()) == {2.0, 3.0}
+    assert queue.rand_item(5).shape == (5, 1, 4, 4)
+
+
+def test_buffer_push_and_pop():
+    buffer = Buffer(max_size=4)
+    first = torch.rand(3, 3, 8, 8)
+    assert torch.equal(buffer.push_and_pop(first), first)
+
+    second = torch.rand(3, 3, 8, 8)
+    result = buffer.push_and_pop(second)
+    assert result.shape == second.shape
+    assert torch.equal(result[0], second[0])
+    assert buffer.size == 4
+    # every returned image is either the pushed one or a previously stored one
+    pool = torch.cat((first, second))
+    for image in result:
+        assert any(torch.equal(image, candidate) for candidate in pool)
+
+
+def test_buffer_swaps_distinct_images():
+    for seed in range(20):
+        torch.manual_seed(seed)
+        buffer = Buffer(max_size=4)
+        stored = torch.arange(4.0).view(4, 1, 1, 1)
+        buffer.push_and_pop(stored)
+
+        incoming = torch.arange(4.0, 10.0).view(6, 1, 1, 1)
+        result = buffer.push_and_pop(incoming)
+        # images are only exchanged, none is duplicated or lost
+        values = torch.cat((result, buffer.data)).flatten().tolist()
+        assert sorted(values) == list(range(10))
+
+
+def test_step_profiler():
+    profiler = StepProfiler(enabled=True, report_every=1000)
+    for _ in range(3):
+        profiler.begin_step()
+        with profiler.phase("forward"):
+            torch.ones(8).sum()
+        profiler.end_step(images=2)
+
+    assert profiler.steps == 3
+    assert len(profiler.phases["forward"]) == 3
+    # time between steps is attributed to data loading
+    assert len(profiler.phases["data"]) == 2
+    assert sum(profiler.step_images) == 6
+    assert _percentile([1, 2, 3, 4], 50) == 2 and _percentile([1, 2, 3, 4], 95) == 4
+
+    disabled = StepProfiler()
+    with disabled.phase("forward"):
+        pass
+    assert not disabled.phases
+
+
+def test_psnr_and_ssim_match_skimage():
+    torch.manual_seed(0)
+    images = torch.rand(2, 3, 32, 32) * 2 - 1
+    references = (images + 0.2 * torch.randn_like(images)).clamp(-1, 1)
+
+    for image, reference, image_psnr, image_ssim in zip(
+        images, references, psnr(images, references), ssim(images, references)
+    ):
+        image, reference = (
+            image.permute(1, 2, 0).numpy(),
+            reference.permute(1, 2, 0).numpy(),
+        )
+        assert image_psnr.item() == pytest.approx(
+            peak_signal_noise_ratio(reference, image, data_range=2.0), rel=1e-4
+        )
+        expected_ssim = structural_similarity(
+            image,
+            reference,
+            data_range=2.0,
+            channel_axis=2,
+            gaussian_weights=True,
+            sigma=1.5,
+            use_sample_covariance=False,
+        )
+        assert image_ssim.item() == pytest.approx(expected_ssim, abs=1e-4)
+
+
+def test_image_backends(tmp_path):
+    array = np.random.default_rng(0).integers(0, 256, (40, 60, 3), dtype=np.uint8)
+    Image.fromarray(array).save(tmp_path / "rgb.png")
+    Image.fromarray(array[..., 0]).save(tmp_path / "gray.png")
+
+    expected = to_tensor("pil")(Image.fromarray(array))
+    for backend in ("pil", "draft", "torchvision"):
+        image = load_image(str(tmp_path / "rgb.png"), backend)
+        assert image_size(image) == (60, 40)
+        assert torch.equal(to_tensor(backend)(image), expected)
+
+    # grayscale images are converted to RGB by every backend
+    gray = load_image(str(tmp_path / "gray.png"), "torchvision")
+    assert torch.equal(gray, torch.from_numpy(array[..., 0]).expand(3, 40, 60))
+    assert np.array_equal(
+        np.asarray(load_image(str(tmp_path / "gray.png"))),
+        gray.permute(1, 2, 0).numpy(),
+    )
+
+    # draft backend decodes images much larger than needed at reduced resolution
+    assert image_size(load_image(str(tmp_path / "rgb.png"), "draft", 15)) == (30, 20)
+    assert image_size(load_image(str(tmp_path / "rgb.png"), "draft", 30)) == (60, 40)
@@ -0,0 +1,113 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from PIL import Image
+
+INDEX_FILE = "index.json"
+DATA_FILE = "images.bin"
+
+
+def build_cache(root: str, cache_path: str, mode: str = "train", size=None) -> None:
+    """
+    Decodes all set_A/set_C images of the dataset split once, optionally resizes them
+    (same semantic as transforms.Resize) and writes them into one uint8 memory-mapped
+    file with a json index next to it.
+    """
+    resize = (
+        transforms.Resize(size, transforms.InterpolationMode.BICUBIC)
+        if size is not None
+        else None
+    )
+    directories = {
+        "shadow": os.path.join(root, mode, "set_A"),
+        "shadow_free": os.path.join(root, mode, "set_C"),
+    }
+
+    # first pass reads only image headers to compute the layout of the data file
+    index = {"mode": mode, "size": size}
+    offset = 0
+    for kind, directory in directories.items():
+        entries = []
+        for file_name in sorted(os.listdir(directory)):
+            with Image.open(os.path.join(directory, file_name)) as image:
+                width, height = image.size
+            if resize is not None:
+                height, width = _resized_shape(height, width, size)
+            entries.append(
+                {"name": file_name, "offset": offset, "shape": [height, width, 3]}
+            )
+            offset += height * width * 3
+        index[kind] = entries
+
+    os.makedirs(cache_path, exist_ok=True)
+    data = np.memmap(
+        os.path.join(cache_path, DATA_FILE), dtype=np.uint8, mode="w+", shape=(offset,)
+    )
+
+    for kind, directory in directories.items():
+        for number, entry in enumerate(index[kind]):
+            image = Image.open(os.path.join(directory, entry["name"])).convert("RGB")
+            if resize is not None:
+                image = resize(image)
+            array = np.asarray(image, dtype=np.uint8)
+            assert list(array.shape) == entry["shape"], "Unexpected image shape"
+            data[entry["offset"] : entry["offset"] + array.size] = array.reshape(-1)
+            print(f"Cached {kind} images {(number + 1):04d} of {len(index[kind]):04d}")
+
+    data.flush()
+    del data
+
+    # index is written last so an interrupted build is never mistaken for a valid cache
+    with open(os.path.join(cache_path, INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file)
+
+
+def _resized_shape(height: int, width: int, size) -> tuple:
+    """
+    returns (height, width) of an image after transforms.Resize(size)
+    """
+    if isinstance(size, (list, tuple)):
+        return int(size[0]), int(size[1])
+    if width <= height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+
+class ISTD_Cache:
+    """
+    Read access to a cache written by build_cache. The memory map is opened lazily,
+    so every DataLoader worker maps the same file and shares its pages.
+    Images are returned as zero-copy uint8 CHW tensor views.
+    """
+
+    def __init__(self, cache_path: str) -> None:
+        self.cache_path = cache_path
+        with open(os.path.join(cache_path, INDEX_FILE)) as index_file:
+            self.index = json.load(index_file)
+        self.shadow_files = [entry["name"] for entry in self.index["shadow"]]
+        self.shadow_free_files = [entry["name"] for entry in self.index["shadow_free"]]
+        self.data = None
+
+    def __getstate__(self) -> dict:
+        # memory map is never pickled into worker processes, each one maps it itself
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def image(self, kind: str, index: int) -> torch.Tensor:
+        """
+        returns image of given kind ("shadow" or "shadow_free") as uint8 CHW tensor
+        """
+        if self.data is None:
+            # copy-on-write mode gives writable arrays without touching the file
+            self.data = np.memmap(
+                os.path.join(self.cache_path, DATA_FILE), dtype=np.uint8, mode="c"
+            )
+        entry = self.index[kind][index]
+        height, width, channels = entry["shape"]
+        array = self.data[entry["offset"] : entry["offset"] + height * width * channels]
+        return torch.from_numpy(array.reshape(height, width, channels)).permute(2, 0, 1)
@@ -1,78 +1,114 @@
-
 import os
 import random
 
 import torch
 import torchvision.transforms as transforms
 
-from PIL import Image
+from dataloaders.ISTD_cache import ISTD_Cache
+from dataloaders.ISTD_masks import ISTD_Masks
+from utils.image_io import load_image, load_mask
 
 
 class ISTD_Dataset(torch.utils.data.Dataset):
-    def __init__(self, root, transforms_list:list=None, unaligned:bool=False, mode:str="train") -> None:
+    def __init__(
+        self,
+        root,
+        transforms_list: list = None,
+        unaligned: bool = False,
+        mode: str = "train",
+        cache_path: str = None,
+        image_backend: str = "pil",
+        decode_size: int = None,
+        mask_transforms_list: list = None,
+        masks_path: str = None,
+    ) -> None:
+        """
+        With cache_path set images are served as uint8 CHW tensors from a cache built
+        by dataloaders.ISTD_cache.build_cache, so transforms_list has to work on tensors.
+        Otherwise images are decoded by utils.image_io.load_image with image_backend,
+        draft backend decodes them reduced to no less than decode_size.
+        With mask_transforms_list set every sample also holds "Mask" of the shadow
+        image, set_B ground truth mask or mask precomputed by
+        dataloaders.ISTD_masks.build_masks into masks_path. Masks are uint8 [1, H, W]
+        tensors transformed with the same random crop and flip as the shadow image.
+        """
         self.transform = transforms.Compose(transforms_list)
+        self.mask_transform = (
+            transforms.Compose(mask_transforms_list)
+            if mask_transforms_list is not None
+            else None
+        )
+        self.masks = ISTD_Masks(masks_path) if masks_path else None
+        self.root_masks = root + "/" + mode + "/set_B"
         self.unaligned = unaligned
+        self.image_backend = image_backend
+        self.decode_size = decode_size
         self.root_shadow_imgs = root + "/" + mode + "/set_A"
         # print(self.root_shadow_imgs)
         self.root_shadow_free_imgs = root + "/" + mode + "/set_C"
 
-        self.shadow_files = sorted(os.listdir(self.root_shadow_imgs))
+        if cache_path:
+            self.cache = ISTD_Cache(cache_path)
+            self.shadow_files = self.cache.shadow_files
+            self.shadow_free_files = self.cache.shadow_free_files
+        else:
+            self.cache = None
+            self.shadow_files = sorted(os.listdir(self.root_shadow_imgs))
+            self.shadow_free_files = sorted(os.listdir(self.root_shadow_free_imgs))
+        if self.mask_transform is not None and self.masks is None:
+            self.mask_files = sorted(os.listdir(self.root_masks))
         print(len(self.shadow_files))
-        self.shadow_free_files = sorted(os.listdir(self.root_shadow_free_imgs))
-
-
 
     def __getitem__(self, index):
 
-
-        item_shadow = self.transform(
-            self.__image_loader(
-                self.root_shadow_imgs
-                + "/"
-                + self.shadow_files[index % len(self.shadow_files)]
+        # random transforms draw from torch RNG, aligned pair gets the same crop and
+        # flip by replaying its state for the shadow-free image
+        rng_state = torch.get_rng_state()
+        item_shadow = self.transform(self.__load_shadow(index % len(self.shadow_files)))
+        item = {}
+        if self.mask_transform is not None:
+            torch.set_rng_state(rng_state)
+            item["Mask"] = self.mask_transform(
+                self.__load_mask(index % len(self.shadow_files))
             )
-        )
 
         if self.unaligned:
             item_shadow_free = self.transform(
-                self.__image_loader(
-                    self.shadow_free_files[
-                        random.randint(0, len(self.shadow_free_files) - 1)
-                    ]
+                self.__load_shadow_free(
+                    random.randint(0, len(self.shadow_free_files) - 1)
                 )
             )
         else:
+            torch.set_rng_state(rng_state)
             item_shadow_free = self.transform(
-
-                self.__image_loader(
-                    self.root_shadow_free_imgs
-                    + "/"
-                    + self.shadow_free_files[index % len(self.shadow_free_files)]
-
-                )
-
+                self.__load_shadow_free(index % len(self.shadow_free_files))
             )
 
-        return {"Shadow": item_shadow, "Shadow-free": item_shadow_free}
+        return {"Shadow": item_shadow, "Shadow-free": item_shadow_free, **item}
 
     def __len__(self):
-                
-        return max(len(self.shadow_files), len(self.shadow_free_files))
-
-    def __image_loader(self,image_path: str,
-    image_scale:float=1)-> Image.Image:
-        """
-        loading image by pillow and convert it to RGB
-        """
-        # https://github.com/python-pillow/Pillow/issues/835
 
-        image = Image.open(image_path)
-
-        width, height = image.size
-        # newsize = (int(width*image_scale),int(height*image_scale))
-        # image.resize(newsize)
-
-        return image.convert("RGB")
+        return max(len(self.shadow_files), len(self.shadow_free_files))
 
+    def __load_mask(self, index: int) -> torch.Tensor:
+        if self.masks is not None:
+            return self.masks.mask(index)
+        return load_mask(self.root_masks + "/" + self.mask_files[index])
+
+    def __load_shadow(self, index: int):
+        if self.cache is not None:
+            return self.cache.image("shadow", index)
+        return load_image(
+            self.root_shadow_imgs + "/" + self.shadow_files[index],
+            self.image_backend,
+            self.decode_size,
+        )
 
-    
\ No newline at end of file
+    def __load_shadow_free(self, index: int):
+        if self.cache is not None:
+            return self.cache.image("shadow_free", index)
+        return load_image(
+            self.root_shadow_free_imgs + "/" + self.shadow_free_files[index],
+            self.image_backend,
+            self.decode_size,
+        )
@@ -0,0 +1,88 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+
+from utils.image_io import load_image
+from utils.utils import mask_generator
+
+INDEX_FILE = "index.json"
+DATA_FILE = "masks.bin"
+
+
+def build_masks(root: str, masks_path: str, mode: str = "train") -> None:
+    """
+    Computes shadow masks of all set_A/set_C image pairs of the dataset split once,
+    by the same Otsu thresholding as mask_generator applied to the real shadow-free
+    image, and writes them bit-packed (8 pixels per byte) into one file with a json
+    index next to it.
+    """
+    directories = [os.path.join(root, mode, folder) for folder in ("set_A", "set_C")]
+    to_tensor = transforms.Compose(
+        [transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
+    )
+
+    os.makedirs(masks_path, exist_ok=True)
+    index = {"mode": mode, "masks": []}
+    offset = 0
+    names = sorted(os.listdir(directories[0]))
+    with open(os.path.join(masks_path, DATA_FILE), "wb") as data:
+        for number, names_pair in enumerate(
+            zip(names, sorted(os.listdir(directories[1])))
+        ):
+            shadow, shadow_free = (
+                to_tensor(load_image(os.path.join(directory, name))).unsqueeze(0)
+                for directory, name in zip(directories, names_pair)
+            )
+            mask = mask_generator(shadow, shadow_free)[0, 0] > 0
+            packed = np.packbits(mask.numpy())
+            data.write(packed.tobytes())
+            index["masks"].append(
+                {"name": names_pair[0], "offset": offset, "shape": list(mask.shape)}
+            )
+            offset += packed.size
+            print(f"Computed masks {(number + 1):04d} of {len(names):04d}")
+
+    # index is written last so an interrupted build is never mistaken for valid masks
+    with open(os.path.join(masks_path, INDEX_FILE), "w") as index_file:
+        json.dump(index, index_file)
+
+
+class ISTD_Masks:
+    """
+    Read access to masks written by build_masks, indexed like sorted set_A images.
+    The file is memory-mapped lazily, so DataLoader workers share its pages.
+    """
+
+    def __init__(self, masks_path: str) -> None:
+        self.masks_path = masks_path
+        with open(os.path.join(masks_path, INDEX_FILE)) as index_file:
+            self.index = json.load(index_file)["masks"]
+        self.data = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def mask(self, index: int) -> torch.Tensor:
+        """
+        returns mask as uint8 [1, H, W] tensor, 255 for shadow and 0 elsewhere
+        like set_B masks
+        """
+        if self.data is None:
+            self.data = np.memmap(
+                os.path.join(self.masks_path, DATA_FILE), dtype=np.uint8, mode="r"
+            )
+        entry = self.index[index]
+        height, width = entry["shape"]
+        packed = self.data[
+            entry["offset"] : entry["offset"] + (height * width + 7) // 8
+        ]
+        mask = np.unpackbits(packed, count=height * width).reshape(1, height, width)
+        return torch.from_numpy(mask * np.uint8(255))
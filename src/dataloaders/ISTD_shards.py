@@ -0,0 +1,254 @@
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from typing import BinaryIO, List
+
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import IterableDataset, get_worker_info
+
+from utils import distributed
+from utils.image_io import decode_image, decode_mask
+
+INDEX_FILE = "shards.json"
+# ISTD folders of triplet images and names of their tar members
+KINDS = {"set_A": "shadow", "set_C": "shadow_free", "set_B": "mask"}
+
+
+class LocalObjectStore:
+    """
+    Local stand-in of a remote object store keeping every object as a file under
+    root directory. Objects are only written whole and read as sequential streams,
+    the access patterns available with remote object stores.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def put(self, name: str, stream: BinaryIO) -> None:
+        """
+        stores object read from stream, readers never see a partially written object
+        """
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as file:
+            shutil.copyfileobj(stream, file)
+        os.replace(path + ".part", path)
+
+    def open(self, name: str) -> BinaryIO:
+        return open(os.path.join(self.root, name), "rb")
+
+    def list(self, prefix: str = "") -> List[str]:
+        """
+        returns sorted names of objects starting with prefix
+        """
+        names = []
+        for directory, _, files in os.walk(self.root):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), self.root)
+                if name.startswith(prefix) and not name.endswith(".part"):
+                    names.append(name.replace(os.sep, "/"))
+        return sorted(names)
+
+
+def write_shards(
+    root: str, store: LocalObjectStore, mode: str = "train", samples_per_shard=256
+) -> None:
+    """
+    Packs aligned set_A/set_C (and set_B masks when present) images of the dataset
+    split into tar shards of samples_per_shard triplets, stored as
+    {mode}-000000.tar, ... objects. Encoded files are stored unchanged as
+    {name}.shadow.png, {name}.shadow_free.png and {name}.mask.png members, one sample
+    after another, so a shard is read with one sequential stream.
+    An index with sample counts of shards is stored last.
+    """
+    directories = {
+        kind: os.path.join(root, mode, folder)
+        for folder, kind in KINDS.items()
+        if os.path.isdir(os.path.join(root, mode, folder))
+    }
+    files = {kind: sorted(os.listdir(path)) for kind, path in directories.items()}
+    samples = list(zip(*files.values()))
+
+    index = {"mode": mode, "shards": []}
+    for start in range(0, len(samples), samples_per_shard):
+        name = f"{mode}-{len(index['shards']):06d}.tar"
+        with tempfile.TemporaryFile() as buffer:
+            with tarfile.open(fileobj=buffer, mode="w") as tar:
+                for sample in samples[start : start + samples_per_shard]:
+                    key = os.path.splitext(sample[0])[0]
+                    for kind, file_name in zip(files, sample):
+                        extension = os.path.splitext(file_name)[1]
+                        tar.add(
+                            os.path.join(directories[kind], file_name),
+                            arcname=f"{key}.{kind}{extension}",
+                        )
+            buffer.seek(0)
+            store.put(name, buffer)
+        shard_samples = len(samples[start : start + samples_per_shard])
+        index["shards"].append({"name": name, "samples": shard_samples})
+        print(f"Written shard {name} with {shard_samples} samples")
+
+    store.put(INDEX_FILE, io.BytesIO(json.dumps(index).encode()))
+
+
+class ISTD_Shards(IterableDataset):
+    """
+    Streams image pairs of tar shards written by write_shards, yielding samples
+    like ISTD_Dataset in aligned mode. Order of shards is shuffled every epoch
+    with the same seed in all processes, which makes one stream of samples.
+    In distributed training every process takes an equal contiguous range of the
+    stream (up to world_size - 1 samples are skipped in that epoch), so all
+    processes run the same number of iterations although shards differ in size.
+    The range is split among DataLoader workers in whole batches of batch_size,
+    only the last worker may end with a partial batch, so the DataLoader yields
+    as many batches as its len(). Every worker reads its shards sequentially,
+    samples before its range in the first shard are read but not decoded.
+    Epochs are counted by iterations of the dataset, persistent workers keep
+    counting on their own, set_epoch sets the counter before resuming.
+    """
+
+    def __init__(
+        self,
+        store: LocalObjectStore,
+        transforms_list: list = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        image_backend: str = "pil",
+        decode_size: int = None,
+        mask_transforms_list: list = None,
+        batch_size: int = 1,
+    ) -> None:
+        self.store = store
+        self.transform = transforms.Compose(transforms_list)
+        # with mask transforms samples hold "Mask" like ISTD_Dataset, shards need masks
+        self.mask_transform = (
+            transforms.Compose(mask_transforms_list)
+            if mask_transforms_list is not None
+            else None
+        )
+        self.shuffle = shuffle
+        self.seed = seed
+        self.image_backend = image_backend
+        self.decode_size = decode_size
+        self.batch_size = batch_size
+        with store.open(INDEX_FILE) as index_file:
+            self.shards = json.load(index_file)["shards"]
+        # process group isn't available in worker processes
+        self.rank = distributed.rank()
+        self.world_size = distributed.world_size()
+        self.epoch = 0
+        if self.mask_transform is not None and self.shards:
+            # write_shards packs masks only when the split had set_B folder
+            samples = self.__read_shard(self.shards[0]["name"])
+            kinds = next(samples).keys()
+            samples.close()
+            if "mask" not in kinds:
+                raise ValueError(
+                    "Shards hold no set_B masks, "
+                    "write them again from a dataset with set_B folder"
+                )
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        """
+        number of samples of this process in every epoch
+        """
+        return sum(shard["samples"] for shard in self.shards) // self.world_size
+
+    def __iter__(self):
+        shards = self.__epoch_shards()
+        self.epoch += 1
+
+        start, samples = self.rank * len(self), len(self)
+        worker = get_worker_info()
+        if worker is not None:
+            start, samples = self.__worker_range(
+                start, samples, worker.id, worker.num_workers
+            )
+        yield from self.__read_range(shards, start, start + samples)
+
+    def __epoch_shards(self) -> list:
+        if not self.shuffle:
+            return self.shards
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.shards), generator=generator).tolist()
+        return [self.shards[number] for number in order]
+
+    def __worker_range(
+        self, start: int, samples: int, worker_id: int, num_workers: int
+    ) -> tuple:
+        """
+        returns (start, samples) of the worker part of the process range
+        """
+        batches, remainder = divmod(samples, self.batch_size)
+        counts = [
+            (batches // num_workers + (worker < batches % num_workers))
+            * self.batch_size
+            for worker in range(num_workers)
+        ]
+        # the last worker has the fewest whole batches
+        counts[-1] += remainder
+        return start + sum(counts[:worker_id]), counts[worker_id]
+
+    def __read_range(self, shards: list, start: int, end: int):
+        """
+        yields samples number start to end - 1 of the stream of shards
+        """
+        shard_end = 0
+        for shard in shards:
+            shard_start, shard_end = shard_end, shard_end + shard["samples"]
+            if shard_start >= end:
+                break
+            if shard_end <= start:
+                continue
+            for number, sample in enumerate(
+                self.__read_shard(shard["name"]), shard_start
+            ):
+                if number >= end:
+                    break
+                if number >= start:
+                    yield self.__sample(sample)
+
+    def __read_shard(self, name: str):
+        """
+        yields encoded members of samples of the shard as {kind: bytes} dicts
+        """
+        # members of one sample are adjacent in the stream
+        sample, sample_key = {}, None
+        with self.store.open(name) as stream, tarfile.open(
+            fileobj=stream, mode="r|"
+        ) as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, kind, _ = member.name.rsplit(".", 2)
+                if sample and key != sample_key:
+                    yield sample
+                    sample = {}
+                sample_key = key
+                sample[kind] = tar.extractfile(member).read()
+        if sample:
+            yield sample
+
+    def __sample(self, sample: dict) -> dict:
+        def transform(kind: str):
+            return self.transform(
+                decode_image(sample[kind], self.image_backend, self.decode_size)
+            )
+
+        # both images of the pair get the same random crop and flip
+        rng_state = torch.get_rng_state()
+        item = {"Shadow": transform("shadow")}
+        if self.mask_transform is not None:
+            torch.set_rng_state(rng_state)
+            item["Mask"] = self.mask_transform(decode_mask(sample["mask"]))
+        torch.set_rng_state(rng_state)
+        item["Shadow-free"] = transform("shadow_free")
+
+        return item
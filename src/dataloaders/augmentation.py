@@ -0,0 +1,87 @@
+import torch
+import torch.nn.functional as F
+
+from dataloaders.ISTD_cache import _resized_shape
+
+
+class PairedAugmentation:
+    """
+    Random crop and horizontal flip of collated uint8 [B, C, H, W] batches of shadow
+    and shadow-free images on the device they are placed on, a replacement of
+    Resize, RandomCrop, RandomHorizontalFlip, ToTensor and Normalize transforms of
+    training images. Both images of a pair always get the same crop and flip.
+    Parameters are sampled for every pair, or once for the whole batch with
+    per_sample=False. With resize set batches are first resized like
+    transforms.Resize(resize) with bicubic interpolation.
+    Optional uint8 [B, 1, H, W] batch of shadow masks (255 for shadow) is resized
+    with nearest interpolation to size of the images, when it differs, and like
+    them, then it's cropped and flipped like its shadow images.
+    """
+
+    def __init__(self, size: int, resize=None, per_sample: bool = True) -> None:
+        self.size = size
+        self.resize = resize
+        self.per_sample = per_sample
+
+    def __call__(
+        self, shadow: torch.Tensor, shadow_free: torch.Tensor, masks=None
+    ) -> tuple:
+        """
+        returns (shadow, shadow_free, masks) augmented float batches normalized
+        to [-1, 1], masks are None when not given
+        """
+        if masks is not None and masks.shape[2:] != shadow.shape[2:]:
+            # masks are loaded at full resolution, images may be decoded reduced
+            masks = F.interpolate(masks, size=shadow.shape[2:], mode="nearest")
+        if self.resize is not None:
+            shadow, shadow_free = self.__resize(shadow), self.__resize(shadow_free)
+            if masks is not None:
+                masks = self.__resize(masks, mode="nearest")
+
+        batch_size, _, height, width = shadow.shape
+        assert height >= self.size and width >= self.size, "Crop larger than image"
+        # parameters are sampled on CPU, so sampling them doesn't synchronize GPU
+        samples = batch_size if self.per_sample else 1
+        tops = torch.randint(height - self.size + 1, (samples,)).tolist()
+        lefts = torch.randint(width - self.size + 1, (samples,)).tolist()
+        flips = (torch.rand(samples) < 0.5).tolist()
+
+        augmented = []
+        for images in (shadow, shadow_free, masks):
+            if images is None:
+                augmented.append(None)
+                continue
+            if self.per_sample:
+                # crops are views of the batch, stack copies them in one kernel
+                crops = torch.stack(
+                    [
+                        self.__crop(image, top, left, flip)
+                        for image, top, left, flip in zip(images, tops, lefts, flips)
+                    ]
+                )
+            else:
+                crops = self.__crop(images, tops[0], lefts[0], flips[0])
+            augmented.append(crops.float().div_(127.5).sub_(1.0))
+        return tuple(augmented)
+
+    def __resize(self, images: torch.Tensor, mode: str = "bicubic") -> torch.Tensor:
+        height, width = _resized_shape(*images.shape[2:], self.resize)
+        if mode == "nearest":
+            return F.interpolate(images, size=(height, width), mode=mode)
+        resized = F.interpolate(
+            images.float(),
+            size=(height, width),
+            mode=mode,
+            align_corners=False,
+            antialias=True,
+        )
+        return resized.round_().clamp_(0, 255).to(torch.uint8)
+
+    def __crop(
+        self, images: torch.Tensor, top: int, left: int, flip: bool
+    ) -> torch.Tensor:
+        """
+        crop of [..., H, W] images, horizontally flipped if flip is set
+        """
+        crop = images[..., top : top + self.size, left : left + self.size]
+        return crop.flip(-1) if flip else crop
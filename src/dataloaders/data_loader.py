@@ -0,0 +1,63 @@
+import torch
+
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
+
+from utils import distributed
+
+
+def channels_last_collate(samples: list) -> dict:
+    """
+    collates samples like the default collate and converts image batches
+    to channels last layout already in the worker processes
+    """
+    batch = default_collate(samples)
+    return {
+        key: (
+            value.contiguous(memory_format=torch.channels_last)
+            if isinstance(value, torch.Tensor) and value.dim() == 4
+            else value
+        )
+        for key, value in batch.items()
+    }
+
+
+def create_dataloader(dataset: Dataset, opt, train: bool = True) -> DataLoader:
+    """
+    Creates DataLoader with worker processes sized from opt.threads, prefetching
+    and pinned host memory, so data loading overlaps with model computations.
+    Training loader shuffles and drops the last partial batch unless
+    opt.keep_last_batch is set.
+    With opt.channels_last batches are collated in channels last layout.
+    In distributed training every process loads its own shard of the dataset
+    with opt.batch_size samples per batch, sampler.set_epoch has to be called
+    every epoch to reshuffle the shards. Iterable datasets are loaded in their
+    own order.
+    """
+    num_workers = max(0, opt.threads)
+    loader_kwargs = {}
+    if num_workers > 0:
+        # both options are only accepted with multiprocessing loading
+        loader_kwargs["persistent_workers"] = True
+        loader_kwargs["prefetch_factor"] = opt.prefetch_factor
+    if opt.channels_last:
+        loader_kwargs["collate_fn"] = channels_last_collate
+
+    drop_last = train and not opt.keep_last_batch
+    sampler = None
+    # iterable datasets shuffle and split their streams themselves
+    iterable = isinstance(dataset, IterableDataset)
+    if distributed.is_distributed() and not iterable:
+        sampler = DistributedSampler(dataset, shuffle=train, drop_last=drop_last)
+
+    return DataLoader(
+        dataset,
+        batch_size=opt.batch_size,
+        shuffle=train and sampler is None and not iterable,
+        sampler=sampler,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
+        drop_last=drop_last,
+        **loader_kwargs,
+    )
@@ -0,0 +1,44 @@
+import os
+
+import torch
+import torchvision.transforms as transforms
+
+from utils.image_io import file_image_size, load_image
+
+
+class Inference_Dataset(torch.utils.data.Dataset):
+    """
+    Images of one folder prepared for inference. Every item holds the transformed
+    image together with its file name and original (width, height) size.
+    decode_size is the size images are resized to, the draft backend decodes
+    them at reduced resolution not below it.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        transforms_list: list = None,
+        im_sufix: str = ".png",
+        image_backend: str = "pil",
+        decode_size: int = None,
+    ) -> None:
+        self.root = root
+        self.image_backend = image_backend
+        self.decode_size = decode_size
+        self.transform = transforms.Compose(transforms_list)
+        self.files = sorted(f for f in os.listdir(root) if f.endswith(im_sufix))
+
+    def __getitem__(self, index: int) -> dict:
+        file_name = self.files[index]
+        path = os.path.join(self.root, file_name)
+        image = load_image(path, self.image_backend, self.decode_size)
+
+        # images decoded at reduced resolution are still saved at the original size
+        return {
+            "image": self.transform(image),
+            "name": file_name,
+            "size": file_image_size(path),
+        }
+
+    def __len__(self) -> int:
+        return len(self.files)
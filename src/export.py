@@ -0,0 +1,144 @@
+import os
+import sys
+import warnings
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+from inference import OnnxRuntimeModel
+from models import Generator_F2S, Generator_S2F
+
+GENERATORS = {"s2f": Generator_S2F, "f2s": Generator_F2S}
+# load_artifact tells formats apart by the extension
+EXTENSIONS = {"torchscript": ".pt", "onnx": ".onnx"}
+
+
+def example_inputs(
+    generator: str, channels: int, size: int
+) -> Tuple[torch.Tensor, ...]:
+    """
+    returns random inputs of the generator, shadower takes additional mask
+    """
+    image = torch.rand(1, channels, size, size) * 2 - 1
+    if generator == "f2s":
+        return image, (torch.rand(1, 1, size, size) * 2 - 1).sign()
+    return (image,)
+
+
+def export_generator(
+    model: nn.Module, inputs: Tuple[torch.Tensor, ...]
+) -> torch.jit.ScriptModule:
+    """
+    Traces model in eval mode and freezes it, weights and attributes become
+    constants of the graph, so the artifact can be run without models.py.
+    Generators have no data dependent control flow and the traced graph works
+    for any input size divisible by 4.
+    """
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs)
+    return torch.jit.freeze(traced)
+
+
+def export_onnx(
+    model: nn.Module,
+    inputs: Tuple[torch.Tensor, ...],
+    path: str,
+    opset_version: int = 13,
+) -> None:
+    """
+    Exports model to ONNX with dynamic batch and spatial axes of all inputs
+    and the output. Inputs are named image (and mask for the shadower).
+    """
+    input_names = ["image", "mask"][: len(inputs)]
+    dynamic_axes = {
+        name: {0: "batch", 2: "height", 3: "width"} for name in input_names + ["output"]
+    }
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            inputs,
+            path,
+            input_names=input_names,
+            output_names=["output"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+
+def load_artifact(
+    path: str,
+    device: torch.device,
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+):
+    """
+    Loads exported generator. .onnx models run with ONNX Runtime on CPU using given
+    threads, TorchScript models on CPU are additionally optimized for inference
+    (conv + relu fusion and conversion to mkldnn where possible).
+    """
+    if path.endswith(".onnx"):
+        return OnnxRuntimeModel(path, intra_op_threads, inter_op_threads)
+
+    model = torch.jit.load(path, map_location=device)
+    if device.type == "cpu":
+        model = torch.jit.optimize_for_inference(model)
+    return model
+
+
+def maybe_compile(model: nn.Module) -> nn.Module:
+    """
+    returns model compiled with torch.compile when installed torch supports it
+    """
+    if not hasattr(torch, "compile"):
+        warnings.warn("torch.compile isn't available, running eager model")
+        return model
+    return torch.compile(model)
+
+
+def artifact_path(opt) -> str:
+    """
+    returns path of the exported artifact, by default the checkpoint path with
+    extension of the export format, exits when the extension doesn't match it
+    """
+    extension = EXTENSIONS[opt.export_format]
+    if not opt.export_path:
+        return os.path.splitext(opt.checkpoint_path)[0] + extension
+    if (os.path.splitext(opt.export_path)[1] == ".onnx") != (extension == ".onnx"):
+        sys.exit(f"Extension of {opt.export_path} doesn't match {opt.export_format}")
+    return opt.export_path
+
+
+def export(opt):
+    """
+    exporting trained generator as a self-contained TorchScript or ONNX artifact
+    """
+    device = torch.device("cpu")
+    export_path = artifact_path(opt)
+
+    generator = GENERATORS[opt.export_generator](opt.in_channels, opt.out_channels)
+    generator.load_state_dict(torch.load(opt.checkpoint_path, map_location=device))
+    generator.eval()
+
+    directory = os.path.dirname(export_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    inputs = example_inputs(opt.export_generator, opt.in_channels, opt.size)
+    if opt.export_format == "onnx":
+        export_onnx(generator, inputs, export_path)
+    else:
+        torch.jit.save(export_generator(generator, inputs), export_path)
+    print(f"Exported model saved to {export_path}")
+
+    # exported model has to reproduce eager model results
+    try:
+        exported = load_artifact(export_path, device)
+    except ImportError as error:
+        print(f"Parity check skipped: {error}")
+        return
+    with torch.inference_mode():
+        difference = (exported(*inputs) - generator(*inputs)).abs().max()
+    print(f"Max absolute difference from eager model: {difference:.2e}")
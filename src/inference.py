@@ -0,0 +1,231 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class InferenceEngine:
+    """
+    Streaming inference pipeline. DataLoader workers decode and preprocess images,
+    samples of the same size are grouped into batches moved to the device and
+    generated images are resized back and encoded as PNG by a pool of writer threads,
+    so the model never waits for image I/O.
+    """
+
+    def __init__(
+        self,
+        device: torch.device,
+        batch_size: int = 1,
+        num_workers: int = 0,
+        writer_threads: int = 2,
+        prefetch_factor: int = 2,
+    ) -> None:
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+
+        self.writer = ThreadPoolExecutor(max_workers=writer_threads)
+        # bounds number of images waiting for encoding held in memory
+        self.max_pending_writes = 4 * writer_threads
+        self.pending_writes = deque()
+
+    def __enter__(self) -> "InferenceEngine":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def batches(self, dataset: Dataset) -> Iterator[Tuple[torch.Tensor, list, list]]:
+        """
+        yields (images, names, sizes) batches of dataset with images on the device
+        """
+        loader_kwargs = {}
+        if self.num_workers > 0:
+            loader_kwargs["prefetch_factor"] = self.prefetch_factor
+        loader = DataLoader(
+            dataset, batch_size=None, num_workers=self.num_workers, **loader_kwargs
+        )
+
+        buckets = {}
+        for sample in loader:
+            shape = tuple(sample["image"].shape)
+            bucket = buckets.setdefault(shape, [])
+            bucket.append(sample)
+            if len(bucket) == self.batch_size:
+                yield self.__collate(buckets.pop(shape))
+
+        for bucket in buckets.values():
+            yield self.__collate(bucket)
+
+    def save(
+        self, images: torch.Tensor, paths: List[str], sizes: List[Tuple[int, int]]
+    ) -> None:
+        """
+        Schedules saving of [B, C, H, W] images in [-1, 1] range, each one resized to
+        its (width, height) size. Conversion to uint8 is done on the images device.
+        """
+        images = ((images.detach().float() + 1) * 0.5).mul(255).byte()
+        images = images.permute(0, 2, 3, 1).cpu().numpy()
+
+        for image, path, size in zip(images, paths, sizes):
+            while len(self.pending_writes) >= self.max_pending_writes:
+                self.pending_writes.popleft().result()
+            self.pending_writes.append(
+                self.writer.submit(self.__write, image, path, size)
+            )
+
+    def close(self) -> None:
+        """
+        waits for all scheduled writes
+        """
+        while self.pending_writes:
+            self.pending_writes.popleft().result()
+        self.writer.shutdown()
+
+    def __collate(self, samples: list) -> Tuple[torch.Tensor, list, list]:
+        images = torch.stack([sample["image"] for sample in samples])
+        if self.device.type == "cuda":
+            images = images.pin_memory()
+        return (
+            images.to(self.device, non_blocking=True),
+            [sample["name"] for sample in samples],
+            [tuple(sample["size"]) for sample in samples],
+        )
+
+    @staticmethod
+    def __write(image: np.ndarray, path: str, size: Tuple[int, int]) -> None:
+        image = Image.fromarray(image.squeeze(2) if image.shape[2] == 1 else image)
+        if image.size != tuple(size):
+            image = image.resize(tuple(size), Image.BILINEAR)
+        image.save(path)
+
+
+class OnnxRuntimeModel:
+    """
+    Generator exported to ONNX run by ONNX Runtime on CPU. It's called like the torch
+    model with [B, C, H, W] tensors and returns the output on the first input device.
+    """
+
+    def __init__(
+        self, path: str, intra_op_threads: int = 0, inter_op_threads: int = 0
+    ) -> None:
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required to run .onnx models")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            # inter op threads are used only by parallel execution
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = [
+            model_input.name for model_input in self.session.get_inputs()
+        ]
+
+    def __call__(self, *inputs: torch.Tensor) -> torch.Tensor:
+        feed = {
+            name: tensor.detach().float().cpu().numpy()
+            for name, tensor in zip(self.input_names, inputs)
+        }
+        (output,) = self.session.run(None, feed)
+        return torch.from_numpy(output).to(inputs[0].device)
+
+
+def tiled_forward(
+    model: nn.Module,
+    inputs: Tuple[torch.Tensor, ...],
+    tile_size: int,
+    overlap: int,
+    batch_size: int = 1,
+) -> torch.Tensor:
+    """
+    Runs model over overlapping tile_size x tile_size tiles of [B, C, H, W] inputs
+    (all of the same spatial size) and blends the tiles with feathered weights.
+    At most batch_size tiles are processed at once, so memory used by the model
+    doesn't depend on the image size.
+    """
+    assert tile_size % 4 == 0, "Tile size has to be divisible by 4"
+    assert 0 <= overlap < tile_size, "Overlap has to be smaller than tile size"
+    images_number, _, height, width = inputs[0].shape
+
+    # images smaller than a tile are padded to the tile size
+    padding = (0, max(0, tile_size - width), 0, max(0, tile_size - height))
+    if any(padding):
+        mode = "reflect" if padding[1] < width and padding[3] < height else "replicate"
+        inputs = tuple(F.pad(tensor, padding, mode=mode) for tensor in inputs)
+    padded_height, padded_width = inputs[0].shape[2:]
+
+    weight = _feather_window(tile_size, overlap, inputs[0].device)
+    positions = [
+        (top, left)
+        for top in _tile_starts(padded_height, tile_size, overlap)
+        for left in _tile_starts(padded_width, tile_size, overlap)
+    ]
+    tiles_per_step = max(1, batch_size // images_number)
+
+    output, weights = None, None
+    for step in range(0, len(positions), tiles_per_step):
+        step_positions = positions[step : step + tiles_per_step]
+        tiles = model(
+            *(
+                torch.cat(
+                    [
+                        tensor[:, :, top : top + tile_size, left : left + tile_size]
+                        for top, left in step_positions
+                    ]
+                )
+                for tensor in inputs
+            )
+        ).float()
+
+        if output is None:
+            output = tiles.new_zeros(
+                (images_number, tiles.size(1), padded_height, padded_width)
+            )
+            weights = tiles.new_zeros((1, 1, padded_height, padded_width))
+        for (top, left), tile in zip(step_positions, tiles.split(images_number)):
+            output[:, :, top : top + tile_size, left : left + tile_size] += (
+                tile * weight
+            )
+            weights[:, :, top : top + tile_size, left : left + tile_size] += weight
+
+    return (output / weights)[:, :, :height, :width]
+
+
+def _tile_starts(length: int, tile_size: int, overlap: int) -> List[int]:
+    """
+    returns start offsets of tiles covering whole length
+    """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+
+def _feather_window(tile_size: int, overlap: int, device) -> torch.Tensor:
+    """
+    returns [tile_size, tile_size] weights rising linearly across the overlap at edges
+    """
+    positions = torch.arange(tile_size, dtype=torch.float, device=device) + 0.5
+    ramp = torch.minimum(positions, tile_size - positions)
+    ramp = (ramp / overlap).clamp(max=1.0) if overlap > 0 else torch.ones_like(ramp)
+    return ramp[:, None] * ramp[None, :]
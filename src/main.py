@@ -2,10 +2,14 @@ import argparse
 import sys
 
 from utils.arguments_parser import arguments_parser, print_all_user_arguments
-from train import train
+from train import cache, precompute_masks, shards, train
 from test import test
+from export import export
+from quantization import quantize
+from server import serve
 from dotenv import load_dotenv
 
+from utils.distributed import launch
 from utils.visualizer import print_memory_status
 
 # load_dotenv()
@@ -20,7 +24,19 @@ def main():
         test(args)
     elif args.type == "train":
         print_memory_status()
-        train(args)
+        launch(train, args)
+    elif args.type == "cache":
+        cache(args)
+    elif args.type == "shards":
+        shards(args)
+    elif args.type == "masks":
+        precompute_masks(args)
+    elif args.type == "export":
+        export(args)
+    elif args.type == "quantize":
+        quantize(args)
+    elif args.type == "serve":
+        serve(args)
     else:
         sys.exit("Bad type to run")
 
@@ -1,9 +1,27 @@
+import math
+import warnings
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from torch.utils.checkpoint import checkpoint
 from typing import Any
 
+CHECKPOINTING_MODES = ("none", "block", "segment")
+
+
+def fuse_kernels(model: nn.Module) -> None:
+    """
+    Compiles model in place with torch.compile, which generates fused kernels of
+    instance norms, activations and residual additions following convolutions.
+    State dict and attributes of the model stay unchanged.
+    """
+    if not hasattr(model, "compile"):
+        warnings.warn("torch.compile isn't available, kernels won't be fused")
+        return
+    model.compile()
+
 
 class ResidualBlock(nn.Module):
     def __init__(self, in_features):
@@ -25,9 +43,43 @@ class ResidualBlock(nn.Module):
         return x + self.conv_block(x)
 
 
+def forward_with_checkpointing(
+    model: nn.Sequential, x, trunk: slice, checkpointing: str, segments: int
+):
+    """
+    Runs sequential generator model, with activation checkpointing of the residual
+    trunk model[trunk] while training. In "block" mode every residual block is
+    recomputed during backward separately, in "segment" mode the trunk is split
+    into given number of segments.
+    """
+    if checkpointing == "none" or not (model.training and torch.is_grad_enabled()):
+        return model(x)
+
+    x = model[: trunk.start](x)
+    blocks = model[trunk]
+    blocks_per_segment = (
+        1 if checkpointing == "block" else math.ceil(len(blocks) / segments)
+    )
+    for start in range(0, len(blocks), blocks_per_segment):
+        x = checkpoint(
+            blocks[start : start + blocks_per_segment], x, use_reentrant=False
+        )
+    return model[trunk.stop :](x)
+
+
 class Generator_S2F(nn.Module):
-    def __init__(self, in_channels, out_channels, n_residual_blocks=9):
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        n_residual_blocks=9,
+        checkpointing="none",
+        checkpoint_segments=3,
+    ):
         super(Generator_S2F, self).__init__()
+        assert checkpointing in CHECKPOINTING_MODES, "Unknown checkpointing mode"
+        self.checkpointing = checkpointing
+        self.checkpoint_segments = checkpoint_segments
         input_nc = in_channels
         output_nc = out_channels
 
@@ -52,6 +104,7 @@ class Generator_S2F(nn.Module):
             out_features = in_features * 2
 
         # Residual blocks
+        self.trunk = slice(len(model), len(model) + n_residual_blocks)
         for _ in range(n_residual_blocks):
             model += [ResidualBlock(in_features)]
 
@@ -73,12 +126,28 @@ class Generator_S2F(nn.Module):
         self.model = nn.Sequential(*model)
 
     def forward(self, x):
-        return (self.model(x) + x).tanh()
+        output = forward_with_checkpointing(
+            self.model, x, self.trunk, self.checkpointing, self.checkpoint_segments
+        )
+        return (output + x).tanh()
 
 
 class Generator_F2S(nn.Module):
-    def __init__(self, in_channels, out_channels, n_residual_blocks=9):
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        n_residual_blocks=9,
+        enable_grad=False,
+        checkpointing="none",
+        checkpoint_segments=3,
+    ):
         super(Generator_F2S, self).__init__()
+        assert checkpointing in CHECKPOINTING_MODES, "Unknown checkpointing mode"
+        # gradients are disabled by default due to GPU memory limitations
+        self.enable_grad = enable_grad
+        self.checkpointing = checkpointing
+        self.checkpoint_segments = checkpoint_segments
         input_nc = in_channels
         output_nc = out_channels
         # Initial convolution block
@@ -102,6 +171,7 @@ class Generator_F2S(nn.Module):
             out_features = in_features * 2
 
         # Residual blocks
+        self.trunk = slice(len(model), len(model) + n_residual_blocks)
         for _ in range(n_residual_blocks):
             model += [ResidualBlock(in_features)]
 
@@ -124,8 +194,15 @@ class Generator_F2S(nn.Module):
         self.model = nn.Sequential(*model)
 
     def forward(self, x, mask):
-        with torch.no_grad():
-            output = (self.model(torch.cat((x, mask), 1)) + x).tanh()
+        with torch.set_grad_enabled(self.enable_grad and torch.is_grad_enabled()):
+            output = forward_with_checkpointing(
+                self.model,
+                torch.cat((x, mask), 1),
+                self.trunk,
+                self.checkpointing,
+                self.checkpoint_segments,
+            )
+            output = (output + x).tanh()
 
         return output
 
@@ -0,0 +1,160 @@
+import copy
+import os
+import time
+from typing import Iterable
+
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.ao.quantization import (
+    DeQuantStub,
+    QuantStub,
+    convert,
+    get_default_qconfig,
+    prepare,
+)
+
+from dataloaders.inference_dataset import Inference_Dataset
+from export import export_generator, load_artifact
+from models import Generator_S2F
+from utils.metrics import psnr, ssim
+
+
+class QuantizedConv(nn.Module):
+    """
+    Conv2d computed in int8. Input is quantized and output dequantized around
+    the convolution, so reflection pads, instance norms, residual additions
+    and tanh of generators stay in float.
+    """
+
+    def __init__(self, conv: nn.Conv2d) -> None:
+        super(QuantizedConv, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def quantization_engine() -> str:
+    """
+    selects int8 CPU kernels, x86 engine replaced fbgemm in newer torch versions
+    """
+    engines = torch.backends.quantized.supported_engines
+    engine = "x86" if "x86" in engines else "fbgemm"
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def wrap_convolutions(module: nn.Module) -> None:
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            setattr(module, name, QuantizedConv(child))
+        else:
+            wrap_convolutions(child)
+
+
+def quantize_generator(
+    model: nn.Module, calibration_inputs: Iterable[tuple]
+) -> nn.Module:
+    """
+    Returns copy of model with all Conv2d layers statically quantized to int8
+    (per channel weights, per tensor activations), ConvTranspose2d upsampling
+    layers stay in float. Activation ranges are observed while running model
+    over calibration_inputs tuples.
+    """
+    qconfig = get_default_qconfig(quantization_engine())
+    quantized = copy.deepcopy(model).eval()
+    wrap_convolutions(quantized)
+    for module in quantized.modules():
+        if isinstance(module, QuantizedConv):
+            module.qconfig = qconfig
+
+    prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            quantized(*inputs)
+    return convert(quantized, inplace=True)
+
+
+def is_quantized_artifact(path: str) -> bool:
+    """
+    tells whether TorchScript artifact runs int8 kernels, which exist only on CPU
+    """
+    if path.endswith(".onnx"):
+        return False
+    model = torch.jit.load(path, map_location="cpu")
+    return any(node.kind().startswith("quantized::") for node in model.graph.nodes())
+
+
+def quantize(opt):
+    """
+    Quantizing trained deshadower calibrated on test images. Quantized model is
+    saved as TorchScript artifact (loaded in test mode with --artifact_path, CPU only)
+    and compared with float model in terms of speed and PSNR/SSIM of its outputs.
+    """
+    dataset_shadow_path = "./data/ISTD_Dataset/test/set_A"
+    device = torch.device("cpu")
+
+    deshadower = Generator_S2F(opt.in_channels, opt.out_channels)
+    deshadower.load_state_dict(torch.load(opt.checkpoint_path, map_location=device))
+    deshadower.eval()
+
+    dataset = Inference_Dataset(
+        dataset_shadow_path,
+        [
+            transforms.Resize((opt.size, opt.size), Image.BICUBIC),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ],
+    )
+    # calibration and evaluation use disjoint random samples of test images
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(0))
+    calibration_indices = order[: opt.calibration_images].tolist()
+    evaluation_indices = order[opt.calibration_images :][: opt.evaluation_images]
+
+    def images(indices):
+        for index in indices:
+            yield (dataset[index]["image"].unsqueeze(0),)
+
+    print(f"Calibrating on {len(calibration_indices)} images")
+    quantized = quantize_generator(deshadower, images(calibration_indices))
+
+    directory = os.path.dirname(opt.quantized_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    example = next(images(calibration_indices))
+    torch.jit.save(export_generator(quantized, example), opt.quantized_path)
+    print(f"Quantized model saved to {opt.quantized_path}")
+
+    quantized = load_artifact(opt.quantized_path, device)
+    float_time, quantized_time, psnrs, ssims = 0.0, 0.0, [], []
+    with torch.inference_mode():
+        # warm up of both models
+        deshadower(*example), quantized(*example)
+        for (image,) in images(evaluation_indices.tolist()):
+            start = time.perf_counter()
+            float_output = deshadower(image)
+            float_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            quantized_output = quantized(image)
+            quantized_time += time.perf_counter() - start
+
+            psnrs.append(psnr(quantized_output, float_output))
+            ssims.append(ssim(quantized_output, float_output))
+
+    if not psnrs:
+        return
+    print(
+        f"[Evaluated images: {len(psnrs)}], "
+        f"[float: {1000 * float_time / len(psnrs):.1f} ms/image], "
+        f"[int8: {1000 * quantized_time / len(psnrs):.1f} ms/image], "
+        f"[speedup: {float_time / quantized_time:.2f}x]"
+    )
+    print(
+        f"[int8 vs float PSNR: {torch.cat(psnrs).mean():.2f} dB], "
+        f"[SSIM: {torch.cat(ssims).mean():.4f}]"
+    )
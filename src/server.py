@@ -0,0 +1,461 @@
+import asyncio
+import io
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from PIL import Image
+
+from export import load_artifact, maybe_compile
+from models import Generator_S2F
+from quantization import is_quantized_artifact
+from utils.image_io import decode_image, file_image_size, to_tensor
+
+STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+# response formats of generated images
+FORMATS = ("png", "tensor")
+
+
+class ServerMetrics:
+    """
+    Counters of served requests and batches with latencies of the last window
+    requests, reported as percentiles by snapshot().
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.latencies = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.batch_times = deque(maxlen=window)
+
+    def observe_request(self, latency: float) -> None:
+        self.requests += 1
+        self.latencies.append(latency)
+
+    def observe_batch(self, size: int, queue_wait: float, batch_time: float) -> None:
+        self.batches += 1
+        self.batched_images += size
+        self.queue_waits.append(queue_wait)
+        self.batch_times.append(batch_time)
+
+    def snapshot(self, queue_depth: int, in_flight: int) -> dict:
+        """
+        returns metrics as json serializable dict, times in milliseconds
+        """
+
+        def percentiles(values: deque) -> dict:
+            if not values:
+                return {}
+            milliseconds = 1000 * np.asarray(values)
+            return {
+                "mean": float(milliseconds.mean()),
+                "p50": float(np.percentile(milliseconds, 50)),
+                "p90": float(np.percentile(milliseconds, 90)),
+                "p99": float(np.percentile(milliseconds, 99)),
+                "max": float(milliseconds.max()),
+            }
+
+        return {
+            "uptime_s": time.perf_counter() - self.started,
+            "queue_depth": queue_depth,
+            "in_flight": in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_images / max(1, self.batches),
+            "latency_ms": percentiles(self.latencies),
+            "queue_wait_ms": percentiles(self.queue_waits),
+            "batch_ms": percentiles(self.batch_times),
+        }
+
+
+class MicroBatcher:
+    """
+    Collects images of concurrent requests into micro-batches. A batch is run as
+    soon as it holds max_batch_size images or its oldest image waited max_delay
+    seconds, images arriving while a batch runs are taken by the next one.
+    Batches run one at a time on a single thread, so the event loop keeps accepting
+    requests meanwhile. Images have to share one shape.
+    """
+
+    def __init__(
+        self,
+        forward: Callable[[torch.Tensor], torch.Tensor],
+        max_batch_size: int = 8,
+        max_delay: float = 0.005,
+        metrics: ServerMetrics = None,
+    ) -> None:
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # (image, future, arrival time) of images waiting for a batch
+        self.pending = deque()
+        self.arrived = None
+        self.task = None
+
+    def start(self) -> None:
+        self.arrived = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    async def submit(self, image: torch.Tensor) -> Tuple[torch.Tensor, int]:
+        """
+        returns (output, batch size) of [C, H, W] image run in a micro-batch
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((image, future, loop.time()))
+        self.arrived.set()
+        return await future
+
+    async def __run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.pending:
+                self.arrived.clear()
+                await self.arrived.wait()
+
+            deadline = self.pending[0][2] + self.max_delay
+            while len(self.pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [
+                self.pending.popleft()
+                for _ in range(min(len(self.pending), self.max_batch_size))
+            ]
+            # futures of cancelled submit calls are done already, images of
+            # dropped connections aren't detected and still take batch slots
+            batch = [request for request in batch if not request[1].done()]
+            if not batch:
+                continue
+
+            start = loop.time()
+            images = torch.stack([image for image, _, _ in batch])
+            try:
+                outputs = await loop.run_in_executor(
+                    self.executor, self.__forward, images
+                )
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.metrics.observe_batch(
+                len(batch), start - batch[0][2], loop.time() - start
+            )
+            for (_, future, _), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result((output, len(batch)))
+
+    def __forward(self, images: torch.Tensor) -> torch.Tensor:
+        # inference mode is thread local, so it's entered by the model thread
+        with torch.inference_mode():
+            return self.forward(images).float().cpu()
+
+
+class DeshadowServer:
+    """
+    Asyncio HTTP/1.1 server of the deshadowing generator with keep-alive
+    connections. POST /deshadow takes an encoded image as the request body,
+    resized to size x size like in test mode, and answers with the generated
+    image resized back to the original size, as PNG or with ?format=tensor as
+    raw little-endian float32 [C, H, W] tensor in [-1, 1] (shape in X-Tensor-Shape
+    header). GET /metrics returns ServerMetrics as json. Decoding and encoding of
+    images runs on codec_threads threads next to the model thread.
+    """
+
+    def __init__(
+        self,
+        model: Callable[[torch.Tensor], torch.Tensor],
+        size: int,
+        device: torch.device = torch.device("cpu"),
+        max_batch_size: int = 8,
+        max_delay: float = 0.005,
+        image_backend: str = "pil",
+        codec_threads: int = 2,
+        max_body_size: int = 32 * 1024 * 1024,
+        memory_format: torch.memory_format = torch.contiguous_format,
+    ) -> None:
+        self.size = size
+        self.device = device
+        self.image_backend = image_backend
+        self.max_body_size = max_body_size
+        self.transform = transforms.Compose(
+            [
+                transforms.Resize((size, size), Image.BICUBIC),
+                to_tensor(image_backend),
+                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+            ]
+        )
+
+        def forward(images: torch.Tensor) -> torch.Tensor:
+            images = images.to(device).contiguous(memory_format=memory_format)
+            return model(images)
+
+        self.metrics = ServerMetrics()
+        self.batcher = MicroBatcher(forward, max_batch_size, max_delay, self.metrics)
+        self.codec = ThreadPoolExecutor(max_workers=codec_threads)
+        self.in_flight = 0
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080) -> int:
+        """
+        starts accepting connections, returns the bound port (useful with port 0)
+        """
+        self.batcher.start()
+        self.server = await asyncio.start_server(self.__handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        await self.batcher.close()
+        self.codec.shutdown()
+
+    async def deshadow(self, data: bytes, output_format: str = "png") -> tuple:
+        """
+        returns (body, headers) of the response with generated image
+        """
+        loop = asyncio.get_running_loop()
+        image, size = await loop.run_in_executor(self.codec, self.__decode, data)
+        output, batch_size = await self.batcher.submit(image)
+        body, headers = await loop.run_in_executor(
+            self.codec, self.__encode, output, size, output_format
+        )
+        headers["X-Batch-Size"] = str(batch_size)
+        return body, headers
+
+    async def __handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                try:
+                    head = await read_head(reader)
+                    if head is None:
+                        break
+                    start_line, headers = head
+                    method, target, _ = start_line.split(" ", 2)
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"Invalid content length {length}")
+                except ValueError as error:
+                    # malformed request line or headers
+                    await write_response(writer, 400, str(error).encode(), close=True)
+                    break
+                if length > self.max_body_size:
+                    await write_response(writer, 413, b"", close=True)
+                    break
+                body = await reader.readexactly(length)
+                status, response, response_headers = await self.__route(
+                    method, target, body
+                )
+                close = headers.get("connection", "").lower() == "close"
+                await write_response(writer, status, response, response_headers, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def __route(self, method: str, target: str, body: bytes) -> tuple:
+        url = urlsplit(target)
+        if url.path == "/metrics":
+            if method != "GET":
+                return 405, b"", {}
+            snapshot = self.metrics.snapshot(self.batcher.queue_depth, self.in_flight)
+            return (
+                200,
+                json.dumps(snapshot).encode(),
+                {"Content-Type": "application/json"},
+            )
+        if url.path != "/deshadow":
+            return 404, b"", {}
+        if method != "POST":
+            return 405, b"", {}
+        output_format = parse_qs(url.query).get("format", ["png"])[0]
+        if output_format not in FORMATS:
+            return 400, f"Unknown format {output_format}".encode(), {}
+
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            response, headers = await self.deshadow(body, output_format)
+        except ValueError as error:
+            self.metrics.errors += 1
+            return 400, str(error).encode(), {}
+        except Exception as error:
+            self.metrics.errors += 1
+            return 500, str(error).encode(), {}
+        finally:
+            self.in_flight -= 1
+        self.metrics.observe_request(time.perf_counter() - start)
+        return 200, response, headers
+
+    def __decode(self, data: bytes) -> Tuple[torch.Tensor, Tuple[int, int]]:
+        try:
+            image = decode_image(data, self.image_backend, self.size)
+        except (OSError, RuntimeError) as error:
+            raise ValueError(f"Can't decode image: {error}") from error
+        # draft backend decodes reduced images, the original size is in the header
+        return self.transform(image), file_image_size(io.BytesIO(data))
+
+    @staticmethod
+    def __encode(
+        output: torch.Tensor, size: Tuple[int, int], output_format: str
+    ) -> tuple:
+        width, height = size
+        if output_format == "tensor":
+            if output.shape[1:] != (height, width):
+                output = F.interpolate(
+                    output[None],
+                    size=(height, width),
+                    mode="bilinear",
+                    align_corners=False,
+                )[0]
+            return (
+                output.contiguous().numpy().astype("<f4").tobytes(),
+                {
+                    "Content-Type": "application/octet-stream",
+                    "X-Tensor-Shape": ",".join(str(side) for side in output.shape),
+                    "X-Tensor-Dtype": "float32",
+                },
+            )
+
+        # outputs of exported or quantized models can slightly exceed [-1, 1]
+        image = ((output + 1) * 0.5).mul(255).clamp_(0, 255).byte()
+        image = image.permute(1, 2, 0).numpy()
+        image = Image.fromarray(image.squeeze(2) if image.shape[2] == 1 else image)
+        if image.size != (width, height):
+            image = image.resize((width, height), Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue(), {"Content-Type": "image/png"}
+
+
+async def read_head(reader: asyncio.StreamReader) -> Optional[Tuple[str, dict]]:
+    """
+    returns (start line, headers with lowercase names) of HTTP message,
+    None when the connection was closed before the message started
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    start_line = line.decode("latin-1").rstrip("\r\n")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+        if not line:
+            break
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+    return start_line, headers
+
+
+async def write_response(
+    writer: asyncio.StreamWriter,
+    status: int,
+    body: bytes,
+    headers: dict = None,
+    close: bool = False,
+) -> None:
+    lines = [f"HTTP/1.1 {status} {STATUS_REASONS[status]}"]
+    headers = {**(headers or {}), "Content-Length": str(len(body))}
+    if close:
+        headers["Connection"] = "close"
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+def serve(opt):
+    """
+    serving deshadower over HTTP until interrupted
+    """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if opt.artifact_path and is_quantized_artifact(opt.artifact_path):
+        print("Quantized deshadower has int8 kernels only on CPU, serving on CPU")
+        device = torch.device("cpu")
+    memory_format = (
+        torch.channels_last if opt.channels_last else torch.contiguous_format
+    )
+
+    if opt.artifact_path:
+        model = load_artifact(
+            opt.artifact_path,
+            device,
+            opt.ort_intra_op_threads,
+            opt.ort_inter_op_threads,
+        )
+    else:
+        model = Generator_S2F(opt.in_channels, opt.out_channels)
+        model.to(device, memory_format=memory_format)
+        model.load_state_dict(torch.load(opt.checkpoint_path, map_location=device))
+        model.eval()
+        if opt.compile:
+            model = maybe_compile(model)
+
+    server = DeshadowServer(
+        model,
+        opt.size,
+        device,
+        opt.max_batch_size,
+        opt.max_batch_delay_ms / 1000,
+        opt.image_backend,
+        opt.codec_threads,
+        memory_format=memory_format,
+    )
+
+    async def run() -> None:
+        port = await server.start(opt.host, opt.port)
+        print(f"Serving deshadower on http://{opt.host}:{port}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        print("Server stopped")
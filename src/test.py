@@ -1,15 +1,17 @@
 import os
-from unittest import result
 
 import torchvision.transforms as transforms
-from torchvision.utils import save_image
-from torch.utils.data import DataLoader
-from torch.autograd import Variable
 import torch
+import torch.nn.functional as F
 from PIL import Image
-import numpy as np
 
+from dataloaders.inference_dataset import Inference_Dataset
+from dataloaders.ISTD_masks import ISTD_Masks
+from export import load_artifact, maybe_compile
+from inference import InferenceEngine, tiled_forward
 from models import Generator_F2S, Generator_S2F
+from quantization import is_quantized_artifact
+from utils.image_io import load_mask, to_tensor
 from utils.utils import mask_generator, QueueMask
 
 
@@ -24,121 +26,139 @@ def test(opt):
     generator_deshadower = "./data/results/generator_shadow_to_free_200.pth"
     generator_shadower = "./data/results/generator_free_to_shadow_200.pth"
 
-    # raise "OK"
-    if torch.cuda.is_available():
-        opt.cuda = True
-        device = torch.device("cuda:0")
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if opt.artifact_path and is_quantized_artifact(opt.artifact_path):
+        print("Quantized deshadower has int8 kernels only on CPU, testing on CPU")
+        device = torch.device("cpu")
+    memory_format = (
+        torch.channels_last if opt.channels_last else torch.contiguous_format
+    )
 
     print(opt)
-    # print("hi\n\n\n")
 
     ###### Definition of variables ######
-    # Networks
-    # Deshadower = Generator_S2F(opt.in_channels, opt.out_channels)
-    Deshadower = Generator_S2F(opt.in_channels, opt.out_channels)
-    Shadower = Generator_F2S(opt.out_channels, opt.in_channels)
-
-    if opt.cuda:
-        Deshadower.to(device)
-        Shadower.to(device)
-
-    # Load state dicts
-    Deshadower.load_state_dict(torch.load(generator_deshadower))
-    Shadower.load_state_dict(torch.load(generator_shadower))
-
-    # Set model's test mode
-    Deshadower.eval()
-    Shadower.eval()
+    # Networks, exported generators don't need the model definition
+    def load(path: str):
+        return load_artifact(
+            path, device, opt.ort_intra_op_threads, opt.ort_inter_op_threads
+        )
 
-    # Inputs & targets memory allocation
-    Tensor = torch.cuda.FloatTensor if opt.cuda else torch.Tensor
-    input_A = Tensor(opt.batch_size, opt.in_channels, opt.size, opt.size)
-    input_B = Tensor(opt.batch_size, opt.out_channels, opt.size, opt.size)
+    if opt.shadower_artifact_path:
+        Shadower = load(opt.shadower_artifact_path)
+    else:
+        Shadower = Generator_F2S(opt.out_channels, opt.in_channels)
+        Shadower.to(device, memory_format=memory_format)
+        Shadower.load_state_dict(torch.load(generator_shadower, map_location=device))
+        Shadower.eval()
+        if opt.compile:
+            Shadower = maybe_compile(Shadower)
+
+    if opt.artifact_path:
+        Deshadower = load(opt.artifact_path)
+    else:
+        Deshadower = Generator_S2F(opt.in_channels, opt.out_channels)
+        Deshadower.to(device, memory_format=memory_format)
+        Deshadower.load_state_dict(
+            torch.load(generator_deshadower, map_location=device)
+        )
+        Deshadower.eval()
+        if opt.compile:
+            Deshadower = maybe_compile(Deshadower)
 
     # Dataset loader
-    img_transform = transforms.Compose(
-        [
-            transforms.Resize((int(opt.size), int(opt.size)), Image.BICUBIC),
-            transforms.ToTensor(),
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-        ]
+    transformation_list = [
+        transforms.Resize((int(opt.size), int(opt.size)), Image.BICUBIC),
+        to_tensor(opt.image_backend),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    ]
+    decode_size = opt.size
+    if opt.tile_size:
+        # tiled inference works on full resolution images
+        transformation_list = transformation_list[1:]
+        decode_size = None
+    shadow_dataset = Inference_Dataset(
+        dataset_shadow_path,
+        transformation_list,
+        im_sufix,
+        opt.image_backend,
+        decode_size,
+    )
+    shadow_free_dataset = Inference_Dataset(
+        dataset_shadow_free_path,
+        transformation_list,
+        im_sufix,
+        opt.image_backend,
+        decode_size,
     )
-
-    to_pil = transforms.ToPILImage()
 
     ###### Testing######
 
     # Create output dirs
-    if not os.path.exists(f"{result_path}/A"):
-        os.makedirs(f"./{result_path}/A")
-    if not os.path.exists(f"{result_path}/B"):
-        os.makedirs(f"{result_path}/B")
-    if not os.path.exists(f"{result_path}/mask"):
-        os.makedirs(f"{result_path}/mask")
-
-    # Deshadower
-    images_list = [
-        os.path.splitext(f)[0]
-        for f in os.listdir(dataset_shadow_path)
-        if f.endswith(im_sufix)
-    ]
-
-    mask_queue = QueueMask(len(images_list))
-
-    for index, img_name in enumerate(images_list):
-
-        img = Image.open(
-            os.path.join(dataset_shadow_path, img_name + im_sufix)
-        ).convert("RGB")
-        width, height = img.size
-
-        image_variable = (img_transform(img).unsqueeze(0)).to(device)
-
-        temp_B = Deshadower(image_variable)
-
-        fake_B = 0.5 * (temp_B.data + 1.0)
-        mask_queue.insert(mask_generator(image_variable, temp_B))
-        fake_B = np.array(
-            transforms.Resize((height, width))(to_pil(fake_B.data.squeeze(0).cpu()))
+    os.makedirs(f"{result_path}/A", exist_ok=True)
+    os.makedirs(f"{result_path}/B", exist_ok=True)
+    os.makedirs(f"{result_path}/mask", exist_ok=True)
+
+    mask_queue = QueueMask(len(shadow_dataset))
+    if opt.mask_source != "generated":
+        # shadower samples ground truth or precomputed masks of test shadow images
+        for mask in test_masks(opt, dataset_shadow_path):
+            mask = F.interpolate(mask[None].float(), size=(opt.size, opt.size))
+            mask_queue.insert((mask / 127.5 - 1).to(device))
+
+    def forward(model: torch.nn.Module, *inputs: torch.Tensor) -> torch.Tensor:
+        inputs = tuple(
+            tensor.contiguous(memory_format=memory_format) for tensor in inputs
         )
-
-        Image.fromarray(fake_B).save(result_path + f"/B/{img_name + im_sufix}")
-
-        print(f"Generated images {(index + 1):03d} of {len(images_list):03d}")
-
-    # Shadower
-    images_list = [
-        os.path.splitext(f)[0]
-        for f in os.listdir(dataset_shadow_free_path)
-        if f.endswith(im_sufix)
-    ]
-
-    for index, img_name in enumerate(images_list):
-
-        img = Image.open(
-            os.path.join(dataset_shadow_free_path, img_name + im_sufix)
-        ).convert("RGB")
-        width, height = img.size
-
-        mask = mask_queue.rand_item()
-        mask_cpu = np.array(
-            transforms.Resize((height, width))(
-                to_pil(((mask.data + 1) * 0.5).squeeze(0).cpu())
+        if opt.tile_size:
+            return tiled_forward(
+                model, inputs, opt.tile_size, opt.tile_overlap, opt.batch_size
             )
-        )
-
-        temp_A = Shadower(image_variable, mask)
-
-        fake_A = 0.5 * (temp_A.data + 1.0)
-
-        fake_A = np.array(
-            transforms.Resize((height, width))(to_pil(fake_A.data.squeeze(0).cpu()))
-        )
-
-        # Save image files
-
-        Image.fromarray(fake_A).save(result_path + f"/A/{img_name + im_sufix}")
-
-        Image.fromarray(mask_cpu).save(result_path + f"/mask/{img_name + im_sufix}")
-
-        print(f"Generated images {(index + 1):03d} of {len(images_list):03d}")
+        return model(*inputs)
+
+    with InferenceEngine(
+        device, opt.batch_size, opt.threads, opt.writer_threads, opt.prefetch_factor
+    ) as engine, torch.inference_mode():
+
+        # Deshadower
+        generated = 0
+        for images, names, sizes in engine.batches(shadow_dataset):
+            fake_B = forward(Deshadower, images)
+            if opt.mask_source == "generated":
+                masks = mask_generator(images, fake_B)
+                # queued masks share one size, they are resized back when sampled
+                mask_queue.insert(F.interpolate(masks, size=(opt.size, opt.size)))
+
+            engine.save(fake_B, [f"{result_path}/B/{name}" for name in names], sizes)
+
+            generated += len(names)
+            print(f"Generated images {generated:03d} of {len(shadow_dataset):03d}")
+
+        # Shadower
+        generated = 0
+        for images, names, sizes in engine.batches(shadow_free_dataset):
+            masks = F.interpolate(
+                mask_queue.rand_item(images.size(0)), size=images.shape[2:]
+            )
+            fake_A = forward(Shadower, images, masks)
+
+            # Save image files
+            engine.save(fake_A, [f"{result_path}/A/{name}" for name in names], sizes)
+            engine.save(masks, [f"{result_path}/mask/{name}" for name in names], sizes)
+
+            generated += len(names)
+            print(f"Generated images {generated:03d} of {len(shadow_free_dataset):03d}")
+
+
+def test_masks(opt, dataset_shadow_path: str):
+    """
+    yields uint8 [1, H, W] masks of test shadow images, set_B ground truth masks
+    or masks precomputed into opt.masks_path
+    """
+    if opt.mask_source == "precomputed":
+        precomputed = ISTD_Masks(os.path.join(opt.masks_path, "test"))
+        for index in range(len(precomputed)):
+            yield precomputed.mask(index)
+    else:
+        masks_path = os.path.join(os.path.dirname(dataset_shadow_path), "set_B")
+        for file_name in sorted(os.listdir(masks_path)):
+            yield load_mask(os.path.join(masks_path, file_name))
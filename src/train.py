@@ -5,13 +5,19 @@ import torch
 import torchvision.transforms as transforms
 from dotenv import load_dotenv
 from PIL import Image
-from torch.autograd import Variable
-from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 
+from dataloaders.augmentation import PairedAugmentation
+from dataloaders.data_loader import create_dataloader
+from dataloaders.ISTD_cache import build_cache
 from dataloaders.ISTD_dataset import ISTD_Dataset
+from dataloaders.ISTD_masks import build_masks
+from dataloaders.ISTD_shards import ISTD_Shards, LocalObjectStore, write_shards
 from trainer import Trainer
-from utils.utils import Buffer, QueueMask
-from utils.visualizer import Visualizer
+from utils.batch_buffers import BatchBuffers
+from utils import distributed
+from utils.image_io import to_tensor, to_uint8_tensor
+from utils.utils import Buffer, QueueMask, computed_sum
 
 torch.cuda.empty_cache()
 
@@ -21,68 +27,146 @@ load_dotenv()
 ISTD_PATH = os.environ.get("ISTD_DATASET_ROOT_PATH")
 
 
-def train(opt):
+def cache(opt):
     """
-    training model
+    building decoded & resized image cache of training set
     """
+    if not opt.cache_path:
+        sys.exit("Set --cache_path to build the cache")
+    build_cache(ISTD_PATH, opt.cache_path, mode="train", size=int(opt.size * 1.12))
 
-    trainer = Trainer(opt)
-    visualizer = Visualizer(opt)
 
-    (
-        lr_scheduler_gen,
-        lr_scheduler_disc_s,
-        lr_scheduler_disc_d,
-    ) = trainer.learning_rate_schedulers_init(opt, current_epoch=0)
+def shards(opt):
+    """
+    packing training set into tar shards streamed in training with --shards_path
+    """
+    if not opt.shards_path:
+        sys.exit("Set --shards_path to write the shards")
+    write_shards(
+        ISTD_PATH,
+        LocalObjectStore(opt.shards_path),
+        mode="train",
+        samples_per_shard=opt.samples_per_shard,
+    )
 
-    if opt.resume:
 
-        trainer.resume_training_state(
-            "./saved_training_state",
-            [
-                trainer.generator_free_to_shadow,
-                trainer.generator_shadow_to_free,
-                trainer.discriminator_free_to_shadow,
-                trainer.discriminator_shadow_to_free,
-            ],
-            [
-                trainer.optimizer_gen,
-                trainer.optimizer_disc_deshadower,
-                trainer.optimizer_disc_shadower,
-            ],
-            [lr_scheduler_gen, lr_scheduler_disc_s, lr_scheduler_disc_d],
-        )
-        epoch_start = 3
-    else:
-        epoch_start = 0
+def precompute_masks(opt):
+    """
+    precomputing shadow masks of training and test sets used with
+    --mask_source precomputed
+    """
+    if not opt.masks_path:
+        sys.exit("Set --masks_path to write the masks")
+    for mode in ("train", "test"):
+        if os.path.isdir(os.path.join(ISTD_PATH, mode)):
+            build_masks(ISTD_PATH, os.path.join(opt.masks_path, mode), mode)
+
 
-    transformation_list = [
-        # transforms.Resize((opt.size, opt.size), Image.BICUBIC),
-        transforms.Resize(int(400 * 1.12), Image.BICUBIC),
-        transforms.RandomCrop(400),
+def mask_transforms(opt) -> list:
+    """
+    returns transforms of uint8 mask tensors matching training image transforms,
+    None when masks are generated during training
+    """
+    if opt.mask_source == "generated":
+        return None
+    if opt.batched_augmentation != "none":
+        # masks of cached images are resized in workers, so batches are smaller,
+        # others are resized to their images by PairedAugmentation
+        if opt.cache_path:
+            return [
+                transforms.Resize(
+                    int(opt.size * 1.12), transforms.InterpolationMode.NEAREST
+                )
+            ]
+        return []
+    return [
+        transforms.Resize(int(opt.size * 1.12), transforms.InterpolationMode.NEAREST),
+        transforms.RandomCrop(opt.size),
         transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize((0.5,), (0.5,)),
     ]
 
-    dataloader = DataLoader(
+
+def train(opt):
+    """
+    training model
+    """
+
+    trainer = Trainer(opt)
+
+    trainer.learning_rate_schedulers_init(opt, current_epoch=0)
+
+    augmentation = None
+    if opt.batched_augmentation != "none":
+        # workers only decode images, batches are augmented on the training device
+        augmentation = PairedAugmentation(
+            opt.size,
+            resize=None if opt.cache_path else int(opt.size * 1.12),
+            per_sample=opt.batched_augmentation == "sample",
+        )
+        transformation_list = (
+            [] if opt.cache_path else [to_uint8_tensor(opt.image_backend)]
+        )
+    elif opt.cache_path:
+        # cached images are already decoded and resized, crops are taken from uint8 tensors
+        transformation_list = [
+            transforms.RandomCrop(opt.size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ConvertImageDtype(torch.float),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ]
+    else:
+        transformation_list = [
+            # transforms.Resize((opt.size, opt.size), Image.BICUBIC),
+            transforms.Resize(int(opt.size * 1.12), Image.BICUBIC),
+            transforms.RandomCrop(opt.size),
+            transforms.RandomHorizontalFlip(),
+            to_tensor(opt.image_backend),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ]
+
+    if opt.shards_path:
+        if opt.mask_source == "precomputed":
+            sys.exit("Shards hold set_B masks, use --mask_source dataset")
+        # sequential reads of tar shards instead of random access to image files
+        dataset = ISTD_Shards(
+            LocalObjectStore(opt.shards_path),
+            transforms_list=transformation_list,
+            image_backend=opt.image_backend,
+            decode_size=int(opt.size * 1.12),
+            mask_transforms_list=mask_transforms(opt),
+            batch_size=opt.batch_size,
+        )
+    else:
         # ISTD_Dataset(root=istd, transforms_list=transformation_list)
-        ISTD_Dataset(root=ISTD_PATH, transforms_list=transformation_list)
-    )
+        dataset = ISTD_Dataset(
+            root=ISTD_PATH,
+            transforms_list=transformation_list,
+            cache_path=opt.cache_path,
+            image_backend=opt.image_backend,
+            decode_size=int(opt.size * 1.12),
+            mask_transforms_list=mask_transforms(opt),
+            masks_path=(
+                os.path.join(opt.masks_path, "train")
+                if opt.mask_source == "precomputed"
+                else None
+            ),
+        )
+    dataloader = create_dataloader(dataset, opt)
 
-    # memory allocation
-    (
-        input_shadow,
-        input_mask,
-        target_real,
-        target_fake,
-        mask_non_shadow,
-    ) = Trainer.allocate_memory(opt)
-
-    mask_queue = QueueMask(len(dataloader) // 4)
+    # inputs and targets preallocated for every batch shape
+    batch_buffers = BatchBuffers(opt.out_channels, trainer.device, opt.channels_last)
+
+    mask_queue = QueueMask(max(1, len(dataloader) // 4))
     # print("len: ", len(dataloader) // 4)
     fake_shadow_buff = Buffer()
     fake_mask_buff = Buffer()
+    pools = {
+        "mask_queue": mask_queue,
+        "fake_shadow_buff": fake_shadow_buff,
+        "fake_mask_buff": fake_mask_buff,
+    }
 
     (
         gan_loss_criterion,
@@ -91,7 +175,12 @@ def train(opt):
     ) = Trainer.critirion_init()
 
     # iteration counter
-    current_it = 0
+    if opt.resume:
+        epoch_start, current_it = trainer.resume_training_state(
+            opt.training_state_path, pools
+        )
+    else:
+        epoch_start, current_it = 0, 0
     plt.ioff()
     to_pil = transforms.ToPILImage()
 
@@ -105,14 +194,50 @@ def train(opt):
     disc_s2f_losses = []
     disc_f2s_losses = []
 
+    # logs, images and snapshots are saved only by the main process
+    main_process = distributed.is_main_process()
+
     # TRAINING
-    print("Starting training loop...")
-    for epoch in range(epoch_num := opt.epochs):
+    if main_process:
+        print("Starting training loop...")
+        if not opt.f2s_grad:
+            print(
+                "Shadower is frozen, its identity and cycle losses aren't computed "
+                "and are left out of logged generator losses"
+            )
+    for epoch in range(epoch_start, opt.epochs):
+        if isinstance(dataloader.sampler, DistributedSampler):
+            dataloader.sampler.set_epoch(epoch)
+        if isinstance(dataset, ISTD_Shards):
+            dataset.set_epoch(epoch)
         for i, data in enumerate(dataloader):
+            trainer.profiler.begin_step()
+            # optimizers step after every opt.accumulation_steps micro-batches
+            # and after the last one of the epoch
+            optimizers_step = trainer.begin_micro_batch(
+                remaining_batches=len(dataloader) - i
+            )
 
             # set model input
-            real_shadow = Variable(input_shadow.copy_(data["Shadow"]))
-            real_mask = Variable(input_mask.copy_(data["Shadow-free"]))
+            # non blocking copies from pinned memory overlap with computations
+            with trainer.profiler.phase("host_to_device"):
+                shadow, shadow_free = data["Shadow"], data["Shadow-free"]
+                masks = data.get("Mask")
+                if augmentation is not None:
+                    shadow, shadow_free, masks = augmentation(
+                        shadow.to(trainer.device, non_blocking=True),
+                        shadow_free.to(trainer.device, non_blocking=True),
+                        None if masks is None else masks.to(trainer.device),
+                    )
+                (
+                    real_shadow,
+                    real_mask,
+                    target_real,
+                    target_fake,
+                    mask_non_shadow,
+                ) = batch_buffers.load(shadow, shadow_free)
+                if masks is not None:
+                    masks = batch_buffers.load_mask(masks)
 
             (
                 gen_loss,
@@ -135,6 +260,7 @@ def train(opt):
                 gan_loss_criterion,
                 cycle_loss_criterion,
                 identity_loss_criterion,
+                masks,
             )
             total_loss_disc_s2f = 0
             (
@@ -173,11 +299,10 @@ def train(opt):
             # del loss_disc_f2s
 
             current_it += 1
-            print(f"current_it: \t {current_it}")
-            if (i + 1) % opt.iteration_loss == 0:
+            if main_process and (i + 1) % opt.iteration_loss == 0:
                 print(
-                    f"[Iteration: {current_it:d}], [gen_loss: {gen_loss:.5f}], [loss_identity_gen: {(identity_loss_shadow + identity_loss_mask):.5f}], [loss_gen_s2f_and_f2s: {(loss_gen_free_to_shadow+loss_gen_shadow_to_free):.5f}],"
-                    f"[Cycle_loss: {(loss_cycle_shadow + loss_cycle_mask):.5f}], [loss_disc: {(total_loss_disc_f2s + total_loss_disc_s2f):.5f}]"
+                    f"[Iteration: {current_it:d}], [gen_loss: {gen_loss:.5f}], [loss_identity_gen: {computed_sum(identity_loss_shadow, identity_loss_mask):.5f}], [loss_gen_s2f_and_f2s: {(loss_gen_free_to_shadow+loss_gen_shadow_to_free):.5f}],"
+                    f"[Cycle_loss: {computed_sum(loss_cycle_shadow, loss_cycle_mask):.5f}], [loss_disc: {(total_loss_disc_f2s + total_loss_disc_s2f):.5f}]"
                 )
 
                 gen_losses.append(gen_losses_temp / opt.iteration_loss)
@@ -195,18 +320,18 @@ def train(opt):
                 )
 
                 img_fake_shadow = 0.5 * (fake_shadow.detach().data + 1.0)
-                img_fake_shadow = to_pil(img_fake_shadow.data.squeeze(0).cpu())
+                img_fake_shadow = to_pil(img_fake_shadow.data[0].cpu())
                 img_fake_shadow.save("output/fake_A.png")
 
                 img_fake_mask = 0.5 * (fake_mask.detach().data + 1.0)
-                img_fake_mask = to_pil(img_fake_mask.data.squeeze(0).cpu())
+                img_fake_mask = to_pil(img_fake_mask.data[0].cpu())
                 img_fake_mask.save("output/fake_B.png")
 
             # update learning rates
 
-            lr_scheduler_gen.step()
-            lr_scheduler_disc_s.step()
-            lr_scheduler_disc_d.step()
+            if optimizers_step:
+                trainer.update_lr_per_batch()
+            trainer.profiler.end_step(real_shadow.size(0))
 
             # torch.save(
             #     trainer.generator_shadow_to_free.state_dict(),
@@ -247,31 +372,32 @@ def train(opt):
             #     lr_scheduler_disc_d.state_dict(), "./data/results1/lr_scheduler_disc_d.pth"
             # )
 
-            if (epoch + 1) % opt.snapshot_epochs == 0:
-                torch.save(
-                    trainer.generator_shadow_to_free.state_dict(),
-                    ("./data/results1/generator_shadow_to_free_%d.pth" % (epoch + 1)),
-                )
-                torch.save(
-                    trainer.generator_free_to_shadow.state_dict(),
-                    ("./data/results1/generator_free_to_shadow_%d.pth" % (epoch + 1)),
-                )
-                torch.save(
-                    trainer.discriminator_shadow_to_free.state_dict(),
-                    (
-                        "./data/results1/discriminator_shadow_to_free_%d.pth"
-                        % (epoch + 1)
-                    ),
-                )
-                torch.save(
-                    trainer.discriminator_free_to_shadow.state_dict(),
-                    (
-                        "./data/results1/discriminator_free_to_shadow_%d.pth"
-                        % (epoch + 1)
-                    ),
-                )
+        # epoch boundary
+        trainer.save_training_state(
+            opt.training_state_path, epoch + 1, current_it, pools
+        )
 
-    print(f"Epoch: {epoch+1} finished")
+        if main_process and (epoch + 1) % opt.snapshot_epochs == 0:
+            torch.save(
+                trainer.generator_shadow_to_free.state_dict(),
+                ("./data/results1/generator_shadow_to_free_%d.pth" % (epoch + 1)),
+            )
+            torch.save(
+                trainer.generator_free_to_shadow.state_dict(),
+                ("./data/results1/generator_free_to_shadow_%d.pth" % (epoch + 1)),
+            )
+            torch.save(
+                trainer.discriminator_shadow_to_free.state_dict(),
+                ("./data/results1/discriminator_shadow_to_free_%d.pth" % (epoch + 1)),
+            )
+            torch.save(
+                trainer.discriminator_free_to_shadow.state_dict(),
+                ("./data/results1/discriminator_free_to_shadow_%d.pth" % (epoch + 1)),
+            )
 
+        if main_process:
+            print(f"Epoch: {epoch+1} finished")
 
-print("Finished training loop.")
+    trainer.checkpoint_writer.wait()
+    if main_process:
+        print("Finished training loop.")
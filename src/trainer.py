@@ -1,14 +1,20 @@
+import contextlib
+import inspect
 import itertools
-from typing import List
+import random
+import warnings
 import models
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
-from utils.utils import mask_generator, weights_init
+from torch.nn.parallel import DistributedDataParallel
+from utils import distributed
+from utils.utils import computed_sum, mask_generator, weights_init
 from utils.utils import LR_lambda
 from utils.utils import QueueMask
 from utils.utils import Buffer
-from utils.visualizer import print_memory_status
+from utils.batch_buffers import BatchBuffers
+from utils.checkpoint import CheckpointWriter, to_cpu
+from utils.profiler import StepProfiler
 
 
 class Trainer:
@@ -20,12 +26,20 @@ class Trainer:
 
     def __init__(self, opt) -> None:
         self.opt = opt
+        self.device = distributed.device()
         # networks
         self.generator_shadow_to_free = models.Generator_S2F(
-            in_channels=opt.in_channels, out_channels=opt.out_channels
+            in_channels=opt.in_channels,
+            out_channels=opt.out_channels,
+            checkpointing=opt.checkpointing,
+            checkpoint_segments=opt.checkpoint_segments,
         )
         self.generator_free_to_shadow = models.Generator_F2S(
-            in_channels=opt.in_channels, out_channels=opt.out_channels
+            in_channels=opt.in_channels,
+            out_channels=opt.out_channels,
+            enable_grad=opt.f2s_grad,
+            checkpointing=opt.checkpointing,
+            checkpoint_segments=opt.checkpoint_segments,
         )
         self.discriminator_shadow_to_free = models.Discriminator(
             in_channels=opt.in_channels
@@ -35,11 +49,17 @@ class Trainer:
         )
 
         # sending models to gpu
-        if torch.cuda.is_available():
-            self.generator_free_to_shadow.cuda()
-            self.generator_shadow_to_free.cuda()
-            self.discriminator_free_to_shadow.cuda()
-            self.discriminator_shadow_to_free.cuda()
+        self.generator_free_to_shadow.to(self.device)
+        self.generator_shadow_to_free.to(self.device)
+        self.discriminator_free_to_shadow.to(self.device)
+        self.discriminator_shadow_to_free.to(self.device)
+
+        if opt.channels_last:
+            for model in self.networks().values():
+                model.to(memory_format=torch.channels_last)
+        if opt.fuse:
+            for model in self.networks().values():
+                models.fuse_kernels(model)
 
         # applying weights init
         self.generator_free_to_shadow.apply(weights_init)
@@ -47,22 +67,81 @@ class Trainer:
         self.discriminator_free_to_shadow.apply(weights_init)
         self.discriminator_shadow_to_free.apply(weights_init)
 
+        # networks running forward passes with gradients, in distributed training
+        # they are wrapped with DDP averaging gradients across processes
+        self.parallel_networks = {
+            name: self.__data_parallel(model)
+            for name, model in self.networks().items()
+            if name != "generator_free_to_shadow" or opt.f2s_grad
+        }
+        if distributed.is_distributed() and not opt.f2s_grad:
+            # frozen shadower only has to start from the same weights
+            distributed.broadcast_module(self.generator_free_to_shadow)
+
         # optimizer init
         self.optimizer_gen = self.generator_optimizer(
             self.generator_shadow_to_free, self.generator_free_to_shadow
         )
-        self.optimizer_disc_deshadower = self.discriminator_optimizer(
-            self.discriminator_shadow_to_free
+        # joint optimizer updates both discriminators in one step, it's stored
+        # under both names and steps after the shadower discriminator backward
+        self.joint_discriminator_optimizer = opt.joint_discriminator_optimizer
+        if self.joint_discriminator_optimizer:
+            self.optimizer_disc_deshadower = self.discriminator_optimizer(
+                self.discriminator_shadow_to_free, self.discriminator_free_to_shadow
+            )
+            self.optimizer_disc_shadower = self.optimizer_disc_deshadower
+        else:
+            self.optimizer_disc_deshadower = self.discriminator_optimizer(
+                self.discriminator_shadow_to_free
+            )
+            self.optimizer_disc_shadower = self.discriminator_optimizer(
+                self.discriminator_free_to_shadow
+            )
+
+        # mixed precision, float16 on GPU needs loss scaling, bfloat16 on CPU doesn't
+        self.amp = opt.amp
+        self.amp_dtype = torch.float16 if self.device.type == "cuda" else torch.bfloat16
+        scaling = self.amp and self.amp_dtype == torch.float16
+        self.scaler_gen = _grad_scaler(scaling)
+        self.scaler_disc_deshadower = _grad_scaler(scaling)
+        self.scaler_disc_shadower = (
+            self.scaler_disc_deshadower
+            if self.joint_discriminator_optimizer
+            else _grad_scaler(scaling)
         )
-        self.optimizer_disc_shadower = self.discriminator_optimizer(
-            self.discriminator_free_to_shadow
+
+        self.lr_schedulers = {}
+        self.checkpoint_writer = CheckpointWriter()
+        # gradient accumulation state, every batch is a whole accumulation
+        # until begin_micro_batch is called
+        self.micro_batch = 0
+        self.accumulation_window = 1
+        self.accumulation_start = True
+        self.accumulation_end = True
+
+        self.profiler = StepProfiler(
+            enabled=opt.profile,
+            report_every=opt.profile_every,
+            trace_start=opt.profile_trace_start,
+            trace_steps=opt.profile_trace_steps,
+            trace_path=opt.profile_trace_path,
         )
+        if not distributed.is_main_process():
+            self.profiler.enabled = False
 
         # self.__critirion_init()
 
         # self.__optimizers_init()
         # self.__learning_rate_schedulers_init(opt)
 
+    def autocast(self) -> torch.autocast:
+        """
+        returns autocast context for forward passes, a no-op unless --amp is set
+        """
+        return torch.autocast(
+            device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp
+        )
+
     def critirion_init() -> tuple:
         """
         initializes loss creterion
@@ -96,9 +175,20 @@ class Trainer:
             self.optimizer_disc_shadower,
             lr_lambda=LR_lambda(50, 0, 25).step,
         )
-        lr_scheduler_disc_d = torch.optim.lr_scheduler.LambdaLR(
-            self.optimizer_disc_deshadower,
-            lr_lambda=LR_lambda(50, 0, 25).step,
+        if self.joint_discriminator_optimizer:
+            lr_scheduler_disc_d = lr_scheduler_disc_s
+        else:
+            lr_scheduler_disc_d = torch.optim.lr_scheduler.LambdaLR(
+                self.optimizer_disc_deshadower,
+                lr_lambda=LR_lambda(50, 0, 25).step,
+            )
+        # every scheduler is stepped and saved once
+        self.lr_schedulers = _unique(
+            {
+                "lr_scheduler_gen": lr_scheduler_gen,
+                "lr_scheduler_disc_s": lr_scheduler_disc_s,
+                "lr_scheduler_disc_d": lr_scheduler_disc_d,
+            }
         )
         return lr_scheduler_gen, lr_scheduler_disc_s, lr_scheduler_disc_d
 
@@ -114,77 +204,128 @@ class Trainer:
         gan_loss_criterion,
         cycle_loss_criterion,
         identity_loss_criterion,
+        real_shadow_mask: torch.Tensor = None,
     ):
-        self.optimizer_gen.zero_grad()
-
-        # print(
-        #     f"Sizes: \n Real_mask:\t\t{real_mask.size()}\n Mask_non_shadow:\t{mask_non_shadow.size()}\n Real_shadow:\t\t{real_shadow.size()}\n"
-        # )
-        # tutaj cos jest źle
-        same_mask = self.generator_shadow_to_free(real_mask)
-        # TODO (real_mask, mask_non_shadow) b4
-        print_memory_status("after shadow_to_free")
-        same_shadow = self.generator_free_to_shadow(real_shadow, mask_non_shadow)
-        # print("----------------------------\n", "same_mask & same_shadow")
-        # print(type(same_mask))
-        # print(type(same_mask))
-        # print(same_shadow.size())
-        # print(f"same_mask:\t\t{same_mask.size()}")
-        # print(f"same_shadow:\t\t{same_shadow.size()}")
-
-        # Identity loss
-        identity_loss_mask = identity_loss_criterion(same_mask, real_mask) * 5.0
-        identity_loss_shadow = identity_loss_criterion(same_shadow, real_shadow) * 5.0
-
-        # GAN loss
-        fake_mask = self.generator_shadow_to_free(real_shadow)
-        pred_fake = self.discriminator_free_to_shadow(fake_mask)
-
-        loss_gen_shadow_to_free = gan_loss_criterion(pred_fake, target_real)
-        mask_queue.insert(mask_generator(real_shadow, fake_mask))
-
-        # print("________________________________________")
-        # print("IM HERE")
-        # print("q len:", len(mask_queue.queue))
-        # print("real_mask: \t", real_mask.size(), "\ttype\t: ", type(real_mask))
-        # print("mask_queue: \t", mask_queue.rand_item().size())
-        # print(mask_queue.rand_item())
-        # print(type(mask_queue.rand_item()))
-
-        # print("________________________________________")
-
-        fake_shadow = self.generator_free_to_shadow(real_mask, mask_queue.rand_item())
-
-        # print("q len:", len(mask_queue.queue))
-
-        pred_fake = self.discriminator_shadow_to_free(fake_shadow)
-        loss_gen_free_to_shadow = gan_loss_criterion(pred_fake, target_real)
-
-        # Cycle loss
-        # print("q len:", len(mask_queue.queue))
-
-        recovered_shadow = self.generator_free_to_shadow(
-            fake_mask, mask_queue.last_item()
-        )
-        loss_cycle_shadow = cycle_loss_criterion(recovered_shadow, real_shadow) * 10.0
-
-        recovered_mask = self.generator_shadow_to_free(fake_shadow)
-        loss_cycle_mask = cycle_loss_criterion(recovered_mask, real_mask) * 10.0
-
-        # Total loss
-        gen_loss = (
-            identity_loss_shadow
-            + identity_loss_mask
-            + loss_gen_shadow_to_free
-            + loss_gen_free_to_shadow
-            + loss_cycle_shadow
-            + loss_cycle_mask
-        )
-        gen_loss.backward()
-
-        gen_losses_temp += gen_loss.item()
-
-        self.optimizer_gen.step()
+        """
+        Generators update on a batch. Shadow masks of real_shadow given by
+        real_shadow_mask (ground truth or precomputed, in [-1, 1]) are inserted
+        into mask_queue, otherwise they're computed from the generated
+        shadow-free images.
+        With frozen shadower (without opt.f2s_grad) its identity and cycle losses
+        aren't computed, they're returned as None and gen_loss doesn't include them.
+        """
+        if self.accumulation_start:
+            self.optimizer_gen.zero_grad(set_to_none=True)
+        batch_size = real_shadow.size(0)
+        generator_shadow_to_free = self.parallel_networks["generator_shadow_to_free"]
+        # discriminators are only evaluated here, their gradients are not needed,
+        # so they are called without DDP wrappers
+        self.__set_discriminators_requires_grad(False)
+        try:
+            with self.__no_sync("generator_shadow_to_free", "generator_free_to_shadow"):
+                with self.autocast():
+                    with self.profiler.phase("gen_s2f_forward"):
+                        # identity and translation passes of deshadower share one forward
+                        same_mask, fake_mask = generator_shadow_to_free(
+                            torch.cat((real_mask, real_shadow))
+                        ).split(batch_size)
+
+                        # Identity loss
+                        identity_loss_mask = (
+                            identity_loss_criterion(same_mask, real_mask)
+                            * self.opt.lambda_identity
+                        )
+
+                        # GAN loss
+                        pred_fake = self.discriminator_free_to_shadow(fake_mask)
+                        loss_gen_shadow_to_free = gan_loss_criterion(
+                            pred_fake, target_real
+                        )
+
+                    with self.profiler.phase("mask_generation"):
+                        if real_shadow_mask is None:
+                            real_shadow_mask = mask_generator(real_shadow, fake_mask)
+                        mask_queue.insert(real_shadow_mask)
+
+                    with self.profiler.phase("gen_f2s_forward"):
+                        if self.generator_free_to_shadow.enable_grad:
+                            # identity, translation and cycle passes of shadower share one forward
+                            (
+                                same_shadow,
+                                fake_shadow,
+                                recovered_shadow,
+                            ) = self.parallel_networks["generator_free_to_shadow"](
+                                torch.cat((real_shadow, real_mask, fake_mask)),
+                                torch.cat(
+                                    (
+                                        mask_non_shadow,
+                                        mask_queue.rand_item(batch_size),
+                                        mask_queue.last_item(),
+                                    )
+                                ),
+                            ).split(
+                                batch_size
+                            )
+
+                            identity_loss_shadow = (
+                                identity_loss_criterion(same_shadow, real_shadow)
+                                * self.opt.lambda_identity
+                            )
+                            pred_fake = self.discriminator_shadow_to_free(fake_shadow)
+                            loss_gen_free_to_shadow = gan_loss_criterion(
+                                pred_fake, target_real
+                            )
+                            loss_cycle_shadow = (
+                                cycle_loss_criterion(recovered_shadow, real_shadow)
+                                * self.opt.lambda_cycle
+                            )
+                        else:
+                            # shadower outputs carry no gradient, so its identity and cycle
+                            # passes can't affect the update and are skipped
+                            fake_shadow = self.generator_free_to_shadow(
+                                real_mask, mask_queue.rand_item(batch_size)
+                            )
+                            # they're reported as None and left out of the total loss
+                            identity_loss_shadow = None
+                            loss_cycle_shadow = None
+                            with torch.no_grad():
+                                pred_fake = self.discriminator_shadow_to_free(
+                                    fake_shadow
+                                )
+                                loss_gen_free_to_shadow = gan_loss_criterion(
+                                    pred_fake, target_real
+                                )
+
+                    with self.profiler.phase("gen_cycle_forward"):
+                        # Cycle loss
+                        recovered_mask = generator_shadow_to_free(fake_shadow)
+                        loss_cycle_mask = (
+                            cycle_loss_criterion(recovered_mask, real_mask)
+                            * self.opt.lambda_cycle
+                        )
+
+                    # Total loss
+                    gen_loss = computed_sum(
+                        identity_loss_shadow,
+                        identity_loss_mask,
+                        loss_gen_shadow_to_free,
+                        loss_gen_free_to_shadow,
+                        loss_cycle_shadow,
+                        loss_cycle_mask,
+                    )
+                with self.profiler.phase("gen_backward"):
+                    self.scaler_gen.scale(
+                        gen_loss / self.accumulation_window
+                    ).backward()
+
+            gen_losses_temp += gen_loss.item()
+
+            if self.accumulation_end:
+                with self.profiler.phase("gen_optimizer"):
+                    self.scaler_gen.step(self.optimizer_gen)
+                    self.scaler_gen.update()
+        finally:
+            self.__set_discriminators_requires_grad(True)
 
         return (
             gen_loss,
@@ -212,26 +353,36 @@ class Trainer:
         fake_shadow,
     ):
         # zero_grad()
-        self.optimizer_disc_deshadower.zero_grad()
+        if self.accumulation_start:
+            self.optimizer_disc_deshadower.zero_grad(set_to_none=True)
         # print("ELOOO DYSKRYMINATOR S2F")
-        # Real loss
-        prediction_real = self.discriminator_shadow_to_free(real_shadow)
-        loss_disc_real = gan_loss_criterion(prediction_real, target_real)
-
-        # Fake loss
-        # i get fake_shadow as an argument
-        # fake_shadow = self.generator_free_to_shadow(real_mask, mask_queue.rand_item())
-        fake_shadow = fake_shadow_buff.push_and_pop(fake_shadow)
-        prediction_fake = self.discriminator_shadow_to_free(fake_shadow.detach())
-        loss_disc_fake = gan_loss_criterion(prediction_fake, target_fake)
-
-        # Total loss
-        loss_disc = (loss_disc_real + loss_disc_fake) / 2.0
-        loss_disc.backward()
+        discriminator = self.parallel_networks["discriminator_shadow_to_free"]
+        with self.__no_sync("discriminator_shadow_to_free"):
+            with self.autocast(), self.profiler.phase("disc_s2f_forward"):
+                # Real loss
+                prediction_real = discriminator(real_shadow)
+                loss_disc_real = gan_loss_criterion(prediction_real, target_real)
+
+                # Fake loss
+                # i get fake_shadow as an argument
+                # fake_shadow = self.generator_free_to_shadow(real_mask, mask_queue.rand_item())
+                fake_shadow = fake_shadow_buff.push_and_pop(fake_shadow)
+                prediction_fake = discriminator(fake_shadow.detach())
+                loss_disc_fake = gan_loss_criterion(prediction_fake, target_fake)
+
+                # Total loss
+                loss_disc = (loss_disc_real + loss_disc_fake) / 2.0
+            with self.profiler.phase("disc_s2f_backward"):
+                self.scaler_disc_deshadower.scale(
+                    loss_disc / self.accumulation_window
+                ).backward()
 
         disc_s2f_losses_temp += loss_disc.item()
         # self.discriminator_optimizer.step()
-        self.optimizer_disc_deshadower.step()
+        if self.accumulation_end and not self.joint_discriminator_optimizer:
+            with self.profiler.phase("disc_s2f_optimizer"):
+                self.scaler_disc_deshadower.step(self.optimizer_disc_deshadower)
+                self.scaler_disc_deshadower.update()
         return loss_disc, disc_s2f_losses_temp
 
     def run_one_batch_for_discriminator_f2s(
@@ -246,27 +397,37 @@ class Trainer:
         disc_f2s_losses_temp,
         fake_mask,
     ):
-        # zero_grad()
-        self.optimizer_disc_shadower.zero_grad()
+        # zero_grad(), joint optimizer keeps gradients of the deshadower discriminator
+        if self.accumulation_start and not self.joint_discriminator_optimizer:
+            self.optimizer_disc_shadower.zero_grad(set_to_none=True)
         # print("ELOOO DYSKRYMINATOR F2S")
-        # Real loss
-        prediction_real = self.discriminator_free_to_shadow(real_mask)
-        loss_disc_real = gan_loss_criterion(prediction_real, target_real)
-
-        # Fake loss
-        # fake_mask = self.generator_shadow_to_free(real_shadow, mask_queue.rand_item())
-        fake_mask = fake_mask_buff.push_and_pop(fake_mask)
-        prediction_fake = self.discriminator_free_to_shadow(fake_mask.detach())
-        loss_disc_fake = gan_loss_criterion(prediction_fake, target_fake)
-
-        # Total loss
-        loss_disc = (loss_disc_real + loss_disc_fake) / 2.0
-        loss_disc.backward()
+        discriminator = self.parallel_networks["discriminator_free_to_shadow"]
+        with self.__no_sync("discriminator_free_to_shadow"):
+            with self.autocast(), self.profiler.phase("disc_f2s_forward"):
+                # Real loss
+                prediction_real = discriminator(real_mask)
+                loss_disc_real = gan_loss_criterion(prediction_real, target_real)
+
+                # Fake loss
+                # fake_mask = self.generator_shadow_to_free(real_shadow, mask_queue.rand_item())
+                fake_mask = fake_mask_buff.push_and_pop(fake_mask)
+                prediction_fake = discriminator(fake_mask.detach())
+                loss_disc_fake = gan_loss_criterion(prediction_fake, target_fake)
+
+                # Total loss
+                loss_disc = (loss_disc_real + loss_disc_fake) / 2.0
+            with self.profiler.phase("disc_f2s_backward"):
+                self.scaler_disc_shadower.scale(
+                    loss_disc / self.accumulation_window
+                ).backward()
 
         disc_f2s_losses_temp += loss_disc.item()
 
         # self.discriminator_optimizer.step()
-        self.optimizer_disc_shadower.step()
+        if self.accumulation_end:
+            with self.profiler.phase("disc_f2s_optimizer"):
+                self.scaler_disc_shadower.step(self.optimizer_disc_shadower)
+                self.scaler_disc_shadower.update()
         # x = loss_disc
         # total_loss = 0
         # total_loss += loss_disc.detach()
@@ -274,12 +435,68 @@ class Trainer:
         # return total_loss
         return loss_disc, disc_f2s_losses_temp
 
-    # TODO description
-    def discriminator_optimizer(
-        self,
-        model: nn.Module,
-    ):
-        return torch.optim.Adam(model.parameters(), lr=self.opt.lr, betas=(0.5, 0.999))
+    def __data_parallel(self, model: nn.Module) -> nn.Module:
+        if not distributed.is_distributed():
+            return model
+        # DDP broadcasts weights of the main process to all processes
+        return DistributedDataParallel(
+            model, device_ids=[self.device] if self.device.type == "cuda" else None
+        )
+
+    def __no_sync(self, *names: str) -> contextlib.ExitStack:
+        """
+        Context of micro-batch forward and backward passes. Until the last micro-batch
+        of accumulation DDP wrapped networks of given names only accumulate local
+        gradients, which are averaged across processes once in the last backward.
+        """
+        stack = contextlib.ExitStack()
+        if not self.accumulation_end:
+            for name in names:
+                network = self.parallel_networks.get(name)
+                if isinstance(network, DistributedDataParallel):
+                    stack.enter_context(network.no_sync())
+        return stack
+
+    def begin_micro_batch(self, remaining_batches: int = None) -> bool:
+        """
+        Starts next micro-batch of gradient accumulation. Gradients are zeroed before
+        the first micro-batch and optimizers step after opt.accumulation_steps
+        micro-batches, or earlier when only remaining_batches (including this one)
+        are left in the epoch. Losses are averaged over micro-batches of the window
+        actually accumulated. Returns whether optimizers step after this micro-batch,
+        only then learning rates should be updated.
+        """
+        self.accumulation_start = self.micro_batch == 0
+        if self.accumulation_start:
+            self.accumulation_window = self.opt.accumulation_steps
+            if remaining_batches is not None:
+                self.accumulation_window = min(
+                    self.accumulation_window, remaining_batches
+                )
+        self.micro_batch += 1
+        self.accumulation_end = self.micro_batch == self.accumulation_window
+        if self.accumulation_end:
+            self.micro_batch = 0
+        return self.accumulation_end
+
+    def __set_discriminators_requires_grad(self, requires_grad: bool) -> None:
+        for discriminator in (
+            self.discriminator_shadow_to_free,
+            self.discriminator_free_to_shadow,
+        ):
+            for parameter in discriminator.parameters():
+                parameter.requires_grad_(requires_grad)
+
+    def discriminator_optimizer(self, *models: nn.Module):
+        """
+        Adam optimizer of given discriminators, each one in its own parameter group
+        """
+        return torch.optim.Adam(
+            [{"params": model.parameters()} for model in models],
+            lr=self.opt.lr,
+            betas=(0.5, 0.999),
+            **self.__adam_implementation(),
+        )
 
     # TODO description
     def generator_optimizer(
@@ -290,23 +507,35 @@ class Trainer:
         combine_parameters = itertools.chain(
             model_deshadower.parameters(), model_shadower.parameters()
         )
-        return torch.optim.Adam(combine_parameters, lr=self.opt.lr, betas=(0.5, 0.999))
+        return torch.optim.Adam(
+            combine_parameters,
+            lr=self.opt.lr,
+            betas=(0.5, 0.999),
+            **self.__adam_implementation(),
+        )
+
+    def __adam_implementation(self) -> dict:
+        """
+        Returns Adam keyword argument selecting opt.optimizer_implementation.
+        foreach updates all parameters with multi-tensor kernels, fused in a single
+        kernel. Implementations unsupported by installed torch fall back to default.
+        """
+        implementation = self.opt.optimizer_implementation
+        if implementation == "default":
+            return {}
+        if implementation not in inspect.signature(torch.optim.Adam).parameters:
+            warnings.warn(f"{implementation} Adam isn't available, using default one")
+            return {}
+        return {implementation: True}
 
     def allocate_memory(opt):
-        Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.Tensor
-        input_shadow = Tensor(opt.batch_size, opt.out_channels, opt.size, opt.size)
-        input_mask = Tensor(opt.batch_size, opt.out_channels, opt.size, opt.size)
-        target_real = Variable(Tensor(opt.batch_size).fill_(1.0), requires_grad=False)
-        target_fake = Variable(Tensor(opt.batch_size).fill_(0.0), requires_grad=False)
-        # mask_non_shadow = Variable(
-        #     Tensor(opt.batch_size, 1, opt.size, opt.size).fill_(-1.0),
-        #     requires_grad=False,
-        # )
-        mask_non_shadow = Variable(
-            Tensor(opt.batch_size, 1, opt.size, opt.size).fill_(-1.0),
-            requires_grad=False,
-        )
-        return [input_shadow, input_mask, target_real, target_fake, mask_non_shadow]
+        """
+        returns (input_shadow, input_mask, target_real, target_fake, mask_non_shadow)
+        buffers of opt.batch_size batches of opt.size crops
+        """
+        return BatchBuffers(
+            opt.out_channels, distributed.device(), opt.channels_last
+        ).get(opt.batch_size, opt.size, opt.size)
 
     def update_lr_per_epoch(lr_scheduler_gen, lr_scheduler_disc_s, lr_scheduler_disc_d):
         """
@@ -319,143 +548,101 @@ class Trainer:
 
         return [lr_scheduler_gen, lr_scheduler_disc_s, lr_scheduler_disc_d]
 
-    def update_lr_per_batch():
-        pass
-
-    # def save_training_state(self, training_state_path, epoch_n, *networks):
-    #     """
-    #     saving state of networks after epoch training
-    #     https://pytorch.org/tutorials/beginner/saving_loading_models.html
-    #     """
-
-    #     pass
-
-    def save_training_state(
-        self,
-        training_state_path: str,
-        networks,
-        optimizers: List[torch.optim.Adam],
-        learning_rates: List[torch.optim.lr_scheduler.LambdaLR],
-    ):
+    def update_lr_per_batch(self) -> None:
         """
-        Saves the state of the training. It takes a string path as a parameter, \n
-        ------------------------------- \n
-        networks in the following order:\n
-        [
-        generator_free_to_shadow, \n
-        generator_shadow_to_free. \n
-        discriminator_free_to_shadow,\n
-        discriminator_shadow_to_free
-        ].\n
-        ------------------------------- \n
-        Optimizers in the following order: \n
-        [
-        optimizer_gen, \n
-        optimizer_disc_deshadower, \n
-        optimizer_disc_shadower
-        ]\n
-        ------------------------------- \n
-        Learning rates in the following order: \n
-        [
-        lr_scheduler_gen, \n
-        lr_scheduler_disc_s, \n
-        lr_scheduler_disc_d \n
-        ]
+        Updates learning rates of all schedulers created by learning_rate_schedulers_init.
         """
-        print("Saving training state...\n")
-        # saving networks
-        torch.save(networks[0].state_dict(), f"{training_state_path}/gen_f2s.pth")
-        torch.save(networks[1].state_dict(), f"{training_state_path}/gen_s2f.pth")
-        torch.save(networks[2].state_dict(), f"{training_state_path}/disc_f2s.pth")
-        torch.save(networks[3].state_dict(), f"{training_state_path}/disc_s2f.pth")
-
-        # saving oprimizers
-        torch.save(optimizers[0].state_disc(), f"{training_state_path}/optim_gen.pth")
-        torch.save(
-            optimizers[1].state_disc(), f"{training_state_path}/optim_disc_d.pth"
-        )
-        torch.save(
-            optimizers[2].state_disc(), f"{training_state_path}/optim_disc_s.pth"
+        for lr_scheduler in self.lr_schedulers.values():
+            lr_scheduler.step()
+
+    def networks(self) -> dict:
+        return {
+            "generator_free_to_shadow": self.generator_free_to_shadow,
+            "generator_shadow_to_free": self.generator_shadow_to_free,
+            "discriminator_free_to_shadow": self.discriminator_free_to_shadow,
+            "discriminator_shadow_to_free": self.discriminator_shadow_to_free,
+        }
+
+    def optimizers(self) -> dict:
+        return _unique(
+            {
+                "optimizer_gen": self.optimizer_gen,
+                "optimizer_disc_deshadower": self.optimizer_disc_deshadower,
+                "optimizer_disc_shadower": self.optimizer_disc_shadower,
+            }
         )
 
-        # saving lr schedulers
-        torch.save(learning_rates[0].state_dict(), f"{training_state_path}/lr_gen.pth")
-        torch.save(
-            learning_rates[1].state_dict(), f"{training_state_path}/lr_disc_s.pth"
-        )
-        torch.save(
-            learning_rates[2].state_dict(), f"{training_state_path}/lr_disc_d.pth"
+    def scalers(self) -> dict:
+        return _unique(
+            {
+                "scaler_gen": self.scaler_gen,
+                "scaler_disc_deshadower": self.scaler_disc_deshadower,
+                "scaler_disc_shadower": self.scaler_disc_shadower,
+            }
         )
 
-    def resume_training_state(
-        self,
-        training_state_path: str,
-        networks,
-        optimizers: List[torch.optim.Adam],
-        learning_rates: List[torch.optim.lr_scheduler.LambdaLR],
-    ):
+    def save_training_state(
+        self, training_state_path: str, epoch: int, iteration: int, pools: dict
+    ) -> None:
         """
-        Resumes training state. It takes training_state_path string as an argument and: \n
-        networks in the following order:\n
-        [
-        generator_free_to_shadow, \n
-        generator_shadow_to_free. \n
-        discriminator_free_to_shadow,\n
-        discriminator_shadow_to_free
-        ].\n
-        ------------------------------- \n
-        Optimizers in the following order: \n
-        [
-        optimizer_gen, \n
-        optimizer_disc_deshadower, \n
-        optimizer_disc_shadower
-        ]\n
-        ------------------------------- \n
-        Learning rates in the following order: \n
-        [
-        lr_scheduler_gen, \n
-        lr_scheduler_disc_s, \n
-        lr_scheduler_disc_d \n
-        ]
+        Saves the whole training state into one file: networks, optimizers, learning
+        rate schedulers, gradient scalers, epoch & iteration counters, RNG states and
+        contents of image pools given as a {name: QueueMask/Buffer} dict.
+        State is copied to CPU here and written atomically by a background thread.
+        In distributed training only the main process saves its state.
         """
-        print("Resuming training state\n")
-        # resumimg networks state
-        networks[0].load_state_dict(torch.load(f"{training_state_path}/gen_f2s.pth"))
-        networks[0].eval()
-        networks[1].load_state_dict(torch.load(f"{training_state_path}/gen_s2f.pth"))
-        networks[1].eval()
-        networks[2].load_state_dict(torch.load(f"{training_state_path}/disc_f2s.pth"))
-        networks[2].eval()
-        networks[3].load_state_dict(torch.load(f"{training_state_path}/disc_s2f.pth"))
-        networks[3].eval()
-
-        # resumimg optimiers state
-        optimizers[0].load_state_dict(
-            torch.load(f"{training_state_path}/optim_gen.pth")
-        )
-        optimizers[0].eval()
-        optimizers[1].load_state_dict(
-            torch.load(f"{training_state_path}/optim_disc_d.pth")
-        )
-        optimizers[1].eval()
-        optimizers[2].load_state_dict(
-            torch.load(f"{training_state_path}/optim_disc_s.pth")
-        )
-        optimizers[2].eval()
-
-        # resumimg learning rates state
-        learning_rates[0].load_state_dict(
-            torch.load(f"{training_state_path}/lr_gen.pth")
-        )
-        learning_rates[0].eval()
-        learning_rates[1].load_state_dict(
-            torch.load(f"{training_state_path}/lr_disc_d.pth")
-        )
-        learning_rates[1].eval()
-        learning_rates[2].load_state_dict(
-            torch.load(f"{training_state_path}/lr_disc_s.pth")
-        )
-        learning_rates[2].eval()
+        if not distributed.is_main_process():
+            return
+        print("Saving training state...\n")
+        state = {
+            "epoch": epoch,
+            "iteration": iteration,
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "cuda": (
+                    torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+                ),
+                "python": random.getstate(),
+            },
+        }
+        for group_name, group in (
+            ("networks", self.networks()),
+            ("optimizers", self.optimizers()),
+            ("lr_schedulers", self.lr_schedulers),
+            ("scalers", self.scalers()),
+            ("pools", pools),
+        ):
+            state[group_name] = {
+                name: element.state_dict() for name, element in group.items()
+            }
+
+        self.checkpoint_writer.save(to_cpu(state), training_state_path)
+
+    def resume_training_state(self, training_state_path: str, pools: dict) -> tuple:
+        """
+        Resumes training state saved by save_training_state. Learning rate schedulers
+        have to be initialized before. Returns (epoch, iteration) to start from.
+        """
+        if distributed.is_main_process():
+            print("Resuming training state\n")
+        state = torch.load(training_state_path, map_location=self.device)
+
+        for group_name, group in (
+            ("networks", self.networks()),
+            ("optimizers", self.optimizers()),
+            ("lr_schedulers", self.lr_schedulers),
+            ("scalers", self.scalers()),
+            ("pools", pools),
+        ):
+            for name, element in group.items():
+                element.load_state_dict(state[group_name][name])
+
+        torch.set_rng_state(state["rng"]["torch"].cpu())
+        if state["rng"]["cuda"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([rng.cpu() for rng in state["rng"]["cuda"]])
+        random.setstate(state["rng"]["python"])
+
+        return state["epoch"], state["iteration"]
 
     def load_training_state(self, training_state_path, *networks):
         """
@@ -468,3 +655,25 @@ class Trainer:
         resume state from certain epoch
         """
         pass
+
+
+def _unique(elements: dict) -> dict:
+    """
+    drops elements already present under an earlier name, e.g. the joint
+    discriminators optimizer stored under both discriminator optimizer names
+    """
+    unique = {}
+    for name, element in elements.items():
+        if all(element is not other for other in unique.values()):
+            unique[name] = element
+    return unique
+
+
+def _grad_scaler(enabled: bool):
+    """
+    returns float16 loss scaler, torch.cuda.amp.GradScaler is deprecated
+    by torch versions having device generic torch.amp.GradScaler
+    """
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
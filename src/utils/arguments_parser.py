@@ -1,22 +1,183 @@
 import argparse
 
-from os import get_terminal_size
+from shutil import get_terminal_size
 
 
-def arguments_parser():
+def positive_int(value: str) -> int:
+    """
+    argparse type of integers not smaller than 1
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+def arguments_parser(args: list = None):
     """
     Functrion parses arguments with argparse library.
+    Parses sys.argv unless list of arguments is given.
     """
     description = "Parser"
     parser = argparse.ArgumentParser(description=description)
 
-    parser.add_argument("--type", type=str, default="train", help="[test/train]")
+    parser.add_argument(
+        "--type",
+        type=str,
+        default="train",
+        help="[test/train/cache/shards/masks/export/quantize/serve]",
+    )
     parser.add_argument("--resume", action="store_true", help="resume training")
-    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="micro-batch size, optimizers step on batch_size * accumulation_steps "
+        "images of every process",
+    )
+    parser.add_argument(
+        "--accumulation_steps",
+        type=int,
+        default=1,
+        help="number of micro-batches whose gradients are accumulated before "
+        "optimizer and learning rate steps",
+    )
     parser.add_argument(
         "--size", type=int, default=400, help="size of the data crop (squared assumed)"
     )
-    parser.add_argument("--threads", type=int, default=5, help="number of threads")
+    parser.add_argument(
+        "--threads", type=int, default=5, help="number of data loading workers"
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=2,
+        help="number of batches loaded in advance by each worker",
+    )
+    parser.add_argument(
+        "--writer_threads",
+        type=int,
+        default=2,
+        help="number of threads encoding images generated in test mode",
+    )
+    parser.add_argument(
+        "--tile_size",
+        type=int,
+        default=0,
+        help="test on full resolution images split into tiles of that size (0 disables)",
+    )
+    parser.add_argument(
+        "--tile_overlap",
+        type=int,
+        default=32,
+        help="overlap of neighbouring tiles blended with feathered weights",
+    )
+    parser.add_argument(
+        "--checkpoint_path",
+        type=str,
+        default="./data/results/generator_shadow_to_free_200.pth",
+        help="generator weights exported in export mode or deshadower served in "
+        "serve mode",
+    )
+    parser.add_argument(
+        "--export_generator",
+        type=str,
+        default="s2f",
+        choices=["s2f", "f2s"],
+        help="generator exported in export mode (deshadower/shadower)",
+    )
+    parser.add_argument(
+        "--export_format",
+        type=str,
+        default="torchscript",
+        choices=["torchscript", "onnx"],
+        help="format of the exported generator",
+    )
+    parser.add_argument(
+        "--export_path",
+        type=str,
+        default="",
+        help="artifact created in export mode (.pt TorchScript or .onnx), "
+        "checkpoint path with extension of the export format by default",
+    )
+    parser.add_argument(
+        "--quantized_path",
+        type=str,
+        default="./data/results/generator_shadow_to_free_200_int8.pt",
+        help="int8 deshadower artifact created in quantize mode (CPU only), "
+        "ConvTranspose2d layers stay in float",
+    )
+    parser.add_argument(
+        "--calibration_images",
+        type=int,
+        default=32,
+        help="number of test images used for quantization calibration",
+    )
+    parser.add_argument(
+        "--evaluation_images",
+        type=int,
+        default=16,
+        help="number of test images comparing quantized and float models",
+    )
+    parser.add_argument(
+        "--artifact_path",
+        type=str,
+        default="",
+        help="test or serve exported (.pt or .onnx) or int8 deshadower, "
+        "int8 one always runs on CPU",
+    )
+    parser.add_argument(
+        "--shadower_artifact_path",
+        type=str,
+        default="",
+        help="test with exported shadower (.pt or .onnx) instead of eager model",
+    )
+    parser.add_argument(
+        "--ort_intra_op_threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime threads used within one operator (0 uses all cores)",
+    )
+    parser.add_argument(
+        "--ort_inter_op_threads",
+        type=int,
+        default=0,
+        help="ONNX Runtime threads running independent operators (0 uses default)",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="test with eager models compiled by torch.compile",
+    )
+    parser.add_argument(
+        "--host", type=str, default="127.0.0.1", help="address of the serve mode server"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8080, help="port of the serve mode server"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="maximum number of concurrent requests run in one micro-batch by server",
+    )
+    parser.add_argument(
+        "--max_batch_delay_ms",
+        type=float,
+        default=5.0,
+        help="longest time a request waits for others joining its micro-batch",
+    )
+    parser.add_argument(
+        "--codec_threads",
+        type=int,
+        default=2,
+        help="number of server threads decoding requests and encoding responses",
+    )
+    parser.add_argument(
+        "--keep_last_batch",
+        action="store_true",
+        help="train on the last partial batch of every epoch instead of dropping it",
+    )
     parser.add_argument(
         "--in_channels", type=int, default=3, help=" number of input channels"
     )
@@ -39,11 +200,175 @@ def arguments_parser():
     parser.add_argument(
         "--iteration_loss", type=int, default=500, help="avarage loss for n iterations"
     )
+    parser.add_argument(
+        "--training_state_path",
+        type=str,
+        default="./saved_training_state/training_state.pth",
+        help="file with training state saved every epoch and loaded by --resume",
+    )
     parser.add_argument(
         "--snapshot_epochs", type=int, default=50, help="number of epochs of training"
     )
+    parser.add_argument(
+        "--lambda_identity", type=float, default=5.0, help="weight of identity losses"
+    )
+    parser.add_argument(
+        "--lambda_cycle", type=float, default=10.0, help="weight of cycle losses"
+    )
+    parser.add_argument(
+        "--amp",
+        action="store_true",
+        help="mixed precision training (float16 on GPU, bfloat16 on CPU)",
+    )
+    parser.add_argument(
+        "--f2s_grad",
+        action="store_true",
+        help="compute gradients of free to shadow generator (full CycleGAN objective)",
+    )
+    parser.add_argument(
+        "--checkpointing",
+        type=str,
+        default="none",
+        choices=["none", "block", "segment"],
+        help="activation checkpointing of generators residual blocks",
+    )
+    parser.add_argument(
+        "--checkpoint_segments",
+        type=positive_int,
+        default=3,
+        help="number of checkpointed segments in segment checkpointing mode",
+    )
+    parser.add_argument(
+        "--nproc_per_node",
+        type=int,
+        default=1,
+        help="number of data parallel training processes spawned on this node",
+    )
+    parser.add_argument(
+        "--nnodes", type=int, default=1, help="number of nodes of distributed training"
+    )
+    parser.add_argument(
+        "--node_rank", type=int, default=0, help="rank of this node (0 to nnodes-1)"
+    )
+    parser.add_argument(
+        "--master_addr",
+        type=str,
+        default="127.0.0.1",
+        help="address of the node with rank 0",
+    )
+    parser.add_argument(
+        "--master_port",
+        type=int,
+        default=29500,
+        help="free port of the node with rank 0",
+    )
+    parser.add_argument(
+        "--dist_backend",
+        type=str,
+        default="",
+        help="distributed backend (gloo/nccl), nccl on GPUs and gloo on CPU by default",
+    )
+    parser.add_argument(
+        "--image_backend",
+        type=str,
+        default="pil",
+        choices=["pil", "draft", "torchvision"],
+        help="image decoding: Pillow, Pillow decoding at reduced resolution when "
+        "images are much larger than needed, or torchvision.io to uint8 tensors",
+    )
+    parser.add_argument(
+        "--batched_augmentation",
+        type=str,
+        default="none",
+        choices=["none", "sample", "batch"],
+        help="crop and flip collated uint8 batches on the training device instead "
+        "of PIL transforms in workers, with parameters sampled per image pair "
+        "or once per batch",
+    )
+    parser.add_argument(
+        "--optimizer_implementation",
+        type=str,
+        default="default",
+        choices=["default", "foreach", "fused"],
+        help="Adam implementation, foreach and fused ones update parameters in batches",
+    )
+    parser.add_argument(
+        "--joint_discriminator_optimizer",
+        action="store_true",
+        help="update both discriminators with a single optimizer step",
+    )
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="use channels last memory format of models and input batches",
+    )
+    parser.add_argument(
+        "--fuse",
+        action="store_true",
+        help="fuse norm and activation kernels of models with torch.compile",
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="measure time of training step phases"
+    )
+    parser.add_argument(
+        "--profile_every",
+        type=int,
+        default=100,
+        help="print profiler report every n iterations",
+    )
+    parser.add_argument(
+        "--profile_trace_start",
+        type=int,
+        default=-1,
+        help="iteration starting torch.profiler trace (-1 disables tracing)",
+    )
+    parser.add_argument(
+        "--profile_trace_steps",
+        type=int,
+        default=5,
+        help="number of traced iterations",
+    )
+    parser.add_argument(
+        "--profile_trace_path",
+        type=str,
+        default="./profiler_trace.json",
+        help="chrome trace file of torch.profiler",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="directory of decoded image cache (built with --type cache)",
+    )
+    parser.add_argument(
+        "--mask_source",
+        type=str,
+        default="generated",
+        choices=["generated", "dataset", "precomputed"],
+        help="shadow masks of the mask queue: computed from generated images every "
+        "iteration, ISTD set_B ground truth masks or masks precomputed once from "
+        "real image pairs (with --type masks)",
+    )
+    parser.add_argument(
+        "--masks_path",
+        type=str,
+        default=None,
+        help="directory of precomputed masks (written with --type masks)",
+    )
+    parser.add_argument(
+        "--shards_path",
+        type=str,
+        default=None,
+        help="directory of training set tar shards (written with --type shards)",
+    )
+    parser.add_argument(
+        "--samples_per_shard",
+        type=int,
+        default=256,
+        help="number of image pairs in one shard",
+    )
 
-    return parser.parse_args()
+    return parser.parse_args(args)
 
 
 def print_all_user_arguments(arguments: argparse.Namespace) -> None:
@@ -0,0 +1,71 @@
+import torch
+
+
+class BatchBuffers:
+    """
+    Preallocated model inputs and loss targets of training iterations. One set of
+    buffers is created for every (batch size, height, width) seen and reused by all
+    later batches of that shape, so the training loop doesn't allocate them again
+    and a partial last batch simply gets buffers of its own.
+    Targets are shaped [B, 1] like discriminator outputs.
+    """
+
+    def __init__(
+        self, channels: int, device: torch.device, channels_last: bool = False
+    ) -> None:
+        self.channels = channels
+        self.device = device
+        self.memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+        self.buffers = {}
+
+    def get(self, batch_size: int, height: int, width: int) -> tuple:
+        """
+        returns (input_shadow, input_mask, target_real, target_fake, mask_non_shadow)
+        buffers of the given batch shape
+        """
+        key = (batch_size, height, width)
+        if key not in self.buffers:
+            self.buffers[key] = self.__allocate(batch_size, height, width)
+        return self.buffers[key]
+
+    def load(self, shadow: torch.Tensor, shadow_free: torch.Tensor) -> tuple:
+        """
+        Copies [B, C, H, W] batch of shadow and shadow-free images into its buffers,
+        non blocking from pinned memory. Returns buffers like get().
+        """
+        buffers = self.get(shadow.size(0), *shadow.shape[2:])
+        buffers[0].copy_(shadow, non_blocking=True)
+        buffers[1].copy_(shadow_free, non_blocking=True)
+        return buffers
+
+    def load_mask(self, masks: torch.Tensor) -> torch.Tensor:
+        """
+        copies [B, 1, H, W] batch of shadow masks into its own buffer, non blocking
+        """
+        key = ("mask", *masks.shape)
+        if key not in self.buffers:
+            self.buffers[key] = torch.empty(
+                masks.shape, device=self.device, memory_format=self.memory_format
+            )
+        return self.buffers[key].copy_(masks, non_blocking=True)
+
+    def __allocate(self, batch_size: int, height: int, width: int) -> tuple:
+        def images(channels: int) -> torch.Tensor:
+            return torch.empty(
+                (batch_size, channels, height, width),
+                device=self.device,
+                memory_format=self.memory_format,
+            )
+
+        target_real = torch.ones((batch_size, 1), device=self.device)
+        target_fake = torch.zeros((batch_size, 1), device=self.device)
+        mask_non_shadow = images(1).fill_(-1.0)
+        return (
+            images(self.channels),
+            images(self.channels),
+            target_real,
+            target_fake,
+            mask_non_shadow,
+        )
@@ -0,0 +1,71 @@
+import os
+import threading
+
+import torch
+
+
+def to_cpu(state):
+    """
+    returns copy of nested dicts/lists/tuples with all tensors copied to CPU,
+    safe to serialize while training keeps updating the original tensors
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def atomic_save(state: dict, path: str) -> None:
+    """
+    Saves state to a temporary file which then replaces path, so an interrupted
+    save never leaves a partially written checkpoint behind.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as checkpoint_file:
+        torch.save(state, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
+
+class CheckpointWriter:
+    """
+    Saves checkpoints with atomic_save in a background thread. Only one save runs
+    at a time, starting a new one waits for the previous to finish.
+    """
+
+    def __init__(self) -> None:
+        self.thread = None
+        self.error = None
+
+    def save(self, state: dict, path: str) -> None:
+        """
+        state has to be a CPU copy (see to_cpu) not modified after the call
+        """
+        self.wait()
+        self.thread = threading.Thread(target=self.__save, args=(state, path))
+        self.thread.start()
+
+    def wait(self) -> None:
+        """
+        waits for the running save, re-raising its error
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __save(self, state: dict, path: str) -> None:
+        try:
+            atomic_save(state, path)
+        except Exception as error:
+            self.error = error
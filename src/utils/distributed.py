@@ -0,0 +1,83 @@
+import itertools
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """
+    only the main process logs and saves checkpoints
+    """
+    return rank() == 0
+
+
+def device() -> torch.device:
+    """
+    returns GPU of the process on its node, or CPU without CUDA
+    """
+    if torch.cuda.is_available():
+        return torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+    return torch.device("cpu")
+
+
+def broadcast_module(module: nn.Module, source: int = 0) -> None:
+    """
+    copies parameters and buffers of module from source process to all processes
+    """
+    with torch.no_grad():
+        for tensor in itertools.chain(module.parameters(), module.buffers()):
+            dist.broadcast(tensor, source)
+
+
+def launch(function, opt) -> None:
+    """
+    Runs function(opt) in a distributed process group. Processes started by torchrun
+    (RANK and WORLD_SIZE set in environment) join the group directly, otherwise
+    opt.nproc_per_node processes are spawned on this node, which is node opt.node_rank
+    of opt.nnodes. With a single process function runs without process group.
+    """
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        _run(function, opt, int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+    elif opt.nproc_per_node * opt.nnodes > 1:
+        os.environ.setdefault("MASTER_ADDR", opt.master_addr)
+        os.environ.setdefault("MASTER_PORT", str(opt.master_port))
+        mp.spawn(_worker, args=(function, opt), nprocs=opt.nproc_per_node)
+    else:
+        function(opt)
+
+
+def _worker(local_rank: int, function, opt) -> None:
+    os.environ["LOCAL_RANK"] = str(local_rank)
+    os.environ["RANK"] = str(opt.node_rank * opt.nproc_per_node + local_rank)
+    os.environ["WORLD_SIZE"] = str(opt.nnodes * opt.nproc_per_node)
+    _run(function, opt, opt.nproc_per_node)
+
+
+def _run(function, opt, local_world_size: int) -> None:
+    backend = opt.dist_backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    if torch.cuda.is_available():
+        torch.cuda.set_device(device())
+    else:
+        # processes on one node share its cores instead of oversubscribing them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+    dist.init_process_group(backend=backend, init_method="env://")
+    try:
+        function(opt)
+    finally:
+        dist.destroy_process_group()
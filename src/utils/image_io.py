@@ -0,0 +1,112 @@
+import io
+
+import torch
+import torchvision.io
+import torchvision.transforms as transforms
+from PIL import Image
+
+# pil and draft backends decode to PIL images, torchvision to uint8 CHW tensors
+BACKENDS = ("pil", "draft", "torchvision")
+
+
+def load_image(path: str, backend: str = "pil", size: int = None):
+    """
+    Decodes RGB image with given backend.
+    pil decodes full image with Pillow (or Pillow-SIMD installed in its place),
+    converting it only when it isn't RGB already.
+    draft additionally decodes at reduced resolution when its shorter side is
+    at least two times larger than size: JPEG images by DCT scaling during
+    decoding (Image.draft), others by fast integer factor downscaling (Image.reduce).
+    Shorter side of the result is never below size, so later Resize still gives
+    the requested size, but pixels differ slightly from resizing the full image.
+    torchvision decodes straight to uint8 tensor by libpng/libjpeg, size is ignored.
+    """
+    if backend == "torchvision":
+        return torchvision.io.read_image(path, torchvision.io.ImageReadMode.RGB)
+    return _decode_pil(path, backend, size)
+
+
+def decode_image(data: bytes, backend: str = "pil", size: int = None):
+    """
+    decodes RGB image from bytes of an encoded file, like load_image
+    """
+    if backend == "torchvision":
+        return torchvision.io.decode_image(
+            torch.frombuffer(bytearray(data), dtype=torch.uint8),
+            torchvision.io.ImageReadMode.RGB,
+        )
+    return _decode_pil(io.BytesIO(data), backend, size)
+
+
+def load_mask(path: str) -> torch.Tensor:
+    """
+    decodes grayscale mask image to uint8 [1, H, W] tensor
+    """
+    return torchvision.io.read_image(path, torchvision.io.ImageReadMode.GRAY)
+
+
+def decode_mask(data: bytes) -> torch.Tensor:
+    """
+    decodes grayscale mask image from bytes of an encoded file, like load_mask
+    """
+    return torchvision.io.decode_image(
+        torch.frombuffer(bytearray(data), dtype=torch.uint8),
+        torchvision.io.ImageReadMode.GRAY,
+    )
+
+
+def _decode_pil(file, backend: str, size: int) -> Image.Image:
+    assert backend in BACKENDS, f"Unknown image backend {backend}"
+    image = Image.open(file)
+    if backend == "draft" and size is not None:
+        image.draft("RGB", _reduced_size(image.size, size))
+        factor = min(image.size) // size
+        if factor >= 2:
+            image = image.reduce(factor)
+    # decoding closes the file
+    image.load()
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def _reduced_size(image_size: tuple, size: int) -> tuple:
+    """
+    returns (width, height) of image scaled so its shorter side equals size
+    """
+    scale = size / min(image_size)
+    return tuple(max(size, round(side * scale)) for side in image_size)
+
+
+def image_size(image) -> tuple:
+    """
+    returns (width, height) of image loaded by any backend
+    """
+    if isinstance(image, torch.Tensor):
+        return image.shape[-1], image.shape[-2]
+    return image.size
+
+
+def file_image_size(file) -> tuple:
+    """
+    returns (width, height) of image file (path or file object) read from its
+    header, without decoding
+    """
+    with Image.open(file) as image:
+        return image.size
+
+
+def to_tensor(backend: str):
+    """
+    returns transform converting images of the backend to float tensors in [0, 1]
+    """
+    if backend == "torchvision":
+        return transforms.ConvertImageDtype(torch.float)
+    return transforms.ToTensor()
+
+
+def to_uint8_tensor(backend: str):
+    """
+    returns transform converting images of the backend to uint8 tensors
+    """
+    if backend == "torchvision":
+        return transforms.Compose([])
+    return transforms.PILToTensor()
@@ -0,0 +1,51 @@
+import torch
+import torch.nn.functional as F
+
+
+def psnr(
+    images: torch.Tensor, references: torch.Tensor, data_range: float = 2.0
+) -> torch.Tensor:
+    """
+    returns peak signal-to-noise ratio in dB of every [B, C, H, W] image,
+    default data range corresponds to images normalized to [-1, 1]
+    """
+    mse = (images.float() - references.float()).pow(2).flatten(1).mean(1)
+    return 10 * torch.log10(data_range**2 / mse)
+
+
+def ssim(
+    images: torch.Tensor,
+    references: torch.Tensor,
+    data_range: float = 2.0,
+    window_size: int = 11,
+    sigma: float = 1.5,
+) -> torch.Tensor:
+    """
+    Returns structural similarity of every [B, C, H, W] image averaged over channels.
+    Local statistics are computed with gaussian window over valid positions only,
+    which matches skimage structural_similarity with gaussian_weights=True.
+    """
+    images, references = images.float(), references.float()
+    channels = images.size(1)
+
+    coordinates = torch.arange(window_size, dtype=torch.float, device=images.device)
+    gaussian = torch.exp(-((coordinates - window_size // 2) ** 2) / (2 * sigma**2))
+    gaussian = gaussian / gaussian.sum()
+    window = (gaussian[:, None] * gaussian[None, :]).expand(
+        channels, 1, window_size, window_size
+    )
+
+    def local_mean(tensor: torch.Tensor) -> torch.Tensor:
+        return F.conv2d(tensor, window, groups=channels)
+
+    mean_x, mean_y = local_mean(images), local_mean(references)
+    variance_x = local_mean(images * images) - mean_x**2
+    variance_y = local_mean(references * references) - mean_y**2
+    covariance = local_mean(images * references) - mean_x * mean_y
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    ssim_map = ((2 * mean_x * mean_y + c1) * (2 * covariance + c2)) / (
+        (mean_x**2 + mean_y**2 + c1) * (variance_x + variance_y + c2)
+    )
+    return ssim_map.flatten(1).mean(1)
@@ -0,0 +1,154 @@
+import math
+import time
+from collections import defaultdict, deque
+from contextlib import nullcontext
+
+import torch
+
+# shared no-op context returned by disabled profiler
+NO_PROFILING = nullcontext()
+
+
+class StepProfiler:
+    """
+    Opt-in timing of training step phases. Phase times of the last `window` steps
+    are kept in rolling buffers and every `report_every` steps a report with
+    images/sec and mean/p50/p95 time and share of every phase is printed.
+    Optionally a torch.profiler trace of steps [trace_start, trace_start + trace_steps)
+    is exported to trace_path in chrome trace format.
+    When disabled phase() returns a shared no-op context, so it costs nearly nothing.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        report_every: int = 100,
+        window: int = 1000,
+        trace_start: int = -1,
+        trace_steps: int = 5,
+        trace_path: str = "./profiler_trace.json",
+    ) -> None:
+        self.enabled = enabled
+        self.report_every = report_every
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+
+        self.phases = defaultdict(lambda: deque(maxlen=window))
+        self.step_times = deque(maxlen=window)
+        self.step_images = deque(maxlen=window)
+        self.current_phases = defaultdict(float)
+        self.steps = 0
+        self.step_start = None
+        self.last_step_end = None
+        self.trace = None
+
+    def phase(self, name: str):
+        """
+        returns context measuring time of the named phase of the current step
+        """
+        if not self.enabled:
+            return NO_PROFILING
+        return _Phase(self, name)
+
+    def begin_step(self) -> None:
+        """
+        called when a new batch is received, time since previous step is data wait
+        """
+        if not self.enabled:
+            return
+        if self.steps == self.trace_start:
+            self.__start_trace()
+
+        self.step_start = time.perf_counter()
+        if self.last_step_end is not None:
+            self.current_phases["data"] += self.step_start - self.last_step_end
+
+    def end_step(self, images: int) -> None:
+        """
+        called after all updates of the step with number of processed images
+        """
+        if not self.enabled:
+            return
+        self.synchronize()
+        self.last_step_end = time.perf_counter()
+
+        self.step_times.append(
+            self.last_step_end - self.step_start + self.current_phases.get("data", 0.0)
+        )
+        self.step_images.append(images)
+        for name, duration in self.current_phases.items():
+            self.phases[name].append(duration)
+        self.current_phases.clear()
+
+        self.steps += 1
+        if self.trace is not None and self.steps == self.trace_start + self.trace_steps:
+            self.__stop_trace()
+        if self.steps % self.report_every == 0:
+            self.report()
+
+    def report(self) -> None:
+        total_time = sum(self.step_times)
+        if total_time == 0:
+            return
+        print(
+            f"[Profiler: last {len(self.step_times)} iterations], "
+            f"[images/sec: {sum(self.step_images) / total_time:.2f}], "
+            f"[step: {1000 * total_time / len(self.step_times):.1f} ms]"
+        )
+        print(f"{'phase':<22}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'share':>9}")
+        for name, durations in self.phases.items():
+            ordered = sorted(durations)
+            # phases not executed in every step are averaged over all steps
+            mean = sum(ordered) / len(self.step_times)
+            print(
+                f"{name:<22}{1000 * mean:>10.2f}"
+                f"{1000 * _percentile(ordered, 50):>10.2f}"
+                f"{1000 * _percentile(ordered, 95):>10.2f}"
+                f"{100 * sum(ordered) / total_time:>8.1f}%"
+            )
+
+    def synchronize(self) -> None:
+        # CUDA kernels run asynchronously, they are awaited to attribute time correctly
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def __start_trace(self) -> None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.trace = torch.profiler.profile(activities=activities, record_shapes=True)
+        self.trace.__enter__()
+
+    def __stop_trace(self) -> None:
+        self.trace.__exit__(None, None, None)
+        self.trace.export_chrome_trace(self.trace_path)
+        print(f"Profiler trace saved to {self.trace_path}")
+        self.trace = None
+
+
+def _percentile(ordered: list, percent: float) -> float:
+    """
+    nearest-rank percentile of sorted values
+    """
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class _Phase:
+    def __init__(self, profiler: StepProfiler, name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self) -> None:
+        self.profiler.synchronize()
+        if self.profiler.trace is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.profiler.synchronize()
+        self.profiler.current_phases[self.name] += time.perf_counter() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
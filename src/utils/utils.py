@@ -1,47 +1,78 @@
-import numpy as np
 import torch
 import torch.nn as nn
 
-from PIL import Image
-from torch.autograd import Variable
-import torchvision.transforms as transforms
-from skimage.filters import threshold_otsu
-
-tf_to_grayscale = transforms.Grayscale(num_output_channels=1)
-tf_to_PIL = transforms.ToPILImage()
-
 
 def mask_generator(
     shadow_img: torch.Tensor, shadow_free_img: torch.Tensor
 ) -> torch.Tensor:
     """
-    generate mask image from shadow and shadow free image
+    generate mask images from batches of shadow and shadow free images,
+    returns [B, 1, H, W] tensor placed on the device of the inputs
     """
-    image_free = tf_to_grayscale(
-        tf_to_PIL(((shadow_free_img.data.squeeze(0) + 1) * 0.5).cuda())
-    )
-    image_shadow = tf_to_grayscale(
-        tf_to_PIL(((shadow_img.data.squeeze(0) + 1) * 0.5).cuda())
+    # difference between shadow image and shadow_free image
+    diff = _to_grayscale(shadow_free_img) - _to_grayscale(shadow_img)
+
+    threshold = otsu_threshold(diff.flatten(1))
+    # -1.0:non-shadow, 1.0:shadow
+    mask = (diff >= threshold.view(-1, 1, 1)).float() * 2 - 1
+
+    return mask.unsqueeze(1)
+
+
+def _to_grayscale(image: torch.Tensor) -> torch.Tensor:
+    """
+    converts [B, 3, H, W] image in [-1, 1] range to [B, H, W] float grayscale
+    with 8 bit levels, same as ToPILImage followed by PIL "L" conversion
+    """
+    image = ((image.detach() + 1) * 0.5).mul(255).byte().int()
+    # ITU-R 601-2 luma transform in PIL's fixed point arithmetic
+    gray = (
+        image[:, 0] * 19595 + image[:, 1] * 38470 + image[:, 2] * 7471 + 0x8000
+    ) >> 16
+    return gray.float()
+
+
+def otsu_threshold(values: torch.Tensor, bins_number: int = 256) -> torch.Tensor:
+    """
+    Computes Otsu threshold for every row of [B, N] tensor from its histogram,
+    follows skimage.filters.threshold_otsu. Returns [B] tensor.
+    """
+    minimum = values.min(dim=1, keepdim=True).values
+    maximum = values.max(dim=1, keepdim=True).values
+    bin_width = (maximum - minimum).clamp_min(
+        torch.finfo(values.dtype).eps
+    ) / bins_number
+
+    bins = ((values - minimum) / bin_width).long().clamp_(0, bins_number - 1)
+    counts = torch.zeros(
+        values.size(0), bins_number, dtype=values.dtype, device=values.device
+    ).scatter_add_(1, bins, torch.ones_like(values))
+    bin_centers = (
+        minimum
+        + (torch.arange(bins_number, dtype=values.dtype, device=values.device) + 0.5)
+        * bin_width
     )
 
-    diff = np.asarray(image_free, dtype="float32") - np.asarray(
-        image_shadow, dtype="float32"
-    )  # difference between shadow image and shadow_free image
+    # class probabilities and means for all possible thresholds
+    weighted_counts = counts * bin_centers
+    weight1 = counts.cumsum(1)
+    weight2 = counts.flip(1).cumsum(1)
+    mean1 = weighted_counts.cumsum(1) / weight1
+    mean2 = (weighted_counts.flip(1).cumsum(1) / weight2).flip(1)
+    weight2 = weight2.flip(1)
 
-    L = threshold_otsu(diff)
-    mask = (
-        torch.tensor((np.float32(diff >= L) - 0.5) / 0.5)
-        .unsqueeze(0)
-        .unsqueeze(0)
-        .cuda()
-    )  # -1.0:non-shadow, 1.0:shadow
-    mask.requires_grad = False
+    variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    threshold = bin_centers.gather(1, variance12.argmax(dim=1, keepdim=True))
 
-    # print("MASK type (mask_generator:)", type(mask))
-    return mask
+    # single intensity rows are thresholded at that intensity
+    return torch.where(maximum == minimum, minimum, threshold).squeeze(1)
 
 
-# pass
+def computed_sum(*losses):
+    """
+    sums losses leaving out the ones which weren't computed (None)
+    """
+    return sum(loss for loss in losses if loss is not None)
 
 
 def weights_init(model: nn.Module) -> None:
@@ -77,53 +108,118 @@ class LR_lambda:
         )
 
 
-# TODO description everywhere
 class QueueMask:
+    """
+    Ring buffer of the last generated shadow masks. Masks are stored in one
+    [lenght, 1, H, W] tensor preallocated on the first insert on the masks device,
+    so inserting and sampling never reallocates memory.
+    """
+
     def __init__(self, lenght: int) -> None:
+        assert lenght > 0, "Empty queue"
         self.max_len = lenght
-        self.queue = []
-
-    def insert(self, mask):
-        # print("insert works")
-        # print("Mask:", type(mask))
-        if self.queue.__len__() >= self.max_len:
-            self.queue.pop(0)
-        self.queue.append(mask)
-        # print("q len: ", len(self.queue))
-
-    def rand_item(self):
-        assert len(self.queue) > 0
-        return self.queue[np.random.randint(0, self.queue.__len__())]
-
-    def last_item(self):
-        assert len(self.queue) > 0, "Error! Empty queue!"
-        return self.queue[self.queue.__len__() - 1]
+        self.queue = None
+        self.cursor = 0
+        self.size = 0
+        self.last_indices = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def insert(self, mask: torch.Tensor) -> None:
+        """
+        inserts batch of masks, overwriting the oldest ones when queue is full
+        """
+        mask = mask.detach()[-self.max_len :]
+        if self.queue is None:
+            self.queue = torch.empty(
+                (self.max_len, *mask.shape[1:]), dtype=mask.dtype, device=mask.device
+            )
+
+        indices = (
+            torch.arange(mask.size(0), device=self.queue.device) + self.cursor
+        ) % self.max_len
+        self.queue.index_copy_(0, indices, mask)
+
+        self.cursor = (self.cursor + mask.size(0)) % self.max_len
+        self.size = min(self.size + mask.size(0), self.max_len)
+        self.last_indices = indices
+
+    def rand_item(self, batch_size: int = 1) -> torch.Tensor:
+        """
+        returns batch of masks sampled from the queue
+        """
+        assert self.size > 0, "Error! Empty queue!"
+        indices = torch.randint(self.size, (batch_size,), device=self.queue.device)
+        return self.queue[indices]
+
+    def last_item(self) -> torch.Tensor:
+        """
+        returns the most recently inserted batch of masks
+        """
+        assert self.size > 0, "Error! Empty queue!"
+        return self.queue[self.last_indices]
+
+    def state_dict(self) -> dict:
+        return {
+            "queue": self.queue,
+            "cursor": self.cursor,
+            "size": self.size,
+            "last_indices": self.last_indices,
+        }
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.queue = state_dict["queue"]
+        self.cursor = state_dict["cursor"]
+        self.size = state_dict["size"]
+        self.last_indices = state_dict["last_indices"]
 
 
 class Buffer:
     """
     Used for temporary storage of shadow masks and shadowed images.
     It is initialized with maximum size and to store a mask or a shadow
-    push_and_pop function can be utilised.
+    push_and_pop function can be utilised. Images are kept in one [max_size, C, H, W]
+    tensor preallocated on the first push on the images device.
     """
 
     def __init__(self, max_size=50):
         assert max_size > 0, "Empty buffer"
         self.max_size = max_size
-        self.data = []
-
-    def push_and_pop(self, data):
-        res = []
-        for element in data.data:
-            element = torch.unsqueeze(element, 0)
-            if len(self.data) < self.max_size:
-                self.data.append(element)
-                res.append(element)
-            else:
-                if np.random.uniform(0, 1) > 0.5:
-                    i = np.random.randint(0, self.max_size - 1)
-                    res.append(self.data[i].clone())
-                    self.data[i] = element
-                else:
-                    res.append(element)
-        return Variable(torch.cat(res))
+        self.data = None
+        self.size = 0
+
+    def push_and_pop(self, data: torch.Tensor) -> torch.Tensor:
+        data = data.detach()
+        if self.data is None:
+            self.data = torch.empty(
+                (self.max_size, *data.shape[1:]), dtype=data.dtype, device=data.device
+            )
+
+        # until the buffer is full images are stored and returned unchanged
+        stored = min(data.size(0), self.max_size - self.size)
+        self.data[self.size : self.size + stored] = data[:stored]
+        self.size += stored
+
+        outputs = [data[:stored]]
+        # otherwise each image is swapped with a random stored one with 0.5 probability,
+        # images of one chunk get distinct stored images, so no swap is lost
+        for incoming in data[stored:].split(self.max_size):
+            swap = torch.rand(incoming.size(0), device=data.device) > 0.5
+            swap = swap.view(-1, *([1] * (data.dim() - 1)))
+            indices = torch.randperm(self.max_size, device=data.device)[
+                : incoming.size(0)
+            ]
+
+            picked = self.data[indices]
+            self.data[indices] = torch.where(swap, incoming, picked)
+            outputs.append(torch.where(swap, picked, incoming))
+
+        return torch.cat(outputs)
+
+    def state_dict(self) -> dict:
+        return {"data": self.data, "size": self.size}
+
+    def load_state_dict(self, state_dict: dict) -> None:
+        self.data = state_dict["data"]
+        self.size = state_dict["size"]
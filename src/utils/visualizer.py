@@ -1,11 +1,13 @@
 from datetime import datetime
-from os import get_terminal_size, terminal_size
+from shutil import get_terminal_size
 
 from torchvision.utils import save_image
 import torch.cuda as cuda
 import os
 from PIL import Image
 
+from utils.image_io import load_image
+
 
 class Visualizer:
     """
@@ -73,19 +75,11 @@ class Visualizer:
             result_image.paste(image2, (0, image1.height))
         return result_image
 
-    def __image_loader(self, image_path: str, image_scale: float = 1) -> Image.Image:
+    def __image_loader(self, image_path: str) -> Image.Image:
         """
-        loading image by pillow and convert it to RGB
+        loading RGB image by pillow
         """
-        # https://github.com/python-pillow/Pillow/issues/835
-
-        image = Image.open(image_path)
-
-        width, height = image.size
-        # newsize = (int(width*image_scale),int(height*image_scale))
-        # image.resize(newsize)
-
-        return image.convert("RGB")
+        return load_image(image_path)
 
     def __get_files_list(self, folder_path: str) -> list:
         return sorted(os.listdir(folder_path))